@@ -0,0 +1,47 @@
+"""
+Compare converting a table with multi-dim (e.g. per-band photometry) columns to pandas by converting each row to a
+string (as astropy_table_to_pandas did before), by expanding each column into one column per band, and by keeping
+each as an array-backed column.
+
+Run from the repo root:
+    python benchmarks/astropy_table_to_pandas_benchmark.py --rows 1000000 --bands 7
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.table import Table
+
+from shared_astro_utils import astropy_utils
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark astropy_table_to_pandas')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--bands', type=int, default=7)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    table = Table({
+        'nsa_id': np.arange(args.rows),
+        'ra': rng.uniform(0., 360., size=args.rows),
+        'petroflux': rng.uniform(size=(args.rows, args.bands)).astype(np.float32),
+        'sersic_nmgy': rng.uniform(size=(args.rows, args.bands)).astype(np.float32),
+        'elpetro_absmag': rng.uniform(size=(args.rows, args.bands)).astype(np.float32)
+    })
+
+    print('{} rows, 3 columns of {} bands'.format(args.rows, args.bands))
+    for multidim in ['string', 'expand', 'array']:
+        # time and trace separately, as tracing slows allocation-heavy code
+        start = time.perf_counter()
+        df = astropy_utils.astropy_table_to_pandas(table, multidim=multidim)
+        elapsed = time.perf_counter() - start
+        del df
+        tracemalloc.start()
+        df = astropy_utils.astropy_table_to_pandas(table, multidim=multidim)
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+        del df
+        print('{:<7} {:.2f}s, {:.0f}MB peak extra memory'.format(multidim + ':', elapsed, peak / 1e6))
@@ -0,0 +1,73 @@
+"""
+Compare reading a few columns of a wide cached table from a FITS cache (as cache_table wrote before)
+and from a memory-mapped Feather cache, and the peak memory of caching a few columns by loading the whole
+source table (as before) or by streaming only those columns.
+
+Run from the repo root:
+    python benchmarks/astropy_utils_benchmark.py --rows 1000000 --columns 40
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.table import Table
+
+from shared_astro_utils import astropy_utils
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark table cache reads')
+    parser.add_argument('--rows', type=int, default=1000000)
+    parser.add_argument('--columns', type=int, default=40)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    table = Table({'col_{}'.format(n): rng.uniform(size=args.rows) for n in range(args.columns)})
+    table['iauname'] = np.array(['J{:012d}'.format(n) for n in range(args.rows)])
+    wanted = ['iauname', 'col_0', 'col_1']
+    all_cols = table.colnames
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        source_loc = os.path.join(temp_dir, 'catalog.fits')
+        table.write(source_loc)
+        del table
+        for cache_name in ['cache.fits', 'cache.feather', 'cache.parquet']:
+            cache_loc = os.path.join(temp_dir, cache_name)
+            start = time.perf_counter()
+            astropy_utils.cache_table(source_loc, cache_loc, useful_cols=all_cols)
+            write_time = time.perf_counter() - start
+
+            start = time.perf_counter()
+            if cache_name.endswith('.fits'):
+                data = Table.read(cache_loc)[wanted]
+            else:
+                data = astropy_utils.read_cache(cache_loc, columns=wanted)
+            read_time = time.perf_counter() - start
+            assert len(data) == args.rows
+
+            start = time.perf_counter()
+            if cache_name.endswith('.fits'):
+                data = Table.read(cache_loc)[wanted][1000:2000]
+            else:
+                data = astropy_utils.read_cache(cache_loc, columns=wanted, rows=slice(1000, 2000))
+            slice_time = time.perf_counter() - start
+
+            print('{:14} {:6.0f}MB: cache in {:.2f}s, read 3 columns in {:.3f}s, 1000 rows of them in {:.4f}s'.format(
+                cache_name, os.path.getsize(cache_loc) / 1024 ** 2, write_time, read_time, slice_time))
+
+        for name, loading_func in [('load whole table', lambda loc: Table.read(loc)), ('stream', Table.read)]:
+            subset_loc = os.path.join(temp_dir, 'subset.feather')
+            start = time.perf_counter()
+            astropy_utils.cache_table(source_loc, subset_loc, wanted, loading_func=loading_func)
+            elapsed = time.perf_counter() - start
+            os.remove(subset_loc)
+            tracemalloc.start()  # in a separate run, as tracing slows allocation-heavy code
+            astropy_utils.cache_table(source_loc, subset_loc, wanted, loading_func=loading_func)
+            _, peak = tracemalloc.get_traced_memory()
+            tracemalloc.stop()
+            os.remove(subset_loc)
+            print('cache 3 columns, {:16}: {:.2f}s, {:.0f}MB peak'.format(name, elapsed, peak / 1024 ** 2))
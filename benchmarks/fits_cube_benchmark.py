@@ -0,0 +1,67 @@
+"""
+Compare loading many fits cutouts into one (n, x, y, channel) array with a fits.open loop in memory (as each project
+did before) and with load_fits_cube, which decodes in a pool of processes into a memory-mapped .npy file.
+
+Run from the repo root:
+    python benchmarks/fits_cube_benchmark.py --files 2000 --size 128
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
+
+from shared_astro_utils import fits_utils
+
+
+def load_in_memory(fits_locs, crop_size, dtype):
+    images = []
+    for fits_loc in fits_locs:
+        pixels = np.moveaxis(fits.open(fits_loc)[0].data, 0, -1)
+        margin = (pixels.shape[0] - crop_size) // 2
+        images.append(pixels[margin:margin + crop_size, margin:margin + crop_size].astype(dtype))
+    return np.array(images)
+
+
+def measure(func, *args):
+    # time and trace separately, as tracing slows allocation-heavy code
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    del result
+    tracemalloc.start()
+    result = func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark loading fits cutouts into one array')
+    parser.add_argument('--files', type=int, default=2000)
+    parser.add_argument('--size', type=int, default=128, help='width of the (square, 3-band) cutouts')
+    parser.add_argument('--crop-size', type=int, default=96)
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        fits_locs = [os.path.join(temp_dir, '{}.fits'.format(n)) for n in range(args.files)]
+        for fits_loc in fits_locs:
+            fits.writeto(fits_loc, rng.uniform(size=(3, args.size, args.size)).astype(np.float32))
+
+        in_memory, in_memory_time, in_memory_peak = measure(load_in_memory, fits_locs, args.crop_size, np.float16)
+        cube_loc = os.path.join(temp_dir, 'cube.npy')
+        cube, cube_time, cube_peak = measure(
+            fits_utils.load_fits_cube, fits_locs, cube_loc, args.crop_size, np.float16, args.max_workers)
+        assert np.array_equal(in_memory, cube)
+        del cube
+
+    print('{} cutouts of 3x{}x{} pixels, cropped to {} as float16, {} CPUs'.format(
+        args.files, args.size, args.size, args.crop_size, os.cpu_count()))
+    print('in memory:  {:.2f}s, {:.0f}MB peak'.format(in_memory_time, in_memory_peak))
+    print('fits cube:  {:.2f}s, {:.0f}MB peak (in this process)'.format(cube_time, cube_peak))
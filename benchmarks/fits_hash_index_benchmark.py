@@ -0,0 +1,62 @@
+"""
+Compare finding duplicate fits cutouts by comparing every pair of files with fits_are_identical (estimated from a
+sample of pairs) and with a FitsHashIndex, both when first built and when updated with nothing changed.
+
+Run from the repo root:
+    python benchmarks/fits_hash_index_benchmark.py --files 20000
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+from astropy.io import fits
+
+from shared_astro_utils import fits_utils
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark duplicate fits detection')
+    parser.add_argument('--files', type=int, default=20000)
+    parser.add_argument('--size', type=int, default=64, help='width of the (square, 3-band) cutouts')
+    parser.add_argument('--duplicates', type=float, default=0.05, help='fraction of files which are copies')
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        image_dir = os.path.join(temp_dir, 'images')
+        n_originals = int(args.files * (1 - args.duplicates))
+        for n in range(args.files):
+            subdir = os.path.join(image_dir, str(n // 1000))
+            os.makedirs(subdir, exist_ok=True)
+            seed = n if n < n_originals else rng.randint(n_originals)
+            cutout = np.random.RandomState(seed).uniform(size=(3, args.size, args.size)).astype(np.float32)
+            fits.writeto(os.path.join(subdir, '{}.fits'.format(n)), cutout)
+        locs = [os.path.join(subdir, name) for subdir, _, names in os.walk(image_dir) for name in names]
+
+        n_sample = 1000
+        pairs = [tuple(rng.choice(locs, size=2, replace=False)) for _ in range(n_sample)]
+        start = time.perf_counter()
+        for loc_a, loc_b in pairs:
+            fits_utils.fits_are_identical(loc_a, loc_b)
+        pairwise_time = (time.perf_counter() - start) / n_sample * args.files * (args.files - 1) / 2
+
+        index_loc = os.path.join(temp_dir, 'index.db')
+        with fits_utils.FitsHashIndex(index_loc) as index:
+            start = time.perf_counter()
+            index.update(image_dir, max_workers=args.max_workers)
+            groups = index.duplicate_groups()
+            build_time = time.perf_counter() - start
+            start = time.perf_counter()
+            report = index.update(image_dir, max_workers=args.max_workers)
+            assert report['hashed'] == 0
+            assert index.duplicate_groups() == groups
+            update_time = time.perf_counter() - start
+
+    print('{} files of 3x{}x{} pixels, {} groups of identical files, {} CPUs'.format(
+        args.files, args.size, args.size, len(groups), os.cpu_count()))
+    print('every pair:        {:.0f}s (estimated from {} pairs)'.format(pairwise_time, n_sample))
+    print('hash index:        {:.2f}s to build, {:.2f}s to update when unchanged'.format(build_time, update_time))
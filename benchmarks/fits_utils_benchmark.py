@@ -0,0 +1,78 @@
+"""
+Compare checking large fits images are identical by reading both whole (as fits_are_identical did before) and by
+comparing memory-mapped blocks, and checking a directory of fits pairs one by one or in a pool of processes.
+
+Run from the repo root:
+    python benchmarks/fits_utils_benchmark.py --size 8000 --files 200
+"""
+import argparse
+import os
+import tempfile
+import time
+import tracemalloc
+
+import numpy as np
+from astropy.io import fits
+
+from shared_astro_utils import fits_utils
+
+
+def original_fits_are_identical(fits_a_loc, fits_b_loc):
+    pixels_a = fits.open(fits_a_loc)[0].data
+    pixels_b = fits.open(fits_b_loc)[0].data
+    return np.allclose(pixels_a[~np.isnan(pixels_a)], pixels_b[~np.isnan(pixels_b)])
+
+
+def measure(func, *args):
+    # time and trace separately, as tracing slows allocation-heavy code
+    start = time.perf_counter()
+    result = func(*args)
+    elapsed = time.perf_counter() - start
+    tracemalloc.start()
+    func(*args)
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1e6
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark fits comparison')
+    parser.add_argument('--size', type=int, default=8000, help='width of the large (square) images')
+    parser.add_argument('--files', type=int, default=200, help='number of cutouts in each directory')
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        mosaic = rng.uniform(size=(args.size, args.size)).astype(np.float32)
+        mosaic_locs = [os.path.join(temp_dir, name) for name in ['mosaic.fits', 'copy.fits', 'changed.fits']]
+        fits.writeto(mosaic_locs[0], mosaic)
+        fits.writeto(mosaic_locs[1], mosaic)
+        mosaic[0, 0] += 1.
+        fits.writeto(mosaic_locs[2], mosaic)
+        del mosaic
+
+        print('{0}x{0} float32 mosaics'.format(args.size))
+        for name, other_loc in [('identical', mosaic_locs[1]), ('differing', mosaic_locs[2])]:
+            for label, func in [('original', original_fits_are_identical), ('blocks', fits_utils.fits_are_identical)]:
+                _, elapsed, peak = measure(func, mosaic_locs[0], other_loc)
+                print('{:<10} {:<9} {:.2f}s, {:.0f}MB peak'.format(name, label + ':', elapsed, peak))
+
+        dir_a, dir_b = os.path.join(temp_dir, 'a'), os.path.join(temp_dir, 'b')
+        os.mkdir(dir_a)
+        os.mkdir(dir_b)
+        for n in range(args.files):
+            cutout = rng.uniform(size=(3, 424, 424)).astype(np.float32)
+            fits.writeto(os.path.join(dir_a, '{}.fits'.format(n)), cutout)
+            fits.writeto(os.path.join(dir_b, '{}.fits'.format(n)), cutout)
+        names = sorted(os.listdir(dir_a))
+        start = time.perf_counter()
+        one_by_one = [original_fits_are_identical(os.path.join(dir_a, name), os.path.join(dir_b, name)) for name in names]
+        one_by_one_time = time.perf_counter() - start
+        start = time.perf_counter()
+        pooled = fits_utils.fits_dirs_are_identical(dir_a, dir_b, max_workers=args.max_workers)
+        pooled_time = time.perf_counter() - start
+        assert all(one_by_one) and all(pooled.values())
+        print('{} pairs of 3x424x424 cutouts: one by one {:.2f}s, in a pool {:.2f}s ({} CPUs)'.format(
+            args.files, one_by_one_time, pooled_time, os.cpu_count()))
@@ -0,0 +1,44 @@
+"""
+Time self-match deduplication (matching_utils.deduplicate_catalog) of a large catalog with some duplicated galaxies.
+
+Run from the repo root:
+    python benchmarks/matching_dedup_benchmark.py --catalog-size 10000000 --n-bands 1 8
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+from astropy import units
+
+from shared_astro_utils import matching_utils
+
+
+def duplicated_catalog(n, duplicate_fraction, rng):
+    ra = rng.uniform(0., 360., size=n)
+    dec = np.degrees(np.arcsin(rng.uniform(-1., 1., size=n)))
+    n_duplicates = int(n * duplicate_fraction)
+    duplicated = rng.choice(n, size=n_duplicates, replace=False)
+    return pd.DataFrame({
+        'ra': np.concatenate([ra, ra[duplicated] + rng.uniform(-0.3, 0.3, size=n_duplicates) / 3600]),
+        'dec': np.concatenate([dec, dec[duplicated] + rng.uniform(-0.3, 0.3, size=n_duplicates) / 3600]),
+        'mag': rng.uniform(15., 20., size=n + n_duplicates)
+    })
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark catalog deduplication')
+    parser.add_argument('--catalog-size', type=int, default=10000000)
+    parser.add_argument('--duplicate-fraction', type=float, default=0.05)
+    parser.add_argument('--n-bands', type=int, nargs='+', default=[1, 8])
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    catalog = duplicated_catalog(args.catalog_size, args.duplicate_fraction, rng)
+
+    for n_bands in args.n_bands:
+        start = time.perf_counter()
+        deduplicated, report = matching_utils.deduplicate_catalog(catalog, 1 * units.arcsec, keep_by='mag', n_bands=n_bands)
+        print('{} rows, {} bands: {:.1f}s, removed {} duplicates, group sizes {}'.format(
+            len(catalog), n_bands, time.perf_counter() - start, report['removed'], report['group_sizes']))
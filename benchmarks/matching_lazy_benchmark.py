@@ -0,0 +1,68 @@
+"""
+Compare the peak memory of joining a wide catalog with match_galaxies_to_catalog_pandas against gathering only
+a few columns from match_galaxies_to_catalog_lazy.
+
+Run from the repo root:
+    python benchmarks/matching_lazy_benchmark.py --catalog-size 200000 --catalog-columns 200 --galaxies 200000
+"""
+import argparse
+import time
+import tracemalloc
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import matching_utils
+
+
+def wide_table(n, n_columns, rng, prefix):
+    columns = {
+        'ra': rng.uniform(0., 360., size=n),
+        'dec': np.degrees(np.arcsin(rng.uniform(-1., 1., size=n)))
+    }
+    for n_col in range(n_columns):
+        columns['{}_{}'.format(prefix, n_col)] = rng.uniform(size=n)
+    return pd.DataFrame(columns)
+
+
+def measure(func):
+    tracemalloc.start()
+    start = time.perf_counter()
+    result = func()
+    elapsed = time.perf_counter() - start
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return result, elapsed, peak / 1024 ** 2
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark lazy crossmatch results')
+    parser.add_argument('--catalog-size', type=int, default=200000)
+    parser.add_argument('--catalog-columns', type=int, default=200)
+    parser.add_argument('--galaxies', type=int, default=200000)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    catalog = wide_table(args.catalog_size, args.catalog_columns, rng, 'catalog')
+    # galaxies near the first catalog galaxies, so most match
+    galaxies = wide_table(args.galaxies, 20, rng, 'galaxy')
+    galaxies['ra'] = catalog['ra'].values[np.arange(args.galaxies) % args.catalog_size]
+    galaxies['dec'] = catalog['dec'].values[np.arange(args.galaxies) % args.catalog_size]
+    index = matching_utils.CatalogIndex.from_catalog(catalog)
+
+    (joined, _), join_time, join_peak = measure(
+        lambda: matching_utils.match_galaxies_to_catalog_pandas(galaxies, catalog, catalog_index=index))
+    galaxies = galaxies.drop(columns=['best_match', 'sky_separation'])  # added by match_galaxies_to_catalog_pandas
+    catalog = catalog.drop(columns='best_match')
+
+    columns = ['catalog_0', 'catalog_1', 'catalog_2']
+    lazy_matched, lazy_time, lazy_peak = measure(
+        lambda: matching_utils.match_galaxies_to_catalog_lazy(galaxies, catalog, catalog_index=index).matched(
+            galaxy_columns=['galaxy_0'], catalog_columns=columns))
+    assert np.all(lazy_matched['catalog_0'].values == joined['catalog_0'].values)
+
+    print('{} galaxies against {} catalog galaxies with {} columns'.format(
+        args.galaxies, args.catalog_size, args.catalog_columns))
+    print('join everything:        {:.2f}s, {:.0f}MB peak'.format(join_time, join_peak))
+    print('lazy, gather 4 columns: {:.2f}s, {:.0f}MB peak'.format(lazy_time, lazy_peak))
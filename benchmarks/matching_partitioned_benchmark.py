@@ -0,0 +1,58 @@
+"""
+Time match_galaxies_to_catalog_partitioned with different numbers of worker processes, from tables on disk.
+
+Run from the repo root:
+    python benchmarks/matching_partitioned_benchmark.py --catalog-size 10000000 --galaxies 1000000 --workers 1 2 4 8
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import matching_utils
+
+
+def random_table(n, rng, data_col):
+    return pd.DataFrame({
+        'ra': rng.uniform(0., 360., size=n),
+        'dec': np.degrees(np.arcsin(rng.uniform(-1., 1., size=n))),
+        data_col: rng.uniform(size=n)
+    })
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark partitioned crossmatching')
+    parser.add_argument('--catalog-size', type=int, default=10000000)
+    parser.add_argument('--galaxies', type=int, default=1000000)
+    parser.add_argument('--bands', type=int, default=64)
+    parser.add_argument('--workers', nargs='+', type=int, default=[1, 2, 4])
+    parser.add_argument('--compare-in-memory', action='store_true',
+                        help='also time match_galaxies_to_catalog_pandas (needs both tables in memory)')
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    with tempfile.TemporaryDirectory() as temp_dir:
+        catalog_loc = os.path.join(temp_dir, 'catalog.parquet')
+        galaxies_loc = os.path.join(temp_dir, 'galaxies.parquet')
+        random_table(args.catalog_size, rng, 'table_data').to_parquet(catalog_loc, index=False)
+        galaxies = random_table(args.galaxies, rng, 'galaxy_data')
+        # half the galaxies have a catalog counterpart
+        catalog_head = pd.read_parquet(catalog_loc).iloc[:args.galaxies // 2]
+        galaxies.iloc[:len(catalog_head), :2] = catalog_head[['ra', 'dec']].values + 1. / 3600
+        galaxies.to_parquet(galaxies_loc, index=False)
+        del catalog_head
+
+        if args.compare_in_memory:
+            start = time.perf_counter()
+            matching_utils.match_galaxies_to_catalog_pandas(pd.read_parquet(galaxies_loc), pd.read_parquet(catalog_loc))
+            print('in memory: {:.2f}s'.format(time.perf_counter() - start))
+
+        for workers in args.workers:
+            start = time.perf_counter()
+            matched, _ = matching_utils.match_galaxies_to_catalog_partitioned(
+                galaxies_loc, catalog_loc, n_bands=args.bands, max_workers=workers)
+            print('{} workers: {:.2f}s ({} matched)'.format(workers, time.perf_counter() - start, len(matched)))
@@ -0,0 +1,83 @@
+"""
+Compare crossmatching many galaxy batches against one catalog, with and without a (saved) CatalogIndex,
+and re-running the same crossmatches with a MatchCache.
+
+Run from the repo root:
+    python benchmarks/matching_utils_benchmark.py --catalog-size 1000000 --batches 20 --batch-size 10000
+"""
+import argparse
+import tempfile
+import time
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import matching_utils
+
+
+def random_positions(n, rng):
+    return pd.DataFrame({
+        'ra': rng.uniform(0., 360., size=n),
+        'dec': np.degrees(np.arcsin(rng.uniform(-1., 1., size=n)))
+    })
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark repeated crossmatching')
+    parser.add_argument('--catalog-size', type=int, default=1000000)
+    parser.add_argument('--batches', type=int, default=20)
+    parser.add_argument('--batch-size', type=int, default=10000)
+    args = parser.parse_args()
+
+    rng = np.random.RandomState(42)
+    catalog = random_positions(args.catalog_size, rng)
+    batches = [random_positions(args.batch_size, rng) for _ in range(args.batches)]
+
+    start = time.perf_counter()
+    expected = [matching_utils.match_galaxies_to_catalog_pandas(batch.copy(), catalog.copy())[0] for batch in batches]
+    no_index_time = time.perf_counter() - start
+
+    start = time.perf_counter()
+    index = matching_utils.CatalogIndex.from_catalog(catalog)
+    build_time = time.perf_counter() - start
+    start = time.perf_counter()
+    matched = [
+        matching_utils.match_galaxies_to_catalog_pandas(batch.copy(), catalog.copy(), catalog_index=index)[0]
+        for batch in batches
+    ]
+    index_time = time.perf_counter() - start
+    for matched_batch, expected_batch in zip(matched, expected):
+        assert matched_batch['best_match'].tolist() == expected_batch['best_match'].tolist()
+
+    with tempfile.TemporaryDirectory() as index_dir:
+        index.save(index_dir)
+        start = time.perf_counter()
+        loaded = matching_utils.CatalogIndex.load(index_dir)
+        load_time = time.perf_counter() - start
+
+    with tempfile.TemporaryDirectory() as cache_dir:
+        cache = matching_utils.MatchCache(cache_dir)
+        start = time.perf_counter()
+        for batch in batches:
+            matching_utils.match_galaxies_to_catalog_pandas(batch.copy(), catalog.copy(), match_cache=cache)
+        cache_miss_time = time.perf_counter() - start
+        start = time.perf_counter()
+        cached = [
+            matching_utils.match_galaxies_to_catalog_pandas(batch.copy(), catalog.copy(), match_cache=cache)[0]
+            for batch in batches
+        ]
+        cache_hit_time = time.perf_counter() - start
+        start = time.perf_counter()
+        for batch in batches:
+            matching_utils.match_galaxies_to_catalog_lazy(batch, catalog, match_cache=cache)
+        lazy_hit_time = time.perf_counter() - start
+    for cached_batch, expected_batch in zip(cached, expected):
+        assert cached_batch['best_match'].tolist() == expected_batch['best_match'].tolist()
+
+    print('{} batches of {} galaxies against {} catalog galaxies'.format(args.batches, args.batch_size, args.catalog_size))
+    print('without index:     {:.2f}s'.format(no_index_time))
+    print('with index:        {:.2f}s (+ {:.2f}s to build once, or {:.3f}s to load from disk)'.format(
+        index_time, build_time, load_time))
+    print('with cache:        {:.2f}s first run, {:.2f}s re-run ({:.2f}s re-run without joining, with lazy results)'.format(
+        cache_miss_time, cache_hit_time, lazy_hit_time))
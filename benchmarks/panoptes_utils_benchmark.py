@@ -0,0 +1,64 @@
+"""
+Compare the vectorized and row-wise paths of panoptes_utils.load_current_subjects.
+
+Run from the repo root:
+    python benchmarks/panoptes_utils_benchmark.py --sizes 10000 100000 1000000
+"""
+import argparse
+import json
+import time
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import panoptes_utils
+
+
+def make_subject_export(n_subjects, n_metadata_keys=30, seed=42):
+    # mimics a Panoptes subject export: one row per subject, with metadata and locations as json strings
+    rng = np.random.RandomState(seed)
+    values = rng.uniform(0., 100., size=(n_subjects, n_metadata_keys))
+    keys = ['!key_{}'.format(n) if n % 2 else 'key_{}'.format(n) for n in range(n_metadata_keys - 2)]
+    metadata = [
+        json.dumps(dict(
+            zip(keys, row[:len(keys)].tolist()),
+            **{'!iauname': 'J{:06d}'.format(n), '#retirement_limit': 40}))
+        for n, row in enumerate(values)
+    ]
+    locations = [
+        json.dumps({'0': 'https://panoptes-uploads.zooniverse.org/production/subject_location/{}.png'.format(n)})
+        for n in range(n_subjects)
+    ]
+    return pd.DataFrame({
+        'subject_id': np.arange(n_subjects),
+        'project_id': 5733,
+        'workflow_id': np.nan,  # entirely empty, so dropped
+        'subject_set_id': 1234,
+        'metadata': metadata,
+        'locations': locations,
+        'classifications_count': rng.randint(0, 40, size=n_subjects),
+        'retired_at': None
+    })
+
+
+def time_load(df, vectorized):
+    start = time.perf_counter()
+    subjects = panoptes_utils.load_current_subjects(df, vectorized=vectorized)
+    return time.perf_counter() - start, subjects
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark load_current_subjects')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--metadata-keys', type=int, default=30)
+    args = parser.parse_args()
+
+    print('{:>10} {:>14} {:>14} {:>9}'.format('rows', 'row-wise (s)', 'vectorized (s)', 'speedup'))
+    for size in args.sizes:
+        df = make_subject_export(size, n_metadata_keys=args.metadata_keys)
+        vectorized_time, vectorized_subjects = time_load(df, vectorized=True)
+        rowwise_time, rowwise_subjects = time_load(df, vectorized=False)
+        pd.testing.assert_frame_equal(vectorized_subjects, rowwise_subjects)
+        print('{:>10} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(
+            size, rowwise_time, vectorized_time, rowwise_time / vectorized_time))
@@ -0,0 +1,59 @@
+"""
+Compare saving grids of labelled galaxy images with matplotlib (as plot_galaxy_grid does by default) and as one numpy
+mosaic (fast=True), and saving many grids one by one or in a pool of processes.
+
+Run from the repo root:
+    python benchmarks/plotting_utils_benchmark.py --grids 20 --rows 10 --columns 10
+"""
+import argparse
+import os
+import tempfile
+import time
+
+import numpy as np
+
+from shared_astro_utils import plotting_utils
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark galaxy grid plotting')
+    parser.add_argument('--grids', type=int, default=20)
+    parser.add_argument('--rows', type=int, default=10)
+    parser.add_argument('--columns', type=int, default=10)
+    parser.add_argument('--size', type=int, default=128, help='width of the (square, 3-band) galaxy images')
+    parser.add_argument('--max-workers', type=int, default=None)
+    args = parser.parse_args()
+
+    per_grid = args.rows * args.columns
+    rng = np.random.RandomState(42)
+    galaxies = rng.uniform(0., 256., size=(args.grids * per_grid, args.size, args.size, 3)).astype(np.float32)
+    labels = ['{}'.format(n) for n in range(len(galaxies))]
+
+    with tempfile.TemporaryDirectory() as temp_dir:
+        n_matplotlib = min(args.grids, 3)  # slow
+        start = time.perf_counter()
+        for n in range(n_matplotlib):
+            grid = slice(n * per_grid, (n + 1) * per_grid)
+            plotting_utils.plot_galaxy_grid(
+                galaxies[grid], args.rows, args.columns, os.path.join(temp_dir, 'slow_{}.png'.format(n)), labels=labels[grid])
+        matplotlib_time = (time.perf_counter() - start) / n_matplotlib
+
+        start = time.perf_counter()
+        for n in range(args.grids):
+            grid = slice(n * per_grid, (n + 1) * per_grid)
+            plotting_utils.plot_galaxy_grid(
+                galaxies[grid], args.rows, args.columns, os.path.join(temp_dir, 'fast_{}.png'.format(n)),
+                labels=labels[grid], fast=True)
+        fast_time = (time.perf_counter() - start) / args.grids
+
+        save_locs = [os.path.join(temp_dir, 'pooled_{}.png'.format(n)) for n in range(args.grids)]
+        start = time.perf_counter()
+        plotting_utils.save_galaxy_mosaics(
+            galaxies, args.rows, args.columns, save_locs, labels=labels, max_workers=args.max_workers)
+        pooled_time = (time.perf_counter() - start) / args.grids
+
+    print('{}x{} grids of {}px galaxies, with labels, {} CPUs'.format(args.rows, args.columns, args.size, os.cpu_count()))
+    print('matplotlib:        {:.3f}s per grid'.format(matplotlib_time))
+    print('fast:              {:.3f}s per grid'.format(fast_time))
+    print('fast, in a pool:   {:.3f}s per grid'.format(pooled_time))
@@ -0,0 +1,75 @@
+"""
+Measure bulk_upload_subjects throughput against a fake (in-memory) Panoptes API, with no network.
+
+Run from the repo root:
+    python benchmarks/upload_benchmark.py --subjects 500 --latency 0.05 --error-rate 0.01 --max-requests-per-second 100
+"""
+import argparse
+import logging
+import os
+import struct
+import tempfile
+import time
+
+from shared_astro_utils import fake_panoptes_utils, upload_utils, rate_limit_utils
+
+
+def make_manifest(n_subjects, image_dir, image_bytes=10000):
+    manifest = []
+    for n in range(n_subjects):
+        loc = os.path.join(image_dir, '{}.png'.format(n))
+        with open(loc, 'wb') as f:
+            f.write(b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 424, 424) + os.urandom(image_bytes))
+        manifest.append({'locations': [loc], 'metadata': {'!filename': os.path.basename(loc)}})
+    return manifest
+
+
+def time_upload(manifest, backend_kwargs, max_in_flight):
+    rate_limit_utils.PANOPTES_WRITE_LIMITER = rate_limit_utils.AdaptiveRateLimiter(
+        max_rate=args.max_rate, base_delay=0.1, max_retries=10)
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=42, **backend_kwargs)
+    start = time.perf_counter()
+    try:
+        with backend.patch():
+            upload_utils.bulk_upload_subjects('benchmark', manifest, max_in_flight=max_in_flight)
+    except Exception as e:  # e.g. out of retries: report, and carry on to the next mode
+        logging.error('Upload failed: {}'.format(e))
+        duration = None
+    else:
+        duration = time.perf_counter() - start
+        assert backend.summary()['linked'] == len(manifest)
+    return duration, backend.summary(), rate_limit_utils.PANOPTES_WRITE_LIMITER.stats
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark bulk_upload_subjects against a fake Panoptes API')
+    parser.add_argument('--subjects', type=int, default=500)
+    parser.add_argument('--latency', type=float, default=0.05, help='seconds per fake API request')
+    parser.add_argument('--latency-jitter', type=float, default=0.02)
+    parser.add_argument('--error-rate', type=float, default=0.)
+    parser.add_argument('--max-requests-per-second', type=float, default=None, help='fake API throttling limit')
+    parser.add_argument('--max-rate', type=float, default=10., help='client-side rate limit, requests per second')
+    parser.add_argument('--max-in-flight', nargs='+', type=int, default=[4, 8, 16])
+    args = parser.parse_args()
+
+    backend_kwargs = {
+        'latency': args.latency,
+        'latency_jitter': args.latency_jitter,
+        'error_rate': args.error_rate,
+        'max_requests_per_second': args.max_requests_per_second
+    }
+
+    with tempfile.TemporaryDirectory() as image_dir:
+        manifest = make_manifest(args.subjects, image_dir)
+        print('{:>14} {:>10} {:>12} {:>8} {:>8} {:>8}'.format(
+            'mode', 'time (s)', 'subjects/s', 'retries', '429s', '503s'))
+        for max_in_flight in [None] + args.max_in_flight:
+            duration, summary, stats = time_upload(manifest, backend_kwargs, max_in_flight)
+            print('{:>14} {:>10} {:>12} {:>8} {:>8} {:>8}'.format(
+                'blocks' if max_in_flight is None else 'pipelined {}'.format(max_in_flight),
+                'failed' if duration is None else '{:.2f}'.format(duration),
+                '-' if duration is None else '{:.1f}'.format(len(manifest) / duration),
+                stats['retries'],
+                summary['errors'].get(429, 0),
+                summary['errors'].get(503, 0)))
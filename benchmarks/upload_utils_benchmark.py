@@ -0,0 +1,66 @@
+"""
+Compare the vectorized and row-wise paths of upload_utils.create_manifest_from_catalog.
+
+Run from the repo root:
+    python benchmarks/upload_utils_benchmark.py --sizes 10000 100000 1000000
+"""
+import argparse
+import time
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import upload_utils
+
+CHECK_EVERY = 10  # compare the two paths' manifests on every 10th record
+
+
+def make_catalog(n_galaxies, seed=42):
+    rng = np.random.RandomState(seed)
+    redshift = rng.uniform(0.01, 0.2, size=n_galaxies)
+    redshift[rng.rand(n_galaxies) < 0.05] = np.nan  # some missing values, as in the NSA
+    return pd.DataFrame({
+        'iauname': np.array(['J{:06d}'.format(n).encode() for n in range(n_galaxies)], dtype=object),
+        'nsa_id': np.arange(n_galaxies),
+        'ra': rng.uniform(0., 360., size=n_galaxies),
+        'dec': rng.uniform(-30., 80., size=n_galaxies),
+        'petrotheta': rng.uniform(1., 30., size=n_galaxies).astype(np.float32),
+        'petroth50': rng.uniform(1., 30., size=n_galaxies),
+        'petroth90': rng.uniform(1., 30., size=n_galaxies),
+        'redshift': redshift,
+        'nsa_version': 'v1_0_1',
+        'file_loc': ['/data/png/J{:06d}.png'.format(n) for n in range(n_galaxies)],
+        '#retirement_limit': 40,
+        '#uploader': 'benchmark'
+    })
+
+
+def time_manifest(catalog, vectorized):
+    start = time.perf_counter()
+    manifest = upload_utils.create_manifest_from_catalog(catalog, vectorized=vectorized)
+    return time.perf_counter() - start, manifest
+
+
+if __name__ == '__main__':
+
+    parser = argparse.ArgumentParser(description='Benchmark create_manifest_from_catalog')
+    parser.add_argument('--sizes', nargs='+', type=int, default=[10000, 100000, 1000000])
+    parser.add_argument('--skip-rowwise-above', type=int, default=None,
+                        help='only time the (slow) row-wise path for catalogs up to this many rows')
+    args = parser.parse_args()
+
+    print('{:>10} {:>14} {:>14} {:>9}'.format('rows', 'row-wise (s)', 'vectorized (s)', 'speedup'))
+    for size in args.sizes:
+        catalog = make_catalog(size)
+        vectorized_time, vectorized_manifest = time_manifest(catalog, vectorized=True)
+        # keep only every CHECK_EVERY'th record to compare: two full manifests of 1M rows need >6GB
+        vectorized_sample = vectorized_manifest[::CHECK_EVERY]
+        del vectorized_manifest
+        if args.skip_rowwise_above is not None and size > args.skip_rowwise_above:
+            print('{:>10} {:>14} {:>14.2f} {:>9}'.format(size, '-', vectorized_time, '-'))
+            continue
+        rowwise_time, rowwise_manifest = time_manifest(catalog, vectorized=False)
+        assert rowwise_manifest[::CHECK_EVERY] == vectorized_sample
+        del rowwise_manifest
+        print('{:>10} {:>14.2f} {:>14.2f} {:>8.1f}x'.format(
+            size, rowwise_time, vectorized_time, rowwise_time / vectorized_time))
@@ -1,55 +1,592 @@
+import json
+import logging
+import os
 
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+from astropy import units as u
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn, Column
+from astropy.table import meta as table_meta
+from astropy.table.connect import TableRead
 
-from astropy.table import Table
+try:
+    import h5py  # optional, to stream HDF5 tables
+except ImportError:
+    h5py = None
 
 from .time_utils import current_time  # use a relative import, this could be a package
 
+# cache_loc extensions saved in a columnar format, which can be read a few columns and rows at a time
+COLUMNAR_FORMATS = {
+    '.feather': 'feather',
+    '.arrow': 'feather',
+    '.parquet': 'parquet',
+    '.pq': 'parquet'
+}
 
-def cache_table(table_loc, cache_loc, useful_cols, loading_func=Table.read, kwargs=None):
+CACHE_METADATA_KEY = b'shared_astro_utils'
+
+# loading kwargs which iter_source_chunks understands. With any others, cache_table loads the table instead.
+STREAMING_KWARGS = {'hdu', 'path'}
+
+
+def cache_table(table_loc, cache_loc, useful_cols, loading_func=Table.read, kwargs=None, chunk_size=100000):
     """
     Save a column subset of astropy.table. This can be read later to save time.
+
+    If cache_loc ends in .feather (or .arrow) or .parquet (or .pq), the cache is columnar, and can be read a few
+    columns and rows at a time with read_cache. Feather caches are uncompressed and memory-mapped, so reads are
+    near-instant whatever the table size. Columnar caches record the source file size and modification time,
+    and the loading kwargs, and are only rebuilt if the source or kwargs have changed (or useful_cols are not all cached).
+    Otherwise, the cache is saved with Table.write (e.g. FITS), and always rebuilt.
+
+    Columnar caches of FITS or HDF5 tables read with the default loading_func, and no kwargs other than hdu or path,
+    are streamed: only useful_cols are read, chunk_size rows at a time (see iter_source_chunks),
+    so the source table need not fit in memory.
+
     Args:
         table_loc (str): file location of astropy.table to load
         cache_loc (str): file location to save column subset of astropy.table
         useful_cols (list): of form ['a_column_to_save', ...]
         loading_func (func): function to load table, where first arg is table_loc
-        kwargs (dict): (optional) additional keyword arguments for loading_func
+        kwargs (dict): (optional) additional keyword arguments for loading_func e.g. {'hdu': 2} or {'path': 'data'}
+        chunk_size (int): rows to read at a time, if streaming
 
     Returns:
         None
     """
+    columnar = cache_format(cache_loc) is not None
+    if columnar and is_cache_fresh(table_loc, cache_loc, useful_cols, kwargs=kwargs):
+        logging.info('Cache {} is up to date with {}'.format(cache_loc, table_loc))
+        return
     print('Begin caching at {}'.format(current_time()))
+    kwargs = kwargs if kwargs is not None else {}
+    streamable = isinstance(loading_func, TableRead) and source_format(table_loc) is not None
+    if columnar and streamable and set(kwargs) <= STREAMING_KWARGS:
+        with CacheWriter(cache_loc, source_loc=table_loc, kwargs=kwargs, columns=useful_cols) as writer:
+            for chunk in iter_source_chunks(table_loc, useful_cols, chunk_size=chunk_size, **kwargs):
+                writer.write(chunk)
+        logging.info('Streamed {} rows to cache {} at {}'.format(writer.n_rows, cache_loc, current_time()))
+        return
     data = loading_func(table_loc, **kwargs)
     print('Table loaded at {}'.format(current_time()))
     data = data[useful_cols]  # need to lower the memory before writing, because writing involves a copy
-    data.write(cache_loc, overwrite=True)
+    if columnar:
+        write_cache(data, cache_loc, source_loc=table_loc, kwargs=kwargs)
+    else:
+        data.write(cache_loc, overwrite=True)
     print('Saved to astropy.Table at {}'.format(current_time()))
 
 
-def astropy_table_to_pandas(table):
+def load_cached_table(table_loc, cache_loc, useful_cols, columns=None, rows=None, loading_func=Table.read, kwargs=None):
+    """
+    Read columns and rows of a table from a columnar cache, (re)building the cache first if needed.
+    See cache_table and read_cache.
+
+    Args:
+        table_loc (str): file location of astropy.table to load
+        cache_loc (str): file location of cache, ending in .feather or .parquet
+        useful_cols (list): columns to cache, if (re)building the cache
+        columns (list): columns to read. If None, read useful_cols.
+        rows (slice): rows to read e.g. slice(1000, 2000). If None, read all rows.
+        loading_func (func): function to load table, where first arg is table_loc
+        kwargs (dict): (optional) additional keyword arguments for loading_func
+
+    Returns:
+        (astropy.table.Table) requested columns and rows of table
+    """
+    if cache_format(cache_loc) is None:
+        raise ValueError('Cache {} is not columnar - expected one of {}'.format(cache_loc, list(COLUMNAR_FORMATS)))
+    cache_table(table_loc, cache_loc, useful_cols, loading_func=loading_func, kwargs=kwargs)
+    return read_cache(cache_loc, columns=columns if columns is not None else useful_cols, rows=rows)
+
+
+def cache_format(cache_loc):
+    """
+    Args:
+        cache_loc (str): file location of cache
+
+    Returns:
+        (str) 'feather' or 'parquet', or None if cache_loc is not columnar
+    """
+    return COLUMNAR_FORMATS.get(os.path.splitext(cache_loc)[1].lower())
+
+
+def source_signature(table_loc):
+    """
+    Args:
+        table_loc (str): file location of source table
+
+    Returns:
+        (dict) of form {'size': bytes, 'mtime_ns': modification time}, which changes whenever the file changes
+    """
+    stat = os.stat(table_loc)
+    return {'size': stat.st_size, 'mtime_ns': stat.st_mtime_ns}
+
+
+def kwargs_signature(kwargs):
+    """
+    Args:
+        kwargs (dict): keyword arguments for loading a table, or None
+
+    Returns:
+        (dict) kwargs as they would be after a round trip through JSON (for the cache metadata), for comparing.
+            Values which are not JSON types are compared by repr.
+    """
+    return json.loads(json.dumps(kwargs if kwargs is not None else {}, sort_keys=True, default=repr))
+
+
+def is_cache_fresh(table_loc, cache_loc, useful_cols=None, kwargs=None):
+    """
+    Args:
+        table_loc (str): file location of source table
+        cache_loc (str): file location of columnar cache
+        useful_cols (list): if not None, columns the cache must include
+        kwargs (dict): (optional) keyword arguments the source table is loaded with e.g. {'hdu': 2}
+
+    Returns:
+        (bool) True if cache_loc exists, was built from table_loc as it is now and with the same kwargs,
+            and includes useful_cols
+    """
+    if not os.path.isfile(cache_loc):
+        return False
+    try:
+        metadata = read_cache_metadata(cache_loc)
+    except (pa.ArrowInvalid, OSError, ValueError, KeyError):
+        logging.warning('Cannot read cache metadata from {} - rebuilding'.format(cache_loc))
+        return False
+    if metadata.get('source') != source_signature(table_loc):
+        return False
+    if metadata.get('kwargs') != kwargs_signature(kwargs):  # e.g. another HDU of the same file
+        return False
+    return useful_cols is None or set(useful_cols) <= set(metadata['columns'])
+
+
+def write_cache(data, cache_loc, source_loc=None, kwargs=None):
+    """
+    Save an astropy Table in a columnar format (from the extension of cache_loc), keeping column dtypes,
+    shapes (multi-dim columns), masks, units and descriptions. Written atomically.
+
+    Args:
+        data (astropy.table.Table): table to save
+        cache_loc (str): file location of cache, ending in .feather or .parquet
+        source_loc (str): if not None, record the size and modification time of this (source table) file,
+            for is_cache_fresh
+        kwargs (dict): (optional) keyword arguments the source table was loaded with, recorded for is_cache_fresh
+    """
+    with CacheWriter(cache_loc, source_loc=source_loc, kwargs=kwargs) as writer:
+        writer.write(data)
+
+
+class CacheWriter():
+    """
+    Write a columnar cache (see write_cache) one chunk (astropy Table) at a time, so it never needs to fit in memory.
+    Column dtypes, shapes, units and descriptions are fixed by the first chunk.
+    The cache only appears at cache_loc once closed without error.
+    """
+
+    def __init__(self, cache_loc, source_loc=None, kwargs=None, columns=None):
+        """
+        Args:
+            cache_loc (str): file location of cache, ending in .feather or .parquet
+            source_loc (str): if not None, record the size and modification time of this (source table) file,
+                for is_cache_fresh. Taken now, so that changes to the source while writing make the cache stale.
+            kwargs (dict): (optional) keyword arguments the source table is loaded with, recorded for is_cache_fresh
+            columns (list): (optional) column names, for an empty (float) cache if no chunks are written
+        """
+        self.cache_loc = cache_loc
+        self.file_format = cache_format(cache_loc)
+        if self.file_format is None:
+            raise ValueError('Cache {} is not columnar - expected one of {}'.format(cache_loc, list(COLUMNAR_FORMATS)))
+        self.source = source_signature(source_loc) if source_loc is not None else None
+        self.kwargs = kwargs_signature(kwargs)
+        self.columns = columns
+        self.n_rows = 0
+        self._temp_loc = cache_loc + '.tmp'
+        self._schema = None
+        self._writer = None
+        self._sink = None
+
+    def write(self, data):
+        """
+        Args:
+            data (astropy.table.Table): next chunk of table, with the same columns as the first chunk
+        """
+        arrays, column_metadata = [], {}
+        for col in data.colnames:
+            array, column_metadata[col] = _column_to_arrow(data[col])
+            arrays.append(array)
+        if self._schema is None:
+            metadata = {'columns': column_metadata, 'source': self.source, 'kwargs': self.kwargs}
+            self._schema = pa.Table.from_arrays(arrays, names=list(data.colnames)).schema.with_metadata(
+                {CACHE_METADATA_KEY: json.dumps(metadata).encode()})
+            self._open()
+        arrow_table = pa.Table.from_arrays(arrays, schema=self._schema)
+        self._writer.write_table(arrow_table)
+        self.n_rows += len(data)
+
+    def close(self, completed=True):
+        """
+        Args:
+            completed (bool): if True, move the cache into place. If False, delete it.
+        """
+        if self._schema is None and completed:  # no chunks, so no dtypes: write an empty table of the columns
+            self.write(Table(names=self.columns if self.columns is not None else []))
+        if self._writer is not None:
+            self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        self._writer = None
+        self._sink = None
+        if completed:
+            os.replace(self._temp_loc, self.cache_loc)
+        elif os.path.isfile(self._temp_loc):
+            os.remove(self._temp_loc)
+
+    def _open(self):
+        if self.file_format == 'feather':
+            # uncompressed, so that reads can memory-map the file rather than decompress it
+            self._sink = pa.OSFile(self._temp_loc, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self._schema)
+        else:
+            self._writer = pq.ParquetWriter(self._temp_loc, self._schema)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, *exc):
+        self.close(completed=exc_type is None)
+
+
+def source_format(table_loc):
+    """
+    Args:
+        table_loc (str): file location of source table
+
+    Returns:
+        (str) 'fits' or 'hdf5' if iter_source_chunks can stream table_loc, else None
+    """
+    name = table_loc.lower()
+    if name.endswith(('.fits', '.fit', '.fts')):
+        return 'fits'
+    if name.endswith(('.hdf5', '.h5', '.he5')):
+        return 'hdf5'
+    return None
+
+
+def iter_source_chunks(table_loc, columns, chunk_size=100000, hdu=1, path=None):
+    """
+    Read columns of a FITS binary table or (astropy) HDF5 table, chunk_size rows at a time, without reading the other
+    columns or loading the whole table. FITS tables are memory-mapped. Chunks are as Table.read would read them:
+    with units, and FITS null values, NaNs and empty strings masked.
+
+    Args:
+        table_loc (str): file location of FITS or HDF5 table
+        columns (list): columns to read
+        chunk_size (int): max. rows per chunk
+        hdu (int or str): FITS HDU of table
+        path (str): HDF5 path of table. If None, the first table found.
+
+    Yields:
+        (astropy.table.Table) next chunk of table. An empty table yields one empty chunk, with the columns' dtypes.
+    """
+    if source_format(table_loc) == 'fits':
+        yield from _iter_fits_chunks(table_loc, columns, chunk_size, hdu)
+    elif source_format(table_loc) == 'hdf5':
+        yield from _iter_hdf5_chunks(table_loc, columns, chunk_size, path)
+    else:
+        raise ValueError('Cannot stream {} - expected a FITS or HDF5 table'.format(table_loc))
+
+
+def _iter_fits_chunks(table_loc, columns, chunk_size, hdu):
+    # masks and units follow astropy.io.fits.connect.read_table_fits, but only for the columns asked for
+    with fits.open(table_loc, memmap=True, character_as_bytes=True) as hdulist:
+        data = hdulist[hdu].data
+        fits_columns = {col.name: col for col in data.columns}
+        units_by_col = {
+            col: u.Unit(fits_columns[col].unit, format='fits', parse_strict='warn') if fits_columns[col].unit else None
+            for col in columns
+        }
+        try:
+            for start in range(0, max(len(data), 1), chunk_size):  # an empty table still yields one (empty) chunk
+                rows = data[start:start + chunk_size]  # a view: nothing is read until a column is accessed
+                yield Table([_fits_chunk_column(rows, fits_columns[col], data.dtype[col].base, units_by_col[col])
+                             for col in columns], copy=False)
+        finally:
+            # on closing, astropy copies the (whole) array of every column still attached to the data
+            for fits_column in fits_columns.values():
+                del fits_column.array
+
+
+def _fits_chunk_column(rows, fits_column, raw_dtype, unit):
+    values = np.array(rows[fits_column.name])  # scaled and converted like Table.read, for these rows only
+    if values.dtype.kind == 'U':  # slices forget character_as_bytes: back to bytes, at the full width
+        values = values.astype(raw_dtype)
+    masked, mask = False, False
+    if fits_column.null is not None:
+        masked, mask = True, values == fits_column.null
+    elif issubclass(values.dtype.type, np.inexact):
+        mask = np.isnan(values)
+    elif issubclass(values.dtype.type, np.character):
+        mask = values == b''
+    if masked or np.any(mask):
+        column = MaskedColumn(values, name=fits_column.name, mask=mask, copy=False)
+    else:
+        column = Column(values, name=fits_column.name, copy=False)
+    column.unit = unit
+    return column
+
+
+def _iter_hdf5_chunks(table_loc, columns, chunk_size, path):
+    # astropy saves each masked column as two fields, col and col.mask, and column units etc. in a YAML header
+    if h5py is None:
+        raise ImportError('Streaming HDF5 tables requires h5py')
+    with h5py.File(table_loc, 'r') as f:
+        if path is None:
+            path = _first_hdf5_table(f)
+        dataset = f[path]
+        header_cols = {}
+        if path + '.__table_column_meta__' in f:
+            header = table_meta.get_header_from_yaml(
+                line.decode('utf-8') for line in f[path + '.__table_column_meta__'])
+            header_cols = {col['name']: col for col in header['datatype']}
+        fields = set(dataset.dtype.names)
+        masked = [col for col in columns if col + '.mask' in fields]
+        read_fields = columns + [col + '.mask' for col in masked]
+        for start in range(0, max(len(dataset), 1), chunk_size):  # an empty table still yields one (empty) chunk
+            rows = dataset.fields(read_fields)[start:start + chunk_size]  # reads only these fields
+            chunk = []
+            for col in columns:
+                if col in masked:
+                    column = MaskedColumn(rows[col], name=col, mask=rows[col + '.mask'], copy=False)
+                else:
+                    column = Column(rows[col], name=col, copy=False)
+                for attr in ('unit', 'description'):
+                    if attr in header_cols.get(col, {}):
+                        setattr(column, attr, header_cols[col][attr])
+                chunk.append(column)
+            yield Table(chunk, copy=False)
+
+
+def _first_hdf5_table(f):
+    # like Table.read, default to the first structured (table) dataset
+    tables = []
+    f.visititems(lambda name, obj: tables.append(name) if isinstance(obj, h5py.Dataset) and obj.dtype.names else None)
+    if not tables:
+        raise ValueError('No table found in {}'.format(f.filename))
+    return tables[0]
+
+
+def read_cache(cache_loc, columns=None, rows=None):
+    """
+    Read columns and rows of a columnar cache, without reading the rest of the cache.
+    Feather caches are memory-mapped, so only the pages of the requested columns and rows are read from disk.
+    Parquet caches read only the requested columns, and only the row groups including the requested rows.
+
+    Args:
+        cache_loc (str): file location of cache, from cache_table or write_cache
+        columns (list): columns to read. If None, read all columns.
+        rows (slice): rows to read e.g. slice(1000, 2000). If None, read all rows.
+
+    Returns:
+        (astropy.table.Table) requested columns and rows, with the dtypes, units etc. of the cached table
+    """
+    rows = rows if rows is not None else slice(None)
+    if rows.step not in (None, 1):
+        raise ValueError('rows must be a contiguous slice, not {}'.format(rows))
+    if cache_format(cache_loc) == 'feather':
+        with pa.memory_map(cache_loc, 'r') as source:
+            arrow_table = pa.ipc.open_file(source).read_all()
+        if columns is not None:
+            arrow_table = arrow_table.select(columns)
+        start, stop, _ = rows.indices(arrow_table.num_rows)
+        arrow_table = arrow_table.slice(start, max(stop - start, 0))
+    else:
+        arrow_table = _read_parquet_rows(cache_loc, columns, rows)
+    metadata = json.loads(arrow_table.schema.metadata[CACHE_METADATA_KEY])
+    return Table(
+        [_column_from_arrow(col, arrow_table.column(col), metadata['columns'][col]) for col in arrow_table.column_names],
+        copy=False)
+
+
+def read_cache_metadata(cache_loc):
+    """
+    Args:
+        cache_loc (str): file location of cache
+
+    Returns:
+        (dict) of form {'columns': {col: {'dtype': ..., 'shape': ...}}, 'source': source_signature or None,
+            'kwargs': kwargs_signature}
+    """
+    if cache_format(cache_loc) == 'feather':
+        with pa.memory_map(cache_loc, 'r') as source:
+            schema = pa.ipc.open_file(source).schema
+    else:
+        schema = pq.read_schema(cache_loc)
+    return json.loads(schema.metadata[CACHE_METADATA_KEY])
+
+
+def _read_parquet_rows(cache_loc, columns, rows):
+    parquet_file = pq.ParquetFile(cache_loc, memory_map=True)
+    start, stop, _ = rows.indices(parquet_file.metadata.num_rows)
+    # read only the row groups overlapping [start, stop)
+    row_groups, first_row, group_start = [], None, 0
+    for n in range(parquet_file.num_row_groups):
+        group_stop = group_start + parquet_file.metadata.row_group(n).num_rows
+        if group_stop > start and group_start < stop:
+            row_groups.append(n)
+            first_row = group_start if first_row is None else first_row
+        group_start = group_stop
+    if not row_groups:
+        arrow_table = parquet_file.schema_arrow.empty_table()
+        return arrow_table.select(columns) if columns is not None else arrow_table
+    arrow_table = parquet_file.read_row_groups(row_groups, columns=columns)
+    return arrow_table.slice(start - first_row, stop - start)
+
+
+def _column_to_arrow(column):
+    values = np.asarray(column)
+    if not values.dtype.isnative:  # e.g. big-endian, from FITS
+        values = values.astype(values.dtype.newbyteorder('='))
+    metadata = {
+        'dtype': values.dtype.str,
+        'shape': list(values.shape[1:]),
+        'unit': column.unit.to_string() if column.unit is not None else None,
+        'description': column.description
+    }
+    mask = np.asarray(column.mask) if isinstance(column, MaskedColumn) else None
+    if mask is not None and not mask.any():
+        mask = None
+    if values.ndim > 1:
+        # Arrow has no multi-dim arrays: save each row as a fixed-size list of the flattened row
+        width = int(np.prod(values.shape[1:]))
+        flat = pa.array(values.reshape(-1), mask=mask.reshape(-1) if mask is not None else None)
+        return pa.FixedSizeListArray.from_arrays(flat, width), metadata
+    return pa.array(values, mask=mask), metadata
+
+
+def _column_from_arrow(name, chunked_array, metadata):
+    dtype = np.dtype(metadata['dtype'])
+    shape = tuple(metadata['shape'])
+    array = chunked_array.combine_chunks() if chunked_array.num_chunks != 1 else chunked_array.chunk(0)
+    n_rows = len(array)
+    if shape:
+        array = array.flatten()  # of the sliced rows only
+    mask = None
+    if array.null_count > 0:
+        mask = array.is_null().to_numpy(zero_copy_only=False).reshape((n_rows,) + shape)
+        array = array.fill_null(_fill_value(array.type))
+    # astype restores e.g. fixed-width strings, and is free (no copy) for numeric columns
+    values = array.to_numpy(zero_copy_only=False).astype(dtype, copy=False).reshape((n_rows,) + shape)
+    kwargs = {'name': name, 'unit': metadata['unit'], 'description': metadata['description'], 'copy': False}
+    if mask is not None:
+        return MaskedColumn(values, mask=mask, **kwargs)
+    return Column(values, **kwargs)
+
+
+def _fill_value(arrow_type):
+    # placeholder for masked values, so the column can be converted to numpy without nulls
+    if pa.types.is_string(arrow_type) or pa.types.is_large_string(arrow_type):
+        return pa.scalar('', type=arrow_type)
+    if pa.types.is_binary(arrow_type) or pa.types.is_large_binary(arrow_type):
+        return pa.scalar(b'', type=arrow_type)
+    if pa.types.is_boolean(arrow_type):
+        return pa.scalar(False, type=arrow_type)
+    return pa.scalar(0, type=arrow_type)
+
+
+def astropy_table_to_pandas(table, multidim='string'):
     """
     Convert astropy table to pandas
-    Wrapper for table.to_pandas() that automatically avoids multidimensional columns
+    Wrapper for table.to_pandas() that automatically converts multidimensional columns, which to_pandas rejects
     Note that the reverse is already implemented: Table.from_pandas(df)
+
+    Multi-dim columns are converted according to multidim:
+        'string': each row becomes the string of its list of values e.g. '[1.0, 2.0]', as originally. Slow.
+        'expand': each column of shape (N, k) becomes k columns, {col}_0 to {col}_{k-1} ({col}_0_0 etc. for
+            more dimensions), in place of the original column
+        'array': each column becomes one column of fixed-size lists of its values (pyarrow-backed)
+    With 'expand' or 'array', native-endian unmasked numeric columns (1D or multi-dim) are not copied: the DataFrame
+    shares their memory with table, so copy one or the other before modifying it in place.
+
     Args:
-        table (astropy.Table): table to be converted to pandas
+        table (astropy.Table): table to be converted to pandas. Not modified.
+        multidim (str): 'string', 'expand' or 'array'
 
     Returns:
-        (pd.DataFrame) original table as DataFrame, excluding multi-dim columns
+        (pd.DataFrame) original table as DataFrame
     """
+    if multidim not in ('string', 'expand', 'array'):
+        raise ValueError('multidim must be string, expand or array, not {}'.format(multidim))
+    if multidim == 'string':
+        columns = []
+        for col in table.colnames:
+            if len(table[col].shape) > 1:
+                logging.debug('converting {} to strings'.format(col))
+                columns.append(Column(list(map(lambda x: str(list(x)), table[col])), name=col))
+            else:
+                columns.append(table[col])
+        return Table(columns, copy=False).to_pandas()
+
+    # let to_pandas convert the columns that need converting (masked, big-endian, strings, mixins...)
+    converted = [
+        col for col in table.colnames
+        if len(table[col].shape) == 1 and not _is_shareable(table[col])
+    ]
+    converted = Table([table[col] for col in converted], copy=False).to_pandas() if converted else {}
+    columns = {}
     for col in table.colnames:
-        # if it has a shape
-        try:
-            exists = table[col].shape[1]
-        except IndexError:
-            print('{} is already one-dim'.format(col))
+        if col in converted:
+            columns[col] = converted[col]
+        elif len(table[col].shape) == 1:
+            columns[col] = np.asarray(table[col])
+        elif multidim == 'expand':
+            columns.update(_expand_multidim(col, table[col]))
         else:
-            print('converting {}'.format(col))
-            col_values = table[col]
-            #  convert to string
-            col_strings = list(map(lambda x: str(list(x)), col_values))
-            # replace original values
-            table[col] = col_strings
-
-    df = table.to_pandas()
-    return df
+            columns[col] = _multidim_to_arrow(table[col])
+    return pd.DataFrame(columns, copy=False)
+
+
+def _is_shareable(column):
+    # can pandas use these values as they are?
+    values = np.asarray(column)
+    return not isinstance(column, MaskedColumn) and values.dtype.isnative and values.dtype.kind in 'biufc'
+
+
+def _native_values(column):
+    values = np.asarray(column)
+    if not values.dtype.isnative:
+        values = values.astype(values.dtype.newbyteorder('='))
+    mask = np.asarray(column.mask) if isinstance(column, MaskedColumn) and np.any(column.mask) else None
+    return values, mask
+
+
+def _expand_multidim(name, column):
+    # one (strided view) column per element of each row
+    values, mask = _native_values(column)
+    expanded = {}
+    for position in np.ndindex(*values.shape[1:]):
+        element = values[(slice(None),) + position]
+        col = '{}_{}'.format(name, '_'.join(str(n) for n in position))
+        if mask is None:
+            expanded[col] = element
+        else:
+            element_mask = mask[(slice(None),) + position]
+            if element.dtype.kind in 'iu':  # nullable integers, as to_pandas
+                expanded[col] = pd.arrays.IntegerArray(np.ascontiguousarray(element), np.ascontiguousarray(element_mask))
+            elif element.dtype.kind == 'b':
+                expanded[col] = pd.arrays.BooleanArray(np.ascontiguousarray(element), np.ascontiguousarray(element_mask))
+            else:
+                expanded[col] = np.where(element_mask, np.nan, element)
+    return expanded
+
+
+def _multidim_to_arrow(column):
+    values, mask = _native_values(column)
+    width = int(np.prod(values.shape[1:]))
+    # pyarrow wraps native-endian numeric numpy data without copying
+    flat = pa.array(values.reshape(-1), mask=mask.reshape(-1) if mask is not None else None)
+    return pd.arrays.ArrowExtensionArray(pa.FixedSizeListArray.from_arrays(flat, width))
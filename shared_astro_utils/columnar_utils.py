@@ -0,0 +1,315 @@
+import logging
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+
+FILE_FORMATS = {
+    '.parquet': 'parquet',
+    '.pq': 'parquet',
+    '.feather': 'feather',
+    '.arrow': 'feather',
+    '.csv': 'csv'
+}
+
+
+def infer_format(loc):
+    """
+    Args:
+        loc (str): file location e.g. 'subjects.parquet'
+
+    Returns:
+        (str) 'parquet', 'feather' or 'csv', from the file extension
+    """
+    extension = os.path.splitext(loc)[1].lower()
+    try:
+        return FILE_FORMATS[extension]
+    except KeyError:
+        raise ValueError('Cannot infer table format from {} - expected one of {}'.format(loc, list(FILE_FORMATS)))
+
+
+def read_table(loc, columns=None, file_format=None):
+    """
+    Read a table written by ChunkedTableWriter (or any Parquet, Feather or csv table) into pandas
+
+    Args:
+        loc (str): file location
+        columns (list): if not None, only read these columns. Parquet and Feather skip the other columns on disk.
+        file_format (str): 'parquet', 'feather' or 'csv'. If None, infer from loc.
+
+    Returns:
+        (pd.DataFrame) table
+    """
+    file_format = file_format if file_format is not None else infer_format(loc)
+    if file_format == 'parquet':
+        return pd.read_parquet(loc, columns=columns)
+    if file_format == 'feather':
+        return pd.read_feather(loc, columns=columns)
+    return pd.read_csv(loc, usecols=columns)
+
+
+def iter_table_chunks(source, chunk_size=100000, columns=None):
+    """
+    Read a table chunk by chunk, so that it never needs to fit in memory
+
+    Args:
+        source (pd.DataFrame or str): table, or location of Parquet, Feather or csv table
+        chunk_size (int): max. rows per chunk. Feather tables are read one record batch (as written) at a time.
+        columns (list): if not None, only read these columns
+
+    Yields:
+        (pd.DataFrame) next chunk of table
+    """
+    if isinstance(source, pd.DataFrame):
+        for start in range(0, len(source), chunk_size):
+            chunk = source.iloc[start:start + chunk_size]
+            yield chunk[columns] if columns is not None else chunk
+        return
+    file_format = infer_format(source)
+    if file_format == 'parquet':
+        for batch in pq.ParquetFile(source).iter_batches(batch_size=chunk_size, columns=columns):
+            yield batch.to_pandas()
+    elif file_format == 'feather':
+        with pa.memory_map(source, 'r') as f:
+            reader = pa.ipc.open_file(f)
+            for n in range(reader.num_record_batches):
+                batch = reader.get_batch(n)
+                if columns is not None:
+                    batch = batch.select(columns)
+                yield batch.to_pandas()
+    else:
+        yield from pd.read_csv(source, chunksize=chunk_size, usecols=columns)
+
+
+def arrow_schema_for(df):
+    """
+    Pick an Arrow schema for df. Integer, float and bool columns keep their type (Arrow columns of any type can hold
+    nulls, so a later chunk may have missing values), columns with no values yet have the null type (see widen_schema),
+    and all other columns become strings.
+
+    Args:
+        df (pd.DataFrame): chunk of table
+
+    Returns:
+        (pa.Schema) schema for chunk
+    """
+    fields = []
+    for col in df.columns:
+        values = df[col]
+        if values.isna().all():
+            arrow_type = pa.null()
+        elif pd.api.types.is_bool_dtype(values.dtype):
+            arrow_type = pa.bool_()
+        elif pd.api.types.is_integer_dtype(values.dtype):
+            arrow_type = pa.int64()
+        elif pd.api.types.is_float_dtype(values.dtype):
+            arrow_type = pa.float64()
+        else:
+            arrow_type = pa.string()
+        fields.append(pa.field(str(col), arrow_type))
+    return pa.schema(fields)
+
+
+def widen_schema(schema, other):
+    """
+    Widen schema so that it can also hold tables of schema other, without losing any values.
+    Columns only in other are added (at the end). Columns in both keep their type if it matches, and otherwise
+    take the type of whichever has values (i.e. is not the null type), int and float become float,
+    and anything else becomes string.
+
+    Args:
+        schema (pa.Schema): schema of table so far
+        other (pa.Schema): schema of new chunk e.g. from arrow_schema_for
+
+    Returns:
+        (pa.Schema) schema for both
+    """
+    other_types = {field.name: field.type for field in other}
+    fields = [pa.field(field.name, _widen_type(field.type, other_types.get(field.name, pa.null()))) for field in schema]
+    fields += [field for field in other if field.name not in schema.names]
+    return pa.schema(fields)
+
+
+def _widen_type(a, b):
+    if a == b or pa.types.is_null(b):
+        return a
+    if pa.types.is_null(a):
+        return b
+    if {a, b} == {pa.int64(), pa.float64()}:
+        return pa.float64()
+    return pa.string()
+
+
+def conform_to_schema(df, schema):
+    """
+    Make a chunk match schema: reorder columns, add missing columns as nulls, drop columns not in schema,
+    and convert values to the schema types. Values that cannot be converted (e.g. text in a numeric column)
+    become null, with a warning. Widen the schema first (see widen_schema) to keep every value.
+
+    Args:
+        df (pd.DataFrame): chunk of table
+        schema (pa.Schema): schema of table, from arrow_schema_for
+
+    Returns:
+        (pd.DataFrame) chunk with one column per schema field, ready for pa.Table.from_pandas(chunk, schema)
+        (list) names of columns dropped because they were not in schema
+    """
+    dropped = [col for col in df.columns if col not in schema.names]
+    columns = {}
+    for field in schema:
+        if field.name not in df.columns:
+            values = pd.Series(None, index=df.index, dtype=object)
+        else:
+            values = df[field.name]
+        is_missing = values.isna()
+        if pa.types.is_null(field.type):
+            converted = pd.Series(None, index=df.index, dtype=object)
+        elif pa.types.is_string(field.type):
+            converted = values.astype(object).where(is_missing, values.astype(str)).where(~is_missing, None)
+        elif pa.types.is_boolean(field.type):
+            converted = values.astype(object).where(~is_missing, None)
+        elif pa.types.is_integer(field.type) and pd.api.types.is_integer_dtype(values.dtype):
+            converted = values  # exactly, without a round trip through float
+        else:
+            converted = pd.to_numeric(values, errors='coerce').astype(float)
+            if pa.types.is_integer(field.type):
+                converted = converted.where(converted == np.round(converted))  # Arrow will not truncate
+        n_lost = int(pd.isna(converted).sum() - is_missing.sum())
+        if n_lost > 0:
+            logging.warning('{} values of column {} are not {} and will be saved as null'.format(
+                n_lost, field.name, field.type))
+        columns[field.name] = converted
+    return pd.DataFrame(columns, index=df.index), dropped
+
+
+def conform_table(table, schema):
+    """
+    Convert an Arrow table (e.g. written with an earlier, narrower schema) to schema, in the same way as
+    conform_to_schema converts a chunk. Ints and bools are converted exactly, not via floats.
+
+    Args:
+        table (pa.Table): table to convert
+        schema (pa.Schema): schema to convert to, which should be widened from the schema of table (see widen_schema)
+
+    Returns:
+        (pa.Table) table with schema
+    """
+    # nullable dtypes, so ints and bools are not turned into floats and objects on the way
+    chunk = table.to_pandas(types_mapper={pa.int64(): pd.Int64Dtype(), pa.bool_(): pd.BooleanDtype()}.get)
+    return pa.Table.from_pandas(conform_to_schema(chunk, schema)[0], schema=schema, preserve_index=False)
+
+
+class ChunkedTableWriter():
+    """
+    Write a table to Parquet, Feather or csv one chunk (DataFrame) at a time, so it never needs to fit in memory.
+
+    The schema starts from the first chunk (see arrow_schema_for) and is widened by later chunks (see widen_schema),
+    so no values are lost: columns missing from a chunk are saved as nulls, new columns are added, and columns
+    whose type changes are saved as float (int and float) or string. Chunks written before the schema last changed
+    are rewritten to the final schema on close, one batch at a time.
+    """
+
+    def __init__(self, save_loc, file_format=None, schema=None):
+        """
+        Args:
+            save_loc (str): location to write table. Overwritten if it exists.
+            file_format (str): 'parquet', 'feather' or 'csv'. If None, infer from save_loc.
+            schema (pa.Schema): if not None, start from this schema (e.g. of an existing table to be extended)
+                rather than from the first chunk. Still widened by chunks which don't fit.
+        """
+        self.save_loc = save_loc
+        self.file_format = file_format if file_format is not None else infer_format(save_loc)
+        self.schema = schema
+        self.n_rows = 0
+        self._writer = None
+        self._sink = None
+        self._segments = []  # files of chunks written with earlier (narrower) schemas, in order
+        self._header_written = False
+
+    def write(self, df):
+        """
+        Args:
+            df (pd.DataFrame): next chunk of table
+        """
+        chunk_schema = arrow_schema_for(df)
+        schema = chunk_schema if self.schema is None else widen_schema(self.schema, chunk_schema)
+        if self._writer is None and self._sink is None:
+            self.schema = schema
+            self._open()
+        elif not schema.equals(self.schema):
+            logging.info('Widening schema of {} to {}'.format(self.save_loc, schema))
+            self._start_segment(schema)
+        chunk, _ = conform_to_schema(df, self.schema)
+        self._write_frame(chunk)
+        self.n_rows += len(chunk)
+
+    def close(self):
+        self._close_writer()
+        if self._segments:
+            self._start_segment(self.schema)  # the chunks written since the schema last changed
+            segments, self._segments = self._segments, []
+            for segment_loc in segments:
+                self._copy_segment(segment_loc)
+                os.remove(segment_loc)
+            self._close_writer()
+
+    def _close_writer(self):
+        if self._writer is not None:
+            self._writer.close()
+        if self._sink is not None:
+            self._sink.close()
+        self._writer = None
+        self._sink = None
+
+    def _start_segment(self, schema):
+        # keep what is written so far aside, and carry on with the new schema
+        self._close_writer()
+        segment_loc = '{}.segment-{:04d}.tmp'.format(self.save_loc, len(self._segments))
+        os.replace(self.save_loc, segment_loc)
+        self._segments.append(segment_loc)
+        self.schema = schema
+        self._open()
+
+    def _copy_segment(self, segment_loc):
+        # append segment, converted to the (final) schema, one batch at a time
+        if self.file_format == 'csv':
+            # as text, so values are written back exactly as they were
+            for chunk in pd.read_csv(segment_loc, chunksize=100000, dtype=str, keep_default_na=False):
+                self._write_frame(chunk.reindex(columns=self.schema.names))
+            return
+        with pa.memory_map(segment_loc, 'r') as f:
+            if self.file_format == 'parquet':
+                batches = pq.ParquetFile(f).iter_batches()
+            else:
+                reader = pa.ipc.open_file(f)
+                batches = (reader.get_batch(n) for n in range(reader.num_record_batches))
+            for batch in batches:
+                self._writer.write_table(conform_table(pa.Table.from_batches([batch]), self.schema))
+
+    def _write_frame(self, chunk):
+        if self.file_format == 'csv':
+            chunk.to_csv(self._sink, header=not self._header_written, index=False)
+            self._header_written = True
+        else:
+            self._writer.write_table(pa.Table.from_pandas(chunk, schema=self.schema, preserve_index=False))
+
+    def _open(self):
+        self._header_written = False
+        if self.file_format == 'parquet':
+            self._writer = pq.ParquetWriter(self.save_loc, self.schema)
+        elif self.file_format == 'feather':
+            # Feather (v2) is the Arrow IPC file format, which can be written batch by batch
+            self._sink = pa.OSFile(self.save_loc, 'wb')
+            self._writer = pa.ipc.new_file(self._sink, self.schema)
+        elif self.file_format == 'csv':
+            self._sink = open(self.save_loc, 'w', newline='')
+        else:
+            raise ValueError('Unknown table format {}'.format(self.file_format))
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
@@ -0,0 +1,368 @@
+"""
+In-memory stand-in for the Panoptes API, for exercising and benchmarking uploads offline.
+
+    backend = FakePanoptesBackend(latency=0.05, error_rate=0.01, max_requests_per_second=50)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects('my_subject_set', manifest, max_in_flight=8)
+    print(backend.summary())
+
+Within backend.patch(), upload_utils and subject_utils use fake Panoptes, Project, SubjectSet and Subject classes
+that implement the (small) part of the panoptes_client API those modules use. Every fake API request sleeps for
+the configured latency, and may fail with a 503 (error_rate) or a 429 (when over max_requests_per_second, or on every
+throttle_every-th request), raised as a real PanoptesAPIException so that retry logic behaves as it would against
+the live API.
+"""
+import collections
+import contextlib
+import itertools
+import random
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from panoptes_client import panoptes
+from panoptes_client.subject import UPLOAD_RETRY_LIMIT
+from redo import retry
+
+from shared_astro_utils import subject_utils, upload_utils
+
+
+class FakePanoptesBackend():
+    """
+    Stores projects, subject sets, subjects and links in memory, and simulates the latency and failures of the API.
+    Safe to use from many threads.
+    """
+
+    def __init__(
+            self,
+            latency=0.,
+            latency_jitter=0.,
+            error_rate=0.,
+            max_requests_per_second=None,
+            throttle_every=None,
+            async_save_threads=5,
+            save_retry_interval=0.,
+            seed=None):
+        """
+        Args:
+            latency (float): seconds each request takes
+            latency_jitter (float): each request takes up to this many extra seconds, uniformly at random
+            error_rate (float): probability that each request fails with HTTP 503
+            max_requests_per_second (float): requests beyond this many in any one second fail with HTTP 429.
+                Only accepted requests count towards the limit.
+                If None, never throttle by time.
+            throttle_every (int): every throttle_every-th request (counting all requests) fails with HTTP 429,
+                whatever the timing, for deterministic tests. If None, never throttle by count.
+            async_save_threads (int): threads used by Subject.async_saves, as panoptes_client.subject.ASYNC_SAVE_THREADS
+            save_retry_interval (float): seconds between the retries Subject.save makes internally on error,
+                as panoptes_client.subject.RETRY_BACKOFF_INTERVAL
+            seed (int): random seed for latency jitter and errors
+        """
+        self.latency = latency
+        self.latency_jitter = latency_jitter
+        self.error_rate = error_rate
+        self.max_requests_per_second = max_requests_per_second
+        self.throttle_every = throttle_every
+        self.async_save_threads = async_save_threads
+        self.save_retry_interval = save_retry_interval
+        self._random = random.Random(seed)
+        self._lock = threading.Lock()
+        self._ids = itertools.count(1)
+        self._recent_requests = collections.deque()  # times of requests in the last second
+        self._n_requests = 0  # all requests, accepted or not
+
+        self.projects = {}  # of form {project_id: FakeProject}
+        self.subject_sets = {}  # of form {subject_set_id: FakeSubjectSet}
+        self.subjects = {}  # of form {subject_id: FakeSubject}
+        self.links = collections.defaultdict(list)  # of form {subject_set_id: [subject_id, ...]}
+        self.requests = collections.Counter()  # successful requests, by kind
+        self.errors = collections.Counter()  # failed requests, by HTTP status
+        self.internal_retries = 0  # retries made by Subject.save itself, after a failed request
+        self.link_races = 0  # number of times one subject set was linked to by two requests at once
+        self._links_in_progress = collections.Counter()
+
+    def request(self, kind):
+        """
+        Simulate one API request: wait for the latency, then maybe fail
+
+        Args:
+            kind (str): name of request, for counting e.g. 'subject_save'
+        """
+        with self._lock:
+            delay = self.latency + self._random.uniform(0., self.latency_jitter)
+            fails = self._random.random() < self.error_rate
+            self._n_requests += 1
+            throttled = self._is_throttled() or (
+                self.throttle_every is not None and self._n_requests % self.throttle_every == 0)
+        time.sleep(delay)
+        if throttled:
+            self._fail(429)
+        if fails:
+            self._fail(503)
+        with self._lock:
+            self.requests[kind] += 1
+
+    def new_id(self):
+        return str(next(self._ids))
+
+    def find_project(self, project_id):
+        with self._lock:
+            if str(project_id) not in self.projects:
+                self.projects[str(project_id)] = FakeProject(project_id)
+            return self.projects[str(project_id)]
+
+    def add_links(self, subject_set_id, subject_ids):
+        with self._lock:
+            if self._links_in_progress[subject_set_id] > 0:
+                self.link_races += 1
+            self._links_in_progress[subject_set_id] += 1
+        try:
+            self.request('subject_set_add')
+            with self._lock:
+                for subject_id in subject_ids:
+                    if subject_id not in self.subjects:
+                        raise panoptes.PanoptesAPIException('Could not find subject with id {}'.format(subject_id))
+                    if subject_id not in self.links[subject_set_id]:
+                        self.links[subject_set_id].append(subject_id)
+        finally:
+            with self._lock:
+                self._links_in_progress[subject_set_id] -= 1
+
+    def duplicate_subjects(self):
+        """
+        Returns:
+            (int) number of subjects saved more than once (by !filename)
+        """
+        filenames = collections.Counter(subject.metadata.get('!filename') for subject in self.subjects.values())
+        return sum(count - 1 for count in filenames.values() if count > 1)
+
+    def summary(self):
+        return {
+            'subjects': len(self.subjects),
+            'linked': sum(len(subject_ids) for subject_ids in self.links.values()),
+            'duplicate_subjects': self.duplicate_subjects(),
+            'link_races': self.link_races,
+            'requests': dict(self.requests),
+            'errors': dict(self.errors),
+            'internal_retries': self.internal_retries
+        }
+
+    @contextlib.contextmanager
+    def patch(self):
+        """
+        Make upload_utils and subject_utils use this backend, instead of the live API, within the context.
+        The Panoptes session and subject set cache are reset on entry and exit.
+        """
+        fakes = {
+            'Panoptes': _bind(FakePanoptes, self),
+            'Project': _bind(FakeProject, self),
+            'SubjectSet': _bind(FakeSubjectSet, self),
+            'Subject': _bind(FakeSubject, self)
+        }
+        originals = {}
+        for module in [upload_utils, subject_utils]:
+            for name, fake in fakes.items():
+                originals[(module, name)] = getattr(module, name)
+                setattr(module, name, fake)
+        originals[(subject_utils, '_connect')] = subject_utils._connect
+        subject_utils._connect = _fake_connect(fakes['Panoptes'])
+        _reset_subject_utils()
+        try:
+            yield self
+        finally:
+            for (module, name), original in originals.items():
+                setattr(module, name, original)
+            _reset_subject_utils()
+
+    def _is_throttled(self):
+        # must hold self._lock
+        if self.max_requests_per_second is None:
+            return False
+        now = time.monotonic()
+        while self._recent_requests and now - self._recent_requests[0] > 1.:
+            self._recent_requests.popleft()
+        if len(self._recent_requests) >= self.max_requests_per_second:
+            return True
+        self._recent_requests.append(now)  # only accepted requests count towards the limit
+        return False
+
+    def _fail(self, status):
+        with self._lock:
+            self.errors[status] += 1
+        raise panoptes.PanoptesAPIException('Received HTTP status code {} from API'.format(status))
+
+
+class FakePanoptes():
+    _backend = None
+    _local = threading.local()
+
+    def __init__(self, username=None, password=None, **kwargs):
+        self.username = username
+        self.logged_in = False
+        self.bearer_token = None
+
+    @classmethod
+    def connect(cls, *args, **kwargs):
+        cls._local.panoptes_client = cls(*args, **kwargs)
+        cls._local.panoptes_client.login()
+        return cls._local.panoptes_client
+
+    @classmethod
+    def client(cls, *args, **kwargs):
+        local_client = getattr(cls._local, 'panoptes_client', None)
+        if not local_client:
+            return cls(*args, **kwargs)
+        return local_client
+
+    def login(self):
+        self._backend.request('login')
+        self.logged_in = True
+        self.bearer_token = 'fake_token'
+        return True
+
+    def valid_bearer_token(self):
+        return self.bearer_token is not None
+
+    def get_bearer_token(self):
+        return self.bearer_token
+
+    def __enter__(self):
+        self._local.previous_client = getattr(self._local, 'panoptes_client', None)
+        self._local.panoptes_client = self
+        return self
+
+    def __exit__(self, *exc):
+        self._local.panoptes_client = self._local.previous_client
+
+
+class FakeProject():
+    _backend = None
+
+    def __init__(self, project_id):
+        self.id = str(project_id)
+
+    @classmethod
+    def find(cls, project_id):
+        cls._backend.request('project_find')
+        return cls._backend.find_project(project_id)
+
+
+class FakeLinks():
+
+    def __init__(self):
+        self.project = None
+
+
+class FakeSubjectSet():
+    _backend = None
+
+    def __init__(self):
+        self.id = None
+        self.display_name = None
+        self.links = FakeLinks()
+
+    @classmethod
+    def where(cls, project_id, display_name):
+        cls._backend.request('subject_set_query')
+        return iter([
+            subject_set for subject_set in list(cls._backend.subject_sets.values())
+            if subject_set.links.project.id == str(project_id) and subject_set.display_name == display_name
+        ])
+
+    def save(self):
+        if self.id is None:
+            self._backend.request('subject_set_create')
+            self.id = self._backend.new_id()
+            self._backend.subject_sets[self.id] = self
+
+    def add(self, objs):
+        if not isinstance(objs, (list, tuple)):
+            objs = [objs]
+        subject_ids = [str(obj.id) if isinstance(obj, FakeSubject) else str(obj) for obj in objs]
+        self._backend.add_links(self.id, subject_ids)
+
+
+class FakeSubject():
+    _backend = None
+    _local = threading.local()
+
+    def __init__(self):
+        self.id = None
+        self.locations = []
+        self.metadata = {}
+        self.links = FakeLinks()
+
+    @classmethod
+    def async_saves(cls):
+        # like Subject.async_saves, saves within the context happen in a thread pool, which is joined on exit
+        cls._local.save_exec = ThreadPoolExecutor(max_workers=cls._backend.async_save_threads)
+        return cls._local.save_exec
+
+    def add_location(self, location):
+        with open(location, 'rb') as f:  # like Subject.add_location, read the media now
+            self.locations.append(len(f.read()))
+
+    def save(self, client=None):
+        save_exec = getattr(self._local, 'save_exec', None)
+        if save_exec is not None:
+            try:
+                self._async_future = save_exec.submit(self._save)
+                return
+            except RuntimeError:  # pool already shut down i.e. outside the async_saves context
+                del self._local.save_exec
+        self._save()
+
+    def _save(self):
+        self._request_with_retries('subject_save')
+        self.id = self._backend.new_id()
+        self._backend.subjects[self.id] = self
+        for _ in self.locations:
+            self._request_with_retries('media_upload')
+
+    def _request_with_retries(self, kind):
+        # like Subject.save, retry failed requests internally before giving up
+        attempts = itertools.count()
+
+        def request():
+            if next(attempts) > 0:
+                with self._backend._lock:
+                    self._backend.internal_retries += 1
+            self._backend.request(kind)
+
+        retry(
+            request,
+            attempts=UPLOAD_RETRY_LIMIT,
+            sleeptime=self._backend.save_retry_interval,
+            jitter=0,
+            retry_exceptions=(panoptes.PanoptesAPIException,),
+            log_args=False)
+
+    @property
+    def async_save_result(self):
+        future = getattr(self, '_async_future', None)
+        if future is not None and future.done():
+            future.result()
+            return True
+        return False
+
+
+def _bind(fake_class, backend):
+    # a subclass per backend, so that concurrent backends (and their thread-local state) don't interfere
+    return type(fake_class.__name__, (fake_class,), {'_backend': backend, '_local': threading.local()})
+
+
+def _fake_connect(fake_panoptes):
+    # replaces subject_utils._connect: log in to the fake backend rather than reading credentials from disk
+    def connect(login_loc):
+        with subject_utils.time_utils.TIMINGS.timed('panoptes_auth'):
+            client = fake_panoptes.connect(username='fake_user', password='fake_password')
+        subject_utils._session['client'] = client
+        subject_utils._session['login_loc'] = login_loc
+        return client
+    return connect
+
+
+def _reset_subject_utils():
+    subject_utils._session['client'] = None
+    subject_utils._session['login_loc'] = None
+    subject_utils.clear_subject_set_cache()
@@ -1,20 +1,360 @@
+import hashlib
+import itertools
+import logging
+import os
+import sqlite3
+from concurrent.futures import ProcessPoolExecutor
 
 import numpy as np
 from astropy.io import fits
 
 
-def fits_are_identical(fits_a_loc, fits_b_loc):
+BLOCK_PIXELS = 2 ** 20  # pixels compared at once, per image
+FITS_EXTENSIONS = ('.fits', '.fits.gz', '.fit', '.fts')
+
+
+def fits_are_identical(fits_a_loc, fits_b_loc, block_pixels=BLOCK_PIXELS):
     """
     Given the location of two fits files, do they have identical pixels?
+    Pixels are compared block by block from memory-mapped files, stopping at the first difference, so memory use
+    doesn't grow with image size.
+
+    Images must have the same shape, and NaNs in the same positions. Previously, NaN pixels were removed from each
+    image and only the remaining pixels compared (in order), so images with NaNs in different places could match.
 
     Args:
         fits_a_loc (str): location of one fits file
         fits_b_loc (str): location of other fits file
+        block_pixels (int): number of pixels from each file to compare at once
+
+    Returns:
+        (bool) True if both fits files have identical pixels (including shape and NaN positions), else False
+    """
+    for loc in [fits_a_loc, fits_b_loc]:
+        if not os.path.isfile(loc):
+            raise FileNotFoundError('Cannot compare fits files: {} does not exist'.format(loc))
+    if os.path.samefile(fits_a_loc, fits_b_loc):
+        return True
+    # astropy can only memory-map unscaled pixels, so read the raw pixels and scale each block in _iter_blocks
+    with fits.open(fits_a_loc, memmap=True, do_not_scale_image_data=True) as hdul_a, \
+            fits.open(fits_b_loc, memmap=True, do_not_scale_image_data=True) as hdul_b:
+        # linter error: this is the correct access method for data in 0th fits HDU
+        hdu_a, hdu_b = hdul_a[0], hdul_b[0]
+        shape = _image_shape(hdu_a.header)
+        if shape != _image_shape(hdu_b.header):  # from the headers, without reading any pixels
+            return False
+        if not shape:
+            return True  # neither has pixels
+        return all(
+            np.allclose(block_a, block_b, equal_nan=True)
+            for block_a, block_b in zip(_iter_blocks(hdu_a, block_pixels), _iter_blocks(hdu_b, block_pixels))
+        )
+
+
+def fits_pairs_are_identical(pairs, block_pixels=BLOCK_PIXELS, max_workers=None):
+    """
+    Check if many pairs of fits files have identical pixels, in a pool of processes.
+
+    Args:
+        pairs (list): of (fits_a_loc, fits_b_loc) tuples
+        block_pixels (int): number of pixels from each file to compare at once
+        max_workers (int): number of processes comparing pairs at once. If None, one per CPU.
 
     Returns:
-        (bool) True if both fits files have identical pixels (including shape), else False
+        (list) of bools, True where that pair has identical pixels (see fits_are_identical)
+    """
+    if not pairs:
+        return []
+    fits_a_locs, fits_b_locs = zip(*pairs)
+    # a few chunks of pairs per process, so processes aren't idle waiting for the next pair
+    chunksize = max(1, len(pairs) // (4 * (max_workers or os.cpu_count())))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        return list(executor.map(
+            fits_are_identical, fits_a_locs, fits_b_locs, [block_pixels] * len(pairs), chunksize=chunksize))
+
+
+def fits_dirs_are_identical(dir_a, dir_b, block_pixels=BLOCK_PIXELS, max_workers=None):
     """
-    # linter error: this is the correct access method for data in 0th fits HDU
-    pixels_a = fits.open(fits_a_loc)[0].data
-    pixels_b = fits.open(fits_b_loc)[0].data
-    return np.allclose(pixels_a[~np.isnan(pixels_a)], pixels_b[~np.isnan(pixels_b)])
+    Check if each fits file in one directory has identical pixels to the file of the same name in another directory.
+
+    Args:
+        dir_a (str): directory of fits files
+        dir_b (str): directory of fits files to compare against
+        block_pixels (int): number of pixels from each file to compare at once
+        max_workers (int): number of processes comparing pairs at once. If None, one per CPU.
+
+    Returns:
+        (dict) of form {file name: True if identical, else False}, for every fits file in either directory.
+            Files only in one directory are not identical.
+    """
+    names_a = set(_fits_names(dir_a))
+    names_b = set(_fits_names(dir_b))
+    shared = sorted(names_a & names_b)
+    identical = dict.fromkeys(names_a ^ names_b, False)
+    pairs = [(os.path.join(dir_a, name), os.path.join(dir_b, name)) for name in shared]
+    identical.update(zip(shared, fits_pairs_are_identical(pairs, block_pixels, max_workers)))
+    return dict(sorted(identical.items()))
+
+
+def fits_content_hash(fits_loc, block_pixels=BLOCK_PIXELS):
+    """
+    Hash the pixels of a fits file, so that files with identical pixels have identical hashes.
+    Pixels are hashed by value (as float64), so the same values stored as different types or with different scaling
+    hash the same, and all NaNs (and both zeros) hash the same. Unlike fits_are_identical, values must match exactly.
+
+    Args:
+        fits_loc (str): location of fits file
+        block_pixels (int): number of pixels to hash at once
+
+    Returns:
+        (str) hex digest of pixels (including shape)
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    with fits.open(fits_loc, memmap=True, do_not_scale_image_data=True) as hdul:
+        hdu = hdul[0]
+        shape = _image_shape(hdu.header)
+        digest.update(repr(shape).encode())
+        if shape:
+            for block in _iter_blocks(hdu, block_pixels):
+                values = block.astype('<f8')
+                values[np.isnan(values)] = np.nan  # one NaN bit pattern
+                values += 0.  # -0. to 0.
+                digest.update(values.tobytes())
+    return digest.hexdigest()
+
+
+class FitsHashIndex():
+    """
+    On-disk (SQLite) index of the pixel content hash (see fits_content_hash) of every fits file under some directories.
+    Finds groups of identical images in one pass, rather than comparing every pair of files.
+
+    Files are keyed by path, modification time and size, so updating the index only re-hashes new or changed files.
+    Files are walked, looked up and written in chunks, so memory use doesn't grow with the number of files.
+    """
+
+    def __init__(self, index_loc):
+        """
+        Args:
+            index_loc (str): location of SQLite index file. Created if it does not exist.
+        """
+        self.index_loc = index_loc
+        self._connection = sqlite3.connect(index_loc)
+        self._connection.execute('PRAGMA journal_mode=WAL')  # cheap commits, and readable while writing
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS files ('
+            'path TEXT PRIMARY KEY, mtime_ns INTEGER NOT NULL, size INTEGER NOT NULL, hash TEXT, scan INTEGER NOT NULL)'
+        )
+        self._connection.execute('CREATE INDEX IF NOT EXISTS files_hash ON files (hash)')
+        self._connection.commit()
+
+    def __len__(self):
+        return self._connection.execute('SELECT COUNT(*) FROM files').fetchone()[0]
+
+    def update(self, directory, max_workers=None, chunk_size=10000, block_pixels=BLOCK_PIXELS):
+        """
+        Hash every new or changed fits file under directory (recursively), in a pool of processes,
+        and forget indexed files under directory that no longer exist.
+        Files that can't be read are recorded without a hash (and so never duplicates) until they change.
+
+        Args:
+            directory (str): directory to index
+            max_workers (int): number of processes hashing files at once. If None, one per CPU.
+            chunk_size (int): number of files to look up, hash and write at once
+            block_pixels (int): number of pixels to hash at once, per process
+
+        Returns:
+            (dict) of form {'files': files found, 'hashed': files (re)hashed, 'removed': files forgotten}
+        """
+        directory = os.path.abspath(directory)
+        scan = self._connection.execute('SELECT COALESCE(MAX(scan), 0) + 1 FROM files').fetchone()[0]
+        report = {'files': 0, 'hashed': 0, 'removed': 0}
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            # a few chunks of files per process, so processes aren't idle waiting for the next file
+            map_chunksize = max(1, chunk_size // (4 * (max_workers or os.cpu_count())))
+            files = _iter_fits_files(directory)
+            for chunk in iter(lambda: list(itertools.islice(files, chunk_size)), []):
+                indexed = self._indexed(path for path, _, _ in chunk)
+                changed = [(path, mtime_ns, size) for path, mtime_ns, size in chunk if indexed.get(path) != (mtime_ns, size)]
+                hashes = executor.map(
+                    _hash_or_none, [path for path, _, _ in changed], [block_pixels] * len(changed), chunksize=map_chunksize)
+                with self._connection:
+                    self._connection.executemany(
+                        'UPDATE files SET scan = ? WHERE path = ?', [(scan, path) for path, _, _ in chunk])
+                    self._connection.executemany(
+                        'INSERT OR REPLACE INTO files (path, mtime_ns, size, hash, scan) VALUES (?, ?, ?, ?, ?)',
+                        [(path, mtime_ns, size, file_hash, scan) for (path, mtime_ns, size), file_hash in zip(changed, hashes)])
+                report['files'] += len(chunk)
+                report['hashed'] += len(changed)
+        with self._connection:
+            prefix = os.path.join(directory, '')
+            report['removed'] = self._connection.execute(
+                'DELETE FROM files WHERE substr(path, 1, ?) = ? AND scan != ?', (len(prefix), prefix, scan)).rowcount
+        logging.info('Indexed {} fits files under {}: {} hashed, {} removed'.format(
+            report['files'], directory, report['hashed'], report['removed']))
+        return report
+
+    def file_hash(self, path):
+        """
+        Args:
+            path (str): location of indexed fits file
+
+        Returns:
+            (str) content hash of file when last indexed, or None if not indexed (or not readable)
+        """
+        row = self._connection.execute('SELECT hash FROM files WHERE path = ?', (os.path.abspath(path),)).fetchone()
+        return row[0] if row else None
+
+    def iter_duplicate_groups(self):
+        """
+        Yield each group of indexed files with identical pixels, one group at a time
+
+        Yields:
+            (list) of paths (at least two, sorted) of files with identical pixels
+        """
+        rows = self._connection.execute(
+            'SELECT hash, path FROM files WHERE hash IN '
+            '(SELECT hash FROM files WHERE hash IS NOT NULL GROUP BY hash HAVING COUNT(*) > 1) '
+            'ORDER BY hash, path')
+        for _, group in itertools.groupby(rows, key=lambda row: row[0]):
+            yield [path for _, path in group]
+
+    def duplicate_groups(self):
+        """
+        Returns:
+            (list) of groups (see iter_duplicate_groups) of indexed files with identical pixels
+        """
+        return list(self.iter_duplicate_groups())
+
+    def _indexed(self, paths):
+        paths = list(paths)
+        indexed = {}
+        for start in range(0, len(paths), 500):  # below SQLite's limit on query parameters
+            batch = paths[start:start + 500]
+            rows = self._connection.execute(
+                'SELECT path, mtime_ns, size FROM files WHERE path IN ({})'.format(','.join('?' * len(batch))), batch)
+            indexed.update((path, (mtime_ns, size)) for path, mtime_ns, size in rows)
+        return indexed
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def load_fits_cube(fits_locs, cube_loc, crop_size=None, dtype=np.float32, max_workers=None, chunk_size=1000):
+    """
+    Load the pixels of many fits images (e.g. catalog['file_loc']) into one (n, x, y, channel) array on disk,
+    as expected by plotting_utils.plot_galaxy_grid and ML pipelines, decoding images in a pool of processes.
+    The array is a .npy file, written in place by each process, so it may be much larger than memory.
+
+    Images are (x, y) or (channel, x, y) in fits (numpy) order, and must all be the same shape.
+    Channels are moved last, and (x, y) images given one channel.
+
+    Args:
+        fits_locs (list): locations of fits files, in the order to load them
+        cube_loc (str): location to save .npy array. Only written (replacing any existing file) once every image loads.
+        crop_size (int): if not None, keep only the central crop_size by crop_size pixels of each image
+        dtype (np.dtype): dtype to save pixels as e.g. np.float16 to halve the size on disk. Cast as numpy does.
+        max_workers (int): number of processes loading images at once. If None, one per CPU.
+        chunk_size (int): number of images each process loads before moving on to the next chunk
+
+    Returns:
+        (np.memmap) read-only (n, x, y, channel) array of pixels, memory-mapped from cube_loc
+    """
+    fits_locs = list(fits_locs)
+    if not fits_locs:
+        raise ValueError('No fits files to load')
+    with fits.open(fits_locs[0]) as hdul:
+        image_shape = _cube_image_shape(_image_shape(hdul[0].header), crop_size)
+    temp_loc = cube_loc + '.tmp.npy'  # np.save would add .npy to anything else
+    cube = np.lib.format.open_memmap(temp_loc, mode='w+', dtype=dtype, shape=(len(fits_locs),) + image_shape)
+    del cube  # each process opens (and writes) its own memory map
+    starts = range(0, len(fits_locs), chunk_size)
+    try:
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            list(executor.map(
+                _load_fits_chunk,
+                [temp_loc] * len(starts),
+                starts,
+                [fits_locs[start:start + chunk_size] for start in starts],
+                [crop_size] * len(starts)
+            ))
+    except BaseException:
+        os.remove(temp_loc)
+        raise
+    os.replace(temp_loc, cube_loc)
+    return np.load(cube_loc, mmap_mode='r')
+
+
+def _cube_image_shape(shape, crop_size):
+    # (channel, x, y) or (x, y) fits image shape to (x, y, channel) cube image shape
+    if len(shape) not in (2, 3):
+        raise ValueError('Expected (x, y) or (channel, x, y) image, not shape {}'.format(shape))
+    x, y = shape[-2:]
+    if crop_size is not None:
+        if crop_size > min(x, y):
+            raise ValueError('Cannot crop {} image to {} pixels'.format(shape, crop_size))
+        x, y = crop_size, crop_size
+    return (x, y, shape[0] if len(shape) == 3 else 1)
+
+
+def _load_fits_chunk(cube_loc, start, fits_locs, crop_size):
+    cube = np.load(cube_loc, mmap_mode='r+')
+    for n, fits_loc in enumerate(fits_locs):
+        with fits.open(fits_loc, memmap=True) as hdul:
+            header = hdul[0].header
+            shape = _image_shape(header)
+            if _cube_image_shape(shape, crop_size) != cube.shape[1:]:
+                raise ValueError('{} has shape {}, unlike the first image'.format(fits_loc, shape))
+            pixels = hdul[0].data
+            if crop_size is not None:
+                x_start, y_start = (shape[-2] - crop_size) // 2, (shape[-1] - crop_size) // 2
+                pixels = pixels[..., x_start:x_start + crop_size, y_start:y_start + crop_size]
+            cube[start + n] = np.moveaxis(pixels, 0, -1) if pixels.ndim == 3 else pixels[:, :, np.newaxis]
+            del pixels
+    cube.flush()
+
+
+def _image_shape(header):
+    return tuple(header['NAXIS{}'.format(n)] for n in range(header['NAXIS'], 0, -1))
+
+
+def _iter_blocks(hdu, block_pixels):
+    # yield the (scaled) pixels as flat blocks, reading only each block from disk
+    bscale, bzero, blank = hdu.header.get('BSCALE', 1), hdu.header.get('BZERO', 0), hdu.header.get('BLANK')
+    pixels = hdu.data.reshape(-1)  # view of the memory map
+    for start in range(0, len(pixels), block_pixels):
+        block = pixels[start:start + block_pixels]
+        if bscale != 1 or bzero != 0 or blank is not None:
+            scaled = block * np.float64(bscale) + bzero  # as astropy, which scales to float
+            if blank is not None and block.dtype.kind in 'iu':
+                scaled[block == blank] = np.nan
+            block = scaled
+        yield block
+
+
+def _fits_names(directory):
+    return [name for name in os.listdir(directory) if name.lower().endswith(FITS_EXTENSIONS)]
+
+
+def _iter_fits_files(directory):
+    # yield (path, mtime_ns, size) of every fits file under directory, using the stats from scanning the directory
+    with os.scandir(directory) as entries:
+        for entry in entries:
+            if entry.is_dir(follow_symlinks=False):
+                yield from _iter_fits_files(entry.path)
+            elif entry.name.lower().endswith(FITS_EXTENSIONS) and entry.is_file():
+                stat = entry.stat()
+                yield entry.path, stat.st_mtime_ns, stat.st_size
+
+
+def _hash_or_none(fits_loc, block_pixels):
+    try:
+        return fits_content_hash(fits_loc, block_pixels)
+    except (OSError, ValueError, KeyError) as e:  # e.g. truncated, not fits, or no NAXIS
+        logging.warning('Could not hash {}: {}'.format(fits_loc, e))
+        return None
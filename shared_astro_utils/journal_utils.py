@@ -0,0 +1,184 @@
+import logging
+import sqlite3
+import threading
+
+from shared_astro_utils import rate_limit_utils
+
+
+class UploadJournal():
+    """
+    On-disk (SQLite) record of which manifest entries have been saved as subjects, and which have been linked.
+    Lets an interrupted upload restart without re-uploading (and so duplicating) anything already saved.
+
+    Each journal is scoped to one subject set. Several subject sets may share one journal file.
+    The subject set's rows are read into memory when the journal is opened, so lookups are O(1) dict lookups
+    and never touch the database. Writes go to both, and are committed immediately.
+    Safe to share between threads.
+    """
+
+    def __init__(self, journal_loc, subject_set_name):
+        """
+        Args:
+            journal_loc (str): location of SQLite journal file. Created if it does not exist.
+            subject_set_name (str): name of subject set being uploaded to
+        """
+        self.journal_loc = journal_loc
+        self.subject_set_name = subject_set_name
+        self._lock = threading.Lock()
+        self._connection = sqlite3.connect(journal_loc, check_same_thread=False)
+        self._connection.execute('PRAGMA journal_mode=WAL')  # cheap commits, and readable while writing
+        self._connection.execute(
+            'CREATE TABLE IF NOT EXISTS subjects ('
+            'subject_set TEXT NOT NULL, key TEXT NOT NULL, subject_id TEXT NOT NULL, linked INTEGER NOT NULL, '
+            'PRIMARY KEY (subject_set, key))'
+        )
+        self._connection.commit()
+        rows = self._connection.execute(
+            'SELECT key, subject_id, linked FROM subjects WHERE subject_set = ?', (subject_set_name,))
+        self._status = {key: (subject_id, bool(linked)) for key, subject_id, linked in rows}
+        logging.info('Journal {} has {} subjects for {}'.format(journal_loc, len(self._status), subject_set_name))
+
+    def __len__(self):
+        return len(self._status)
+
+    def __contains__(self, key):
+        return key in self._status
+
+    def subject_id(self, key):
+        """
+        Args:
+            key (str): manifest entry key, from manifest_entry_key
+
+        Returns:
+            (str) id of subject saved for key, or None if not yet saved
+        """
+        try:
+            return self._status[key][0]
+        except KeyError:
+            return None
+
+    def is_linked(self, key):
+        """
+        Args:
+            key (str): manifest entry key, from manifest_entry_key
+
+        Returns:
+            (bool) True if the subject for key has been saved and linked to the subject set
+        """
+        return self._status.get(key, (None, False))[1]
+
+    def unlinked_subject_ids(self):
+        """
+        Returns:
+            (dict) of form {key: subject_id} for subjects saved but not yet linked to the subject set
+        """
+        return {key: subject_id for key, (subject_id, linked) in self._status.items() if not linked}
+
+    def record_saved(self, key, subject_id):
+        """
+        Record that the subject for key has been saved (but not linked)
+
+        Args:
+            key (str): manifest entry key, from manifest_entry_key
+            subject_id (str): id of saved subject
+        """
+        self.record_many_saved([(key, subject_id)])
+
+    def record_many_saved(self, saved):
+        """
+        Record that many subjects have been saved (but not linked), in one transaction
+
+        Args:
+            saved (list): of form [(key, subject_id), ...]
+        """
+        saved = [(key, str(subject_id)) for key, subject_id in saved]
+        with self._lock:
+            self._connection.executemany(
+                'INSERT OR REPLACE INTO subjects (subject_set, key, subject_id, linked) VALUES (?, ?, ?, 0)',
+                [(self.subject_set_name, key, subject_id) for key, subject_id in saved])
+            self._connection.commit()
+            for key, subject_id in saved:
+                self._status[key] = (subject_id, False)
+
+    def record_linked(self, keys):
+        """
+        Record that the (already saved) subjects for keys have been linked to the subject set, in one transaction
+
+        Args:
+            keys (list): manifest entry keys, from manifest_entry_key
+        """
+        keys = list(keys)
+        with self._lock:
+            self._connection.executemany(
+                'UPDATE subjects SET linked = 1 WHERE subject_set = ? AND key = ?',
+                [(self.subject_set_name, key) for key in keys])
+            self._connection.commit()
+            for key in keys:
+                self._status[key] = (self._status[key][0], True)
+
+    def close(self):
+        self._connection.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+def manifest_entry_key(metadata):
+    """
+    Get the key identifying a manifest entry in an UploadJournal: the entry's !filename, or its iauname if it has none
+
+    Args:
+        metadata (dict): metadata of manifest entry, as uploaded to Panoptes
+
+    Returns:
+        (str) unique key for manifest entry
+    """
+    for key_col in ['!filename', '!iauname', 'iauname']:
+        if key_col in metadata:
+            return str(metadata[key_col])
+    raise KeyError('Manifest entry metadata has no !filename or iauname to journal by: {}'.format(metadata))
+
+
+def skip_saved_entries(manifest, journal, pbar=None):
+    """
+    Lazily filter out manifest entries whose subjects the journal records as already saved
+
+    Args:
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        journal (UploadJournal): journal of previous uploads to the same subject set
+        pbar (tqdm.tqdm): progress bar to update for each skipped entry. If None, no bar will display.
+
+    Yields:
+        (dict) manifest entries not yet saved
+    """
+    n_skipped = 0
+    for manifest_entry in manifest:
+        if manifest_entry_key(manifest_entry['metadata']) in journal:
+            n_skipped += 1
+            if pbar is not None:
+                pbar.update()
+        else:
+            yield manifest_entry
+    logging.info('Skipped {} manifest entries already saved according to journal'.format(n_skipped))
+
+
+def link_unlinked_subjects(journal, subject_set):
+    """
+    Link any subjects the journal records as saved but not linked (e.g. after a crash mid-upload)
+
+    Args:
+        journal (UploadJournal): journal of previous uploads to subject_set
+        subject_set (panoptes_client.SubjectSet): subject set to link to
+
+    Returns:
+        (int) number of subjects linked
+    """
+    unlinked = journal.unlinked_subject_ids()
+    if unlinked:
+        logging.info('Linking {} subjects saved but not linked according to journal'.format(len(unlinked)))
+        rate_limit_utils.panoptes_write(subject_set.add, list(unlinked.values()))
+        journal.record_linked(unlinked.keys())
+    return len(unlinked)
@@ -1,10 +1,25 @@
 
+import hashlib
+import json
+import logging
+import os
+import tempfile
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
+import scipy
+import scipy.sparse
+import scipy.sparse.csgraph
+from scipy.spatial import cKDTree
 from astropy import table
-from astropy.coordinates import SkyCoord
+from astropy.coordinates import SkyCoord, Angle
 from astropy import units
 
+from shared_astro_utils import columnar_utils
+
 
 def match_galaxies_to_catalog_table(
     galaxies, 
@@ -12,15 +27,32 @@ def match_galaxies_to_catalog_table(
     matching_radius=10 * units.arcsec,
     join_type='inner',
     galaxy_suffix='_subject', 
-    catalog_suffix=''):
+    catalog_suffix='',
+    catalog_index=None,
+    match_cache=None):
+    """
+    Match each galaxy to the nearest catalog galaxy within matching_radius, and join
 
-    galaxies_coord = SkyCoord(ra=galaxies['ra'], dec=galaxies['dec'], unit=units.deg)
-    catalog_coord = SkyCoord(ra=catalog['ra'], dec=catalog['dec'], unit=units.deg)
+    Args:
+        galaxies (astropy.table.Table): galaxies to match, with ra and dec columns (in degrees, if no units)
+        catalog (astropy.table.Table): catalog to match to, with ra and dec columns (in degrees, if no units)
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        join_type (str): join type for astropy.table.join e.g. 'inner', 'right'
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        catalog_index (CatalogIndex): if not None, index built from catalog, to match against without building a new
+            tree. Must have been built from the same catalog, in the same order.
+        match_cache (MatchCache): if not None, reuse the matches of any earlier call with the same galaxy and
+            catalog positions, and save the matches of this call for later
 
+    Returns:
+        (astropy.table.Table) matched galaxies joined with catalog
+        (astropy.table.Table) galaxies without a match
+    """
     catalog['best_match'] = np.arange(len(catalog))
-    best_match_catalog_index, sky_separation, _ = galaxies_coord.match_to_catalog_sky(catalog_coord)
+    best_match_catalog_index, sky_separation = _nearest_matches(galaxies, catalog, catalog_index, match_cache)
     galaxies['best_match'] = best_match_catalog_index
-    galaxies['sky_separation'] = sky_separation.to(units.arcsec).value
+    galaxies['sky_separation'] = sky_separation
     matched_galaxies = galaxies[galaxies['sky_separation'] < matching_radius.value]
 
     matched_catalog = table.join(matched_galaxies,
@@ -35,15 +67,31 @@ def match_galaxies_to_catalog_table(
 
 
 def match_galaxies_to_catalog_pandas(galaxies, catalog, matching_radius=10 * units.arcsec,
-                              galaxy_suffix='_subject', catalog_suffix='', how_join='inner'):
+                              galaxy_suffix='_subject', catalog_suffix='', how_join='inner', catalog_index=None,
+                              match_cache=None):
+    """
+    Match each galaxy to the nearest catalog galaxy within matching_radius, and join. See match_galaxies_to_catalog_table.
 
-    galaxies_coord = SkyCoord(ra=galaxies['ra'].values * units.degree, dec=galaxies['dec'].values * units.degree)
-    catalog_coord = SkyCoord(ra=catalog['ra'].values * units.degree, dec=catalog['dec'].values * units.degree)
+    Args:
+        galaxies (pd.DataFrame): galaxies to match, with ra and dec columns in degrees
+        catalog (pd.DataFrame): catalog to match to, with ra and dec columns in degrees
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        how_join (str): join type for pd.merge e.g. 'inner', 'right'
+        catalog_index (CatalogIndex): if not None, index built from catalog, to match against without building a new
+            tree. Must have been built from the same catalog, in the same order.
+        match_cache (MatchCache): if not None, reuse the matches of any earlier call with the same galaxy and
+            catalog positions, and save the matches of this call for later
 
+    Returns:
+        (pd.DataFrame) matched galaxies joined with catalog
+        (pd.DataFrame) galaxies without a match
+    """
     catalog['best_match'] = np.arange(len(catalog))
-    best_match_catalog_index, sky_separation, _ = galaxies_coord.match_to_catalog_sky(catalog_coord)
+    best_match_catalog_index, sky_separation = _nearest_matches(galaxies, catalog, catalog_index, match_cache)
     galaxies['best_match'] = best_match_catalog_index
-    galaxies['sky_separation'] = sky_separation.to(units.arcsec).value
+    galaxies['sky_separation'] = sky_separation
     matched_galaxies = galaxies[galaxies['sky_separation'] < matching_radius.value]
 
     matched_catalog = pd.merge(
@@ -56,3 +104,967 @@ def match_galaxies_to_catalog_pandas(galaxies, catalog, matching_radius=10 * uni
     # correct names not shared
     unmatched_galaxies = galaxies[galaxies['sky_separation'] >= matching_radius.value]
     return matched_catalog, unmatched_galaxies
+
+
+def match_galaxies_to_catalog_lazy(
+        galaxies, catalog, matching_radius=10 * units.arcsec, catalog_index=None, match_cache=None):
+    """
+    Match each galaxy to the nearest catalog galaxy within matching_radius, without joining.
+    Returns only index arrays, wrapped in a MatchResult that gathers columns when asked, so that wide tables are
+    never copied whole. Unlike match_galaxies_to_catalog_table/pandas, the inputs are not modified.
+
+    Args:
+        galaxies (astropy.table.Table or pd.DataFrame): galaxies to match, with ra and dec columns
+            (in degrees, if no units)
+        catalog (astropy.table.Table or pd.DataFrame): catalog to match to, with ra and dec columns
+            (in degrees, if no units)
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        catalog_index (CatalogIndex): if not None, index built from catalog. If None, build one.
+        match_cache (MatchCache): if not None, reuse the matches of any earlier call with the same galaxy and
+            catalog positions, and save the matches of this call for later
+
+    Returns:
+        (MatchResult) matches, with the (nearest) catalog row and separation of every galaxy
+    """
+    best_match, sky_separation = _nearest_matches(galaxies, catalog, catalog_index, match_cache, build_index=True)
+    return MatchResult(galaxies, catalog, best_match, sky_separation, matching_radius)
+
+
+def _nearest_matches(galaxies, catalog, catalog_index, match_cache, build_index=False):
+    # nearest catalog row and separation (arcsec) of each galaxy, from match_cache if possible
+    if match_cache is not None:
+        # the nearest match does not depend on the matching radius, so neither does the key
+        key = match_cache.key('nearest', radec_fingerprint(galaxies), radec_fingerprint(catalog))
+        cached = match_cache.get(key)
+        if cached is not None:
+            return cached['best_match'].astype(np.int64), cached['sky_separation']
+    if catalog_index is None and build_index:
+        catalog_index = CatalogIndex.from_catalog(catalog)
+    if catalog_index is None:
+        galaxies_coord = SkyCoord(ra=_column_values(galaxies['ra']), dec=_column_values(galaxies['dec']), unit=units.deg)
+        catalog_coord = SkyCoord(ra=_column_values(catalog['ra']), dec=_column_values(catalog['dec']), unit=units.deg)
+        best_match, sky_separation, _ = galaxies_coord.match_to_catalog_sky(catalog_coord)
+    else:
+        best_match, sky_separation = catalog_index.match(galaxies['ra'], galaxies['dec'])
+    sky_separation = sky_separation.to(units.arcsec).value
+    if match_cache is not None:
+        match_cache.put(key, best_match=best_match, sky_separation=sky_separation)
+    return best_match, sky_separation
+
+
+class MatchCache():
+    """
+    On-disk cache of crossmatch results, so that re-running the same crossmatch (e.g. a notebook or pipeline step)
+    only costs reading back the match indices and separations.
+
+    Entries are keyed by radec_fingerprint of both inputs (plus the kind of match), and saved as uncompressed .npz
+    files. When the cache grows beyond max_bytes, the least recently used entries are deleted.
+
+        cache = MatchCache('crossmatch_cache')
+        matched, unmatched = match_galaxies_to_catalog_pandas(galaxies, catalog, match_cache=cache)
+    """
+
+    def __init__(self, cache_dir, max_bytes=1024 ** 3):
+        """
+        Args:
+            cache_dir (str): directory to save entries. Created if it does not exist.
+            max_bytes (int): max. total size of entries. If None, never evict.
+        """
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if not os.path.isdir(cache_dir):
+            os.makedirs(cache_dir)
+
+    def key(self, *parts):
+        """
+        Args:
+            parts: anything with a stable str() e.g. fingerprints, radii, options
+
+        Returns:
+            (str) cache key for that combination of parts
+        """
+        return hashlib.blake2b('|'.join(str(part) for part in parts).encode(), digest_size=16).hexdigest()
+
+    def get(self, key):
+        """
+        Args:
+            key (str): cache key, from self.key
+
+        Returns:
+            (dict) of form {name: np.array} as saved by put, or None if not cached
+        """
+        loc = self._entry_loc(key)
+        try:
+            with np.load(loc) as entry:
+                arrays = {name: entry[name] for name in entry.files}
+        except (FileNotFoundError, ValueError, OSError):  # missing, or partly deleted by eviction elsewhere
+            self.misses += 1
+            return None
+        os.utime(loc)  # now most recently used
+        self.hits += 1
+        return arrays
+
+    def put(self, key, **arrays):
+        """
+        Save arrays under key, then evict least recently used entries if over max_bytes
+
+        Args:
+            key (str): cache key, from self.key
+            arrays: np.arrays to save, by name
+        """
+        temp_loc = self._entry_loc(key) + '.tmp'
+        with open(temp_loc, 'wb') as f:
+            np.savez(f, **{name: _compact(array) for name, array in arrays.items()})
+        os.replace(temp_loc, self._entry_loc(key))  # readers never see a partly-written entry
+        self.evict()
+
+    def evict(self):
+        """
+        Delete least recently used entries until the cache is no larger than max_bytes
+        """
+        if self.max_bytes is None:
+            return
+        entries = sorted(self._entries(), key=lambda entry: entry[1].st_mtime)
+        total_bytes = sum(stat.st_size for _, stat in entries)
+        for loc, stat in entries[:-1]:  # always keep the newest entry
+            if total_bytes <= self.max_bytes:
+                break
+            os.remove(loc)
+            total_bytes -= stat.st_size
+
+    @property
+    def size_bytes(self):
+        return sum(stat.st_size for _, stat in self._entries())
+
+    def clear(self):
+        for loc, _ in self._entries():
+            os.remove(loc)
+
+    def _entry_loc(self, key):
+        return os.path.join(self.cache_dir, '{}.npz'.format(key))
+
+    def _entries(self):
+        entries = []
+        for name in os.listdir(self.cache_dir):
+            if name.endswith('.npz'):
+                loc = os.path.join(self.cache_dir, name)
+                try:
+                    entries.append((loc, os.stat(loc)))
+                except FileNotFoundError:  # evicted meanwhile
+                    pass
+        return entries
+
+
+def radec_fingerprint(data):
+    """
+    Cheap fingerprint of the positions of a table: a hash of the ra and dec values (in degrees), which changes if
+    any position changes, or rows are added, removed or reordered. Other columns are ignored.
+
+    Args:
+        data (astropy.table.Table or pd.DataFrame): table with ra and dec columns (in degrees, if no units)
+
+    Returns:
+        (str) fingerprint
+    """
+    digest = hashlib.blake2b(digest_size=16)
+    for col in ['ra', 'dec']:
+        values = units.Quantity(_column_values(data[col]), units.deg).value
+        digest.update(np.ascontiguousarray(values, dtype=np.float64).tobytes())
+    return '{}-{}'.format(len(data), digest.hexdigest())
+
+
+def _compact(array):
+    # row indices fit in int32 for any catalog of fewer than 2 billion rows, halving their size on disk
+    array = np.asarray(array)
+    if array.dtype.kind in 'iu' and len(array) and -2 ** 31 <= array.min() and array.max() < 2 ** 31:
+        return array.astype(np.int32)
+    return array
+
+
+class MatchResult():
+    """
+    Nearest-neighbour matches of galaxies to a catalog, as index arrays into the (unmodified) input tables.
+    Columns are only gathered (for matched rows) when asked, by matched() and unmatched().
+
+        result = match_galaxies_to_catalog_lazy(galaxies, catalog)
+        matched = result.matched(galaxy_columns=['id_str'], catalog_columns=['ra', 'dec', 'redshift'])
+    """
+
+    def __init__(self, galaxies, catalog, best_match, sky_separation, matching_radius):
+        """
+        Args:
+            galaxies (astropy.table.Table or pd.DataFrame): matched galaxies
+            catalog (astropy.table.Table or pd.DataFrame): catalog matched to
+            best_match (np.array): row of catalog nearest to each galaxy
+            sky_separation (np.array): separation (arcsec) of each galaxy from that catalog row
+            matching_radius (astropy.units.Quantity): max. separation for a match
+        """
+        self.galaxies = galaxies
+        self.catalog = catalog
+        self.best_match = best_match
+        self.sky_separation = sky_separation
+        is_matched = sky_separation < matching_radius.to(units.arcsec).value
+        self.galaxy_index = np.flatnonzero(is_matched)  # rows of galaxies with a match
+        self.unmatched_index = np.flatnonzero(~is_matched)
+        self.catalog_match = best_match[self.galaxy_index]  # row of catalog matched to each of those galaxies
+        self.separation = sky_separation[self.galaxy_index]  # and their separation (arcsec)
+
+    def __len__(self):
+        return len(self.galaxy_index)
+
+    def matched(self, galaxy_columns=None, catalog_columns=None, galaxy_suffix='_subject', catalog_suffix=''):
+        """
+        Gather matched galaxies and their catalog matches into one table, like an inner join but only of the columns
+        asked for. Rows are in galaxy order.
+
+        Args:
+            galaxy_columns (list): galaxy columns to include. If None, all columns.
+            catalog_columns (list): catalog columns to include. If None, all columns.
+            galaxy_suffix (str): suffix for galaxy columns also in catalog_columns
+            catalog_suffix (str): suffix for catalog columns also in galaxy_columns
+
+        Returns:
+            (astropy.table.Table or pd.DataFrame, as galaxies) matched galaxies with catalog columns,
+                best_match and sky_separation
+        """
+        galaxy_columns = _column_names(self.galaxies) if galaxy_columns is None else list(galaxy_columns)
+        catalog_columns = _column_names(self.catalog) if catalog_columns is None else list(catalog_columns)
+        shared = set(galaxy_columns) & set(catalog_columns)
+        columns = {}
+        for col in galaxy_columns:
+            name = col + galaxy_suffix if col in shared else col
+            columns[name] = _take(self.galaxies, col, self.galaxy_index)
+        columns['best_match'] = self.catalog_match
+        columns['sky_separation'] = self.separation
+        for col in catalog_columns:
+            name = col + catalog_suffix if col in shared else col
+            columns[name] = _take(self.catalog, col, self.catalog_match)
+        return _new_like(self.galaxies, columns)
+
+    def unmatched(self, columns=None):
+        """
+        Args:
+            columns (list): galaxy columns to include. If None, all columns.
+
+        Returns:
+            (astropy.table.Table or pd.DataFrame, as galaxies) galaxies without a match, with the best_match
+                and sky_separation of the nearest (too distant) catalog galaxy
+        """
+        columns = _column_names(self.galaxies) if columns is None else list(columns)
+        gathered = {col: _take(self.galaxies, col, self.unmatched_index) for col in columns}
+        gathered['best_match'] = self.best_match[self.unmatched_index]
+        gathered['sky_separation'] = self.sky_separation[self.unmatched_index]
+        unmatched = _new_like(self.galaxies, gathered)
+        if isinstance(unmatched, pd.DataFrame):
+            unmatched.index = self.galaxies.index[self.unmatched_index]  # as a slice of galaxies would have
+        return unmatched
+
+
+def _column_names(data):
+    return list(data.columns) if isinstance(data, pd.DataFrame) else list(data.colnames)
+
+
+def _take(data, col, rows):
+    # gather one column at some rows, without copying any other columns
+    if isinstance(data, pd.DataFrame):
+        return data[col].values[rows]
+    return data[col][rows]
+
+
+def _new_like(data, columns):
+    if isinstance(data, pd.DataFrame):
+        return pd.DataFrame(columns)
+    return table.Table(list(columns.values()), names=list(columns.keys()), copy=False)
+
+
+def match_galaxies_to_catalog_partitioned(
+        galaxies,
+        catalog,
+        matching_radius=10 * units.arcsec,
+        galaxy_suffix='_subject',
+        catalog_suffix='',
+        how_join='inner',
+        n_bands=64,
+        max_workers=None,
+        chunk_size=1000000,
+        work_dir=None):
+    """
+    Crossmatch like match_galaxies_to_catalog_pandas, for galaxies and catalogs too large to match in memory at once.
+
+    Both sides are streamed (chunk_size rows at a time) into equal-area declination bands on disk. Catalog rows within
+    matching_radius of a band edge are copied into the neighbouring band too, so that every match within
+    matching_radius is found. Each band is then matched separately, in a pool of max_workers processes, and the results
+    merged in the original galaxy order. Memory per process is bounded by the size of one band.
+
+    Matched galaxies are exactly those of match_galaxies_to_catalog_pandas. For unmatched galaxies, best_match and
+    sky_separation are of the nearest catalog galaxy within the same band (plus margin), which may not be the nearest
+    overall, or -1 and inf if the band has no catalog galaxies. Unlike match_galaxies_to_catalog_pandas,
+    the inputs are not modified. Columns keep the types of the whole inputs (see band_schema).
+
+    Args:
+        galaxies (pd.DataFrame or str): galaxies with ra and dec columns in degrees, or location of such a table
+            (Parquet, Feather or csv)
+        catalog (pd.DataFrame or str): catalog with ra and dec columns in degrees, or location of such a table
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        how_join (str): 'inner' or 'left' (which are equivalent here, as every matched galaxy has a catalog match).
+            Joins including every catalog row are not supported, as the catalog may not fit in memory.
+        n_bands (int): number of declination bands. Each band (of both tables) should comfortably fit in memory.
+        max_workers (int): number of processes matching bands at once. If None, one per CPU.
+        chunk_size (int): rows of each table to read at a time, when splitting into bands
+        work_dir (str): directory for band files. If None, use a temporary directory, deleted afterwards.
+
+    Returns:
+        (pd.DataFrame) matched galaxies joined with catalog, in galaxy order
+        (pd.DataFrame) galaxies without a match, in galaxy order
+    """
+    if how_join not in ('inner', 'left'):
+        raise ValueError('Partitioned matching supports how_join inner or left, not {}'.format(how_join))
+    if work_dir is None:
+        with tempfile.TemporaryDirectory() as temp_dir:
+            return match_galaxies_to_catalog_partitioned(
+                galaxies, catalog, matching_radius, galaxy_suffix, catalog_suffix, how_join,
+                n_bands, max_workers, chunk_size, work_dir=temp_dir)
+
+    band_edges = equal_area_dec_bands(n_bands)
+    radius_deg = matching_radius.to(units.deg).value
+    galaxy_locs = write_dec_bands(galaxies, os.path.join(work_dir, 'galaxies'), band_edges, 0., '_galaxy_row', chunk_size)
+    catalog_locs = write_dec_bands(catalog, os.path.join(work_dir, 'catalog'), band_edges, radius_deg, 'best_match', chunk_size)
+
+    band_args = [
+        (galaxy_loc, catalog_locs.get(band), matching_radius.to(units.arcsec).value, galaxy_suffix, catalog_suffix, how_join)
+        for band, galaxy_loc in sorted(galaxy_locs.items())
+    ]
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(_match_band, *zip(*band_args))) if band_args else []
+
+    matched = pd.concat([result[0] for result in results], ignore_index=True) if results else pd.DataFrame()
+    unmatched = pd.concat([result[1] for result in results]) if results else pd.DataFrame()
+    if not matched.empty:
+        matched = matched.sort_values('_galaxy_row', kind='stable').drop(columns='_galaxy_row').reset_index(drop=True)
+    if not unmatched.empty:
+        unmatched = unmatched.sort_values('_galaxy_row', kind='stable')
+        galaxy_rows = unmatched.pop('_galaxy_row').values
+        # restore the input index, as match_galaxies_to_catalog_pandas returns a slice of galaxies
+        unmatched.index = galaxies.index[galaxy_rows] if isinstance(galaxies, pd.DataFrame) else galaxy_rows
+    return matched, unmatched
+
+
+def equal_area_dec_bands(n_bands):
+    """
+    Args:
+        n_bands (int): number of bands
+
+    Returns:
+        (np.array) n_bands + 1 declination band edges (degrees) from -90 to 90, with equal sky area between each
+    """
+    return np.degrees(np.arcsin(np.linspace(-1., 1., n_bands + 1)))
+
+
+def write_dec_bands(source, band_dir, band_edges, margin, row_col, chunk_size=1000000):
+    """
+    Split a table into declination bands on disk, streaming chunk by chunk.
+    Every band has the column types of the whole source (see band_schema), so that bands read back as the source
+    would be, whichever band a row is in.
+
+    Args:
+        source (pd.DataFrame or str): table with ra and dec columns in degrees, or its location
+        band_dir (str): directory to write one Feather file per band (quick to write and read back). Created if it does not exist.
+        band_edges (np.array): declination band edges, from equal_area_dec_bands
+        margin (float): rows within this many degrees (of declination) of a band are also written to that band
+        row_col (str): name of new column recording the row number of each row in source
+        chunk_size (int): rows to read at a time
+
+    Returns:
+        (dict) of form {band: location of band file} for each band with any rows
+    """
+    if not os.path.isdir(band_dir):
+        os.makedirs(band_dir)
+    n_bands = len(band_edges) - 1
+    source_schema = band_schema(source, chunk_size)
+    schema = None
+    sinks = {}
+    writers = {}
+    n_rows = 0
+    try:
+        for chunk in columnar_utils.iter_table_chunks(source, chunk_size=chunk_size):
+            chunk = chunk.reset_index(drop=True)
+            chunk[row_col] = np.arange(n_rows, n_rows + len(chunk))
+            n_rows += len(chunk)
+            if schema is None:
+                schema = pa.schema(
+                    [source_schema.field(str(col)) for col in chunk.columns[:-1]] + [pa.field(row_col, pa.int64())])
+            batch = _to_band_table(chunk, schema)
+            dec = chunk['dec'].values
+            first_band = np.clip(np.searchsorted(band_edges, dec - margin, side='right') - 1, 0, n_bands - 1)
+            last_band = np.clip(np.searchsorted(band_edges, dec + margin, side='right') - 1, 0, n_bands - 1)
+            # with margins, a row may belong to several bands
+            for offset in range(int((last_band - first_band).max(initial=0)) + 1):
+                bands = first_band + offset
+                in_band = bands <= last_band
+                for band in np.unique(bands[in_band]):
+                    if band not in writers:
+                        sinks[band] = pa.OSFile(os.path.join(band_dir, 'band_{:05d}.feather'.format(band)), 'wb')
+                        writers[band] = pa.ipc.new_file(sinks[band], schema)
+                    writers[band].write_table(batch.filter(pa.array(in_band & (bands == band))))
+    finally:
+        for band, writer in writers.items():
+            writer.close()
+            sinks[band].close()
+    return {int(band): os.path.join(band_dir, 'band_{:05d}.feather'.format(band)) for band in writers}
+
+
+def band_schema(source, chunk_size=1000000):
+    """
+    Arrow schema for all of a table, not just its first chunk.
+    DataFrames keep their dtypes (except object columns Arrow cannot hold, like a mix of str and int, which become
+    str), and Parquet and Feather tables their schema. csv tables have no types, so the types of every chunk are
+    widened (see columnar_utils.widen_schema) as pd.read_csv of the whole table would, with empty columns as floats.
+
+    Args:
+        source (pd.DataFrame or str): table, or location of Parquet, Feather or csv table
+        chunk_size (int): rows of csv table to read at a time
+
+    Returns:
+        (pa.Schema) schema of table
+    """
+    if isinstance(source, pd.DataFrame):
+        fields = []
+        for col in source.columns:
+            try:
+                fields.append(pa.Schema.from_pandas(source[[col]], preserve_index=False).field(0))
+            except (pa.ArrowInvalid, pa.ArrowTypeError):
+                fields.append(pa.field(str(col), pa.string()))
+        return pa.schema(fields)
+    file_format = columnar_utils.infer_format(source)
+    if file_format == 'parquet':
+        return pq.read_schema(source).remove_metadata()
+    if file_format == 'feather':
+        with pa.memory_map(source, 'r') as f:
+            return pa.ipc.open_file(f).schema.remove_metadata()
+    schema = pa.schema([])
+    for chunk in columnar_utils.iter_table_chunks(source, chunk_size=chunk_size):
+        schema = columnar_utils.widen_schema(schema, columnar_utils.arrow_schema_for(chunk))
+    return pa.schema([pa.field(field.name, pa.float64()) if pa.types.is_null(field.type) else field for field in schema])
+
+
+def _to_band_table(chunk, schema):
+    for field in schema:
+        values = chunk[field.name]
+        # str columns of a csv may have other values in this chunk, and mixed columns of a DataFrame are saved as str
+        if pa.types.is_string(field.type) and not pd.api.types.is_string_dtype(values):
+            chunk[field.name] = values.astype(object).where(values.isna(), values.astype(str))
+    return pa.Table.from_pandas(chunk, schema=schema, preserve_index=False)
+
+
+def _match_band(galaxy_loc, catalog_loc, matching_radius_arcsec, galaxy_suffix, catalog_suffix, how_join):
+    # runs in a worker process: match one band of galaxies against the same band (plus margin) of the catalog
+    galaxies = pd.read_feather(galaxy_loc)
+    if catalog_loc is None:
+        galaxies['best_match'] = -1
+        galaxies['sky_separation'] = np.inf
+        return pd.DataFrame(), galaxies
+    catalog = pd.read_feather(catalog_loc)
+    best_match, sky_separation = CatalogIndex.from_catalog(catalog).match(galaxies['ra'].values, galaxies['dec'].values)
+    galaxies['best_match'] = catalog['best_match'].values[best_match]  # band row to row of whole catalog
+    galaxies['sky_separation'] = sky_separation.to(units.arcsec).value
+    is_matched = galaxies['sky_separation'] < matching_radius_arcsec
+    matched = pd.merge(
+        galaxies[is_matched],
+        catalog,
+        on='best_match',
+        how=how_join,
+        suffixes=['{}'.format(galaxy_suffix), '{}'.format(catalog_suffix)]
+    )
+    return matched, galaxies[~is_matched]
+
+
+def iter_pairs_within_radius(galaxies, catalog_index, matching_radius=10 * units.arcsec, chunk_size=100000):
+    """
+    Find every catalog galaxy within matching_radius of each galaxy, chunk_size galaxies at a time.
+    Memory is bounded by the pairs of one chunk, unlike astropy search_around_sky on the whole table.
+
+    Args:
+        galaxies (astropy.table.Table or pd.DataFrame): galaxies with ra and dec columns
+        catalog_index (CatalogIndex): index of catalog to match to
+        matching_radius (astropy.units.Quantity): max. separation of pairs
+        chunk_size (int): galaxies to match at a time
+
+    Yields:
+        (np.array) galaxy (row) index of each pair
+        (np.array) catalog (row) index of each pair
+        (np.array) separation of each pair, in arcseconds
+    Within each chunk, pairs are sorted by galaxy index, then separation.
+    """
+    for start, ra, dec in _iter_radec_chunks(galaxies, chunk_size):
+        galaxy_index, catalog_match, sky_separation = catalog_index.query_radius(ra, dec, matching_radius)
+        sky_separation = sky_separation.to(units.arcsec).value
+        order = np.lexsort((sky_separation, galaxy_index))
+        yield start + galaxy_index[order], catalog_match[order], sky_separation[order]
+
+
+def iter_nearest_pairs(galaxies, catalog_index, k, matching_radius=None, chunk_size=100000):
+    """
+    Find the k nearest catalog galaxies to each galaxy (optionally, only those within matching_radius),
+    chunk_size galaxies at a time
+
+    Args:
+        galaxies (astropy.table.Table or pd.DataFrame): galaxies with ra and dec columns
+        catalog_index (CatalogIndex): index of catalog to match to
+        k (int): max. neighbours per galaxy
+        matching_radius (astropy.units.Quantity): if not None, max. separation of pairs
+        chunk_size (int): galaxies to match at a time
+
+    Yields:
+        (np.array) galaxy (row) index of each pair
+        (np.array) catalog (row) index of each pair
+        (np.array) separation of each pair, in arcseconds
+    Within each chunk, pairs are sorted by galaxy index, then separation.
+    """
+    for start, ra, dec in _iter_radec_chunks(galaxies, chunk_size):
+        galaxy_index, catalog_match, sky_separation = catalog_index.query_nearest(ra, dec, k, max_radius=matching_radius)
+        yield start + galaxy_index, catalog_match, sky_separation.to(units.arcsec).value
+
+
+def match_all_within_radius_pandas(
+        galaxies, catalog, matching_radius=10 * units.arcsec, galaxy_suffix='_subject', catalog_suffix='',
+        how_join='inner', catalog_index=None, chunk_size=100000):
+    """
+    Match each galaxy to every catalog galaxy within matching_radius (e.g. to find blends or duplicates), and join.
+    Like match_galaxies_to_catalog_pandas, but with one row per (galaxy, catalog galaxy) pair.
+    Pairs have the catalog row in best_match, their separation (arcsec) in sky_separation,
+    and their rank by separation for that galaxy (1 for the nearest) in match_rank. Inputs are not modified.
+
+    Args:
+        galaxies (pd.DataFrame): galaxies to match, with ra and dec columns in degrees
+        catalog (pd.DataFrame): catalog to match to, with ra and dec columns in degrees
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        how_join (str): join type for pd.merge e.g. 'inner', 'right'
+        catalog_index (CatalogIndex): if not None, index of catalog. If None, build one.
+        chunk_size (int): galaxies to match at a time. See iter_pairs_within_radius.
+
+    Returns:
+        (pd.DataFrame) galaxy-catalog pairs joined with catalog
+        (pd.DataFrame) galaxies without any match
+    """
+    catalog_index = catalog_index if catalog_index is not None else CatalogIndex.from_catalog(catalog)
+    pairs = iter_pairs_within_radius(galaxies, catalog_index, matching_radius, chunk_size)
+    return _join_pairs_pandas(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, how_join)
+
+
+def match_all_within_radius_table(
+        galaxies, catalog, matching_radius=10 * units.arcsec, join_type='inner', galaxy_suffix='_subject',
+        catalog_suffix='', catalog_index=None, chunk_size=100000):
+    """
+    As match_all_within_radius_pandas, for astropy Tables (joined like match_galaxies_to_catalog_table)
+
+    Args:
+        galaxies (astropy.table.Table): galaxies to match, with ra and dec columns (in degrees, if no units)
+        catalog (astropy.table.Table): catalog to match to, with ra and dec columns (in degrees, if no units)
+        matching_radius (astropy.units.Quantity): max. separation for a match
+        join_type (str): join type for astropy.table.join e.g. 'inner', 'right'
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        catalog_index (CatalogIndex): if not None, index of catalog. If None, build one.
+        chunk_size (int): galaxies to match at a time. See iter_pairs_within_radius.
+
+    Returns:
+        (astropy.table.Table) galaxy-catalog pairs joined with catalog
+        (astropy.table.Table) galaxies without any match
+    """
+    catalog_index = catalog_index if catalog_index is not None else CatalogIndex.from_catalog(catalog)
+    pairs = iter_pairs_within_radius(galaxies, catalog_index, matching_radius, chunk_size)
+    return _join_pairs_table(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, join_type)
+
+
+def match_k_nearest_pandas(
+        galaxies, catalog, k, matching_radius=None, galaxy_suffix='_subject', catalog_suffix='',
+        how_join='inner', catalog_index=None, chunk_size=100000):
+    """
+    Match each galaxy to its k nearest catalog galaxies (optionally, only those within matching_radius), and join.
+    Output columns are as match_all_within_radius_pandas, so match_rank runs from 1 (nearest) to k.
+    Inputs are not modified.
+
+    Args:
+        galaxies (pd.DataFrame): galaxies to match, with ra and dec columns in degrees
+        catalog (pd.DataFrame): catalog to match to, with ra and dec columns in degrees
+        k (int): max. matches per galaxy
+        matching_radius (astropy.units.Quantity): if not None, max. separation for a match
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        how_join (str): join type for pd.merge e.g. 'inner', 'right'
+        catalog_index (CatalogIndex): if not None, index of catalog. If None, build one.
+        chunk_size (int): galaxies to match at a time. See iter_nearest_pairs.
+
+    Returns:
+        (pd.DataFrame) galaxy-catalog pairs joined with catalog
+        (pd.DataFrame) galaxies without any match
+    """
+    catalog_index = catalog_index if catalog_index is not None else CatalogIndex.from_catalog(catalog)
+    pairs = iter_nearest_pairs(galaxies, catalog_index, k, matching_radius, chunk_size)
+    return _join_pairs_pandas(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, how_join)
+
+
+def match_k_nearest_table(
+        galaxies, catalog, k, matching_radius=None, join_type='inner', galaxy_suffix='_subject',
+        catalog_suffix='', catalog_index=None, chunk_size=100000):
+    """
+    As match_k_nearest_pandas, for astropy Tables (joined like match_galaxies_to_catalog_table)
+
+    Args:
+        galaxies (astropy.table.Table): galaxies to match, with ra and dec columns (in degrees, if no units)
+        catalog (astropy.table.Table): catalog to match to, with ra and dec columns (in degrees, if no units)
+        k (int): max. matches per galaxy
+        matching_radius (astropy.units.Quantity): if not None, max. separation for a match
+        join_type (str): join type for astropy.table.join e.g. 'inner', 'right'
+        galaxy_suffix (str): suffix for galaxy columns also in catalog
+        catalog_suffix (str): suffix for catalog columns also in galaxies
+        catalog_index (CatalogIndex): if not None, index of catalog. If None, build one.
+        chunk_size (int): galaxies to match at a time. See iter_nearest_pairs.
+
+    Returns:
+        (astropy.table.Table) galaxy-catalog pairs joined with catalog
+        (astropy.table.Table) galaxies without any match
+    """
+    catalog_index = catalog_index if catalog_index is not None else CatalogIndex.from_catalog(catalog)
+    pairs = iter_nearest_pairs(galaxies, catalog_index, k, matching_radius, chunk_size)
+    return _join_pairs_table(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, join_type)
+
+
+def _iter_radec_chunks(galaxies, chunk_size):
+    ra, dec = _column_values(galaxies['ra']), _column_values(galaxies['dec'])
+    for start in range(0, len(galaxies), chunk_size):
+        yield start, ra[start:start + chunk_size], dec[start:start + chunk_size]
+
+
+def _collect_pairs(pairs, n_galaxies):
+    # concatenate chunks of pairs (compact index arrays) and rank each galaxy's matches by separation
+    chunks = list(pairs)
+    if chunks:
+        galaxy_index, catalog_match, sky_separation = [np.concatenate(arrays) for arrays in zip(*chunks)]
+    else:
+        galaxy_index, catalog_match, sky_separation = np.zeros(0, dtype=int), np.zeros(0, dtype=int), np.zeros(0)
+    # pairs are already sorted by galaxy, then separation
+    first_of_galaxy = np.searchsorted(galaxy_index, galaxy_index, side='left')
+    match_rank = np.arange(len(galaxy_index)) - first_of_galaxy + 1  # 1 is the nearest, see match_all_within_radius_pandas
+    has_match = np.zeros(n_galaxies, dtype=bool)
+    has_match[galaxy_index] = True
+    return galaxy_index, catalog_match, sky_separation, match_rank, has_match
+
+
+def _join_pairs_pandas(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, how_join):
+    galaxy_index, catalog_match, sky_separation, match_rank, has_match = _collect_pairs(pairs, len(galaxies))
+    matched_galaxies = galaxies.iloc[galaxy_index].assign(
+        best_match=catalog_match, sky_separation=sky_separation, match_rank=match_rank, _pair=np.arange(len(galaxy_index)))
+    matched_catalog = pd.merge(
+        matched_galaxies,
+        catalog.assign(best_match=np.arange(len(catalog))),
+        on='best_match',
+        how=how_join,
+        suffixes=['{}'.format(galaxy_suffix), '{}'.format(catalog_suffix)]
+    )
+    if how_join in ('inner', 'left'):  # merge groups rows by key, but pairs are clearer in galaxy order
+        matched_catalog = matched_catalog.sort_values('_pair', kind='stable').reset_index(drop=True)
+    return matched_catalog.drop(columns='_pair'), galaxies[~has_match]
+
+
+def _join_pairs_table(galaxies, catalog, pairs, galaxy_suffix, catalog_suffix, join_type):
+    galaxy_index, catalog_match, sky_separation, match_rank, has_match = _collect_pairs(pairs, len(galaxies))
+    matched_galaxies = galaxies[galaxy_index]
+    matched_galaxies['best_match'] = catalog_match
+    matched_galaxies['sky_separation'] = sky_separation
+    matched_galaxies['match_rank'] = match_rank
+    matched_galaxies['_pair'] = np.arange(len(galaxy_index))
+    catalog = catalog.copy(copy_data=False)
+    catalog['best_match'] = np.arange(len(catalog))
+    matched_catalog = table.join(matched_galaxies,
+                                 catalog,
+                                 keys='best_match',
+                                 join_type=join_type,
+                                 table_names=['{}'.format(galaxy_suffix), '{}'.format(catalog_suffix)],
+                                 uniq_col_name='{col_name}{table_name}')
+    if join_type in ('inner', 'left'):  # join sorts rows by key, but pairs are clearer in galaxy order
+        matched_catalog.sort('_pair')
+    matched_catalog.remove_column('_pair')
+    return matched_catalog, galaxies[~has_match]
+
+
+def self_match_groups(catalog, matching_radius=1 * units.arcsec, n_bands=1, max_workers=None):
+    """
+    Group catalog galaxies that are within matching_radius of each other (e.g. the same object in overlapping bricks),
+    friends-of-friends style: galaxies are in the same group if linked by any chain of pairs within matching_radius.
+
+    Pairs are found with a KD-tree, so time is near-linear in catalog size. With n_bands > 1, the catalog is split
+    into equal-area declination bands (plus a matching_radius margin, so no pair is missed), searched in parallel
+    by max_workers processes.
+
+    Args:
+        catalog (astropy.table.Table or pd.DataFrame): catalog with ra and dec columns (in degrees, if no units)
+        matching_radius (astropy.units.Quantity): max. separation of duplicates
+        n_bands (int): number of declination bands to search separately
+        max_workers (int): number of processes searching bands at once. If None, one per CPU.
+
+    Returns:
+        (np.array) group of each catalog row, numbered from 0 in order of first appearance
+        (np.array) size of the group of each catalog row (1 if not duplicated)
+    """
+    xyz = radec_to_xyz(catalog['ra'], catalog['dec'])
+    max_chord = angle_to_chord(matching_radius.to(units.rad).value)
+    if n_bands == 1:
+        pairs = cKDTree(xyz, balanced_tree=False).query_pairs(max_chord, output_type='ndarray')
+    else:
+        dec = np.degrees(np.arcsin(np.clip(xyz[:, 2], -1., 1.)))
+        band_edges = equal_area_dec_bands(n_bands)
+        margin = matching_radius.to(units.deg).value
+        band_rows = [
+            np.flatnonzero((dec >= low - margin) & (dec <= high + margin))
+            for low, high in zip(band_edges[:-1], band_edges[1:])
+        ]
+        with ProcessPoolExecutor(max_workers=max_workers) as executor:
+            band_pairs = list(executor.map(_band_pairs, [xyz[rows] for rows in band_rows], [max_chord] * n_bands))
+        # pairs in a margin are found by both bands, which is harmless when finding connected components
+        pairs = np.concatenate([rows[pairs] for rows, pairs in zip(band_rows, band_pairs)] + [np.zeros((0, 2), dtype=int)])
+    n_rows = len(xyz)
+    graph = scipy.sparse.coo_matrix((np.ones(len(pairs), dtype=bool), (pairs[:, 0], pairs[:, 1])), shape=(n_rows, n_rows))
+    # groups are labelled in order of their first row, so group numbers do not depend on how pairs were found
+    _, group = scipy.sparse.csgraph.connected_components(graph, directed=False)
+    group_size = np.bincount(group)[group]
+    return group, group_size
+
+
+def deduplicate_catalog(
+        catalog, matching_radius=1 * units.arcsec, keep='first', keep_by=None, n_bands=1, max_workers=None):
+    """
+    Remove near-duplicate galaxies from catalog, keeping one representative of each self_match_groups group.
+    The input is not modified.
+
+    Args:
+        catalog (astropy.table.Table or pd.DataFrame): catalog with ra and dec columns (in degrees, if no units)
+        matching_radius (astropy.units.Quantity): max. separation of duplicates
+        keep (str): 'first' or 'last': keep the first or last galaxy of each group, ordered by keep_by
+        keep_by (str): column to order each group by e.g. 'mag' with keep='first' keeps the brightest duplicate.
+            If None, order by catalog row.
+        n_bands (int): number of declination bands to search in parallel. See self_match_groups.
+        max_workers (int): number of processes searching bands at once. If None, one per CPU.
+
+    Returns:
+        (astropy.table.Table or pd.DataFrame, as catalog) catalog with one galaxy per group, in catalog order
+        (dict) of form {'rows': int, 'groups': int, 'removed': int, 'group_sizes': {size: number of groups}}
+    """
+    if keep not in ('first', 'last'):
+        raise ValueError('keep must be first or last, not {}'.format(keep))
+    group, group_size = self_match_groups(catalog, matching_radius, n_bands=n_bands, max_workers=max_workers)
+    # only rows with duplicates need ranking within their group
+    duplicated = np.flatnonzero(group_size > 1)
+    rank = duplicated if keep_by is None else np.asarray(_column_values(catalog[keep_by]))[duplicated]
+    order = np.lexsort((duplicated, rank, group[duplicated]))  # by group, then rank (ties by row) within group
+    if keep == 'last':
+        order = order[::-1]
+    sorted_group = group[duplicated][order]
+    is_first_of_group = np.ones(len(order), dtype=bool)
+    is_first_of_group[1:] = sorted_group[1:] != sorted_group[:-1]
+    kept = np.sort(np.concatenate([np.flatnonzero(group_size == 1), duplicated[order[is_first_of_group]]]))
+
+    n_groups = len(kept)
+    sizes, counts = np.unique(group_size[kept], return_counts=True)
+    report = {
+        'rows': len(group),
+        'groups': n_groups,
+        'removed': len(group) - n_groups,
+        'group_sizes': {int(size): int(count) for size, count in zip(sizes, counts)}
+    }
+    logging.info('Removed {} duplicates of {} galaxies: {}'.format(report['removed'], report['rows'], report))
+    deduplicated = catalog.iloc[kept] if isinstance(catalog, pd.DataFrame) else catalog[kept]
+    return deduplicated, report
+
+
+def _band_pairs(xyz, max_chord):
+    # runs in a worker process: pairs (of band rows) within max_chord
+    return cKDTree(xyz, balanced_tree=False).query_pairs(max_chord, output_type='ndarray')
+
+
+class CatalogIndex():
+    """
+    Sky index (KD-tree of unit vectors) of a catalog, to match many batches of galaxies against the same catalog
+    without rebuilding the tree each time. Can be saved to disk and memory-mapped back, so loading is near-instant
+    and the index is shared (via the page cache) between processes.
+
+    Matches agree with astropy's SkyCoord.match_to_catalog_sky and search_around_sky.
+    """
+
+    def __init__(self, ra, dec, tree=None):
+        """
+        Args:
+            ra (np.array): catalog right ascensions, in degrees (if no units)
+            dec (np.array): catalog declinations, in degrees (if no units)
+            tree (scipy.spatial.cKDTree): if not None, already-built tree of the catalog unit vectors
+        """
+        if tree is None:
+            # unbalanced trees build about twice as fast, and query as fast for sky positions
+            tree = cKDTree(radec_to_xyz(ra, dec), balanced_tree=False)
+        self.tree = tree
+
+    @classmethod
+    def from_catalog(cls, catalog):
+        """
+        Args:
+            catalog (astropy.table.Table or pd.DataFrame): catalog with ra and dec columns
+
+        Returns:
+            (CatalogIndex) index of catalog, in catalog order
+        """
+        return cls(_column_values(catalog['ra']), _column_values(catalog['dec']))
+
+    def __len__(self):
+        return self.tree.n
+
+    def match(self, ra, dec, nthneighbor=1):
+        """
+        Find the nearest catalog galaxy to each galaxy. Like SkyCoord.match_to_catalog_sky.
+
+        Args:
+            ra (np.array): galaxy right ascensions, in degrees (if no units)
+            dec (np.array): galaxy declinations, in degrees (if no units)
+            nthneighbor (int): which neighbour to find e.g. 2 for the second-nearest
+
+        Returns:
+            (np.array) index of nearest catalog galaxy to each galaxy
+            (astropy.coordinates.Angle) separation to nearest catalog galaxy
+        """
+        chord, catalog_index = self.tree.query(radec_to_xyz(ra, dec), k=nthneighbor)
+        if nthneighbor > 1:
+            chord, catalog_index = chord[:, -1], catalog_index[:, -1]
+        return catalog_index, Angle(chord_to_angle(chord), unit=units.rad).to(units.deg)
+
+    def query_radius(self, ra, dec, radius):
+        """
+        Find every catalog galaxy within radius of each galaxy. Like SkyCoord.search_around_sky.
+
+        Args:
+            ra (np.array): galaxy right ascensions, in degrees (if no units)
+            dec (np.array): galaxy declinations, in degrees (if no units)
+            radius (astropy.units.Quantity): max. separation
+
+        Returns:
+            (np.array) galaxy index of each pair
+            (np.array) catalog index of each pair
+            (astropy.coordinates.Angle) separation of each pair
+        Pairs are sorted by galaxy index, then catalog index.
+        """
+        xyz = radec_to_xyz(ra, dec)
+        max_chord = angle_to_chord(radius.to(units.rad).value)
+        matches = self.tree.query_ball_point(xyz, r=max_chord, return_sorted=True)
+        n_matches = np.array([len(m) for m in matches], dtype=int)
+        galaxy_index = np.repeat(np.arange(len(xyz)), n_matches)
+        catalog_index = np.concatenate(matches).astype(int) if n_matches.sum() > 0 else np.zeros(0, dtype=int)
+        chord = np.linalg.norm(xyz[galaxy_index] - self.tree.data[catalog_index], axis=1)
+        return galaxy_index, catalog_index, Angle(chord_to_angle(chord), unit=units.rad).to(units.deg)
+
+    def query_nearest(self, ra, dec, k, max_radius=None):
+        """
+        Find the k nearest catalog galaxies to each galaxy, optionally only within max_radius
+
+        Args:
+            ra (np.array): galaxy right ascensions, in degrees (if no units)
+            dec (np.array): galaxy declinations, in degrees (if no units)
+            k (int): max. neighbours per galaxy
+            max_radius (astropy.units.Quantity): if not None, only find neighbours within this separation
+
+        Returns:
+            (np.array) galaxy index of each pair
+            (np.array) catalog index of each pair
+            (astropy.coordinates.Angle) separation of each pair
+        Pairs are sorted by galaxy index, then separation.
+        """
+        upper_bound = np.inf if max_radius is None else angle_to_chord(max_radius.to(units.rad).value)
+        chord, catalog_index = self.tree.query(radec_to_xyz(ra, dec), k=k, distance_upper_bound=upper_bound)
+        chord, catalog_index = chord.reshape(len(chord), -1), catalog_index.reshape(len(catalog_index), -1)
+        galaxy_index = np.repeat(np.arange(len(chord)), chord.shape[1]).reshape(chord.shape)
+        found = catalog_index < self.tree.n  # missing neighbours are reported with index n
+        return galaxy_index[found], catalog_index[found], Angle(chord_to_angle(chord[found]), unit=units.rad).to(units.deg)
+
+    def save(self, index_dir):
+        """
+        Save index as .npy files, which load can memory-map
+
+        Args:
+            index_dir (str): directory to save index in. Created if it does not exist.
+        """
+        if not os.path.isdir(index_dir):
+            os.makedirs(index_dir)
+        state = self.tree.__getstate__()
+        arrays = [n for n, value in enumerate(state) if isinstance(value, np.ndarray)]
+        for n in arrays:
+            np.save(os.path.join(index_dir, 'tree_{}.npy'.format(n)), state[n])
+        with open(os.path.join(index_dir, 'index.json'), 'w') as f:
+            json.dump({
+                'scipy_version': scipy.__version__,
+                'n': self.tree.n,
+                'state': [None if isinstance(value, np.ndarray) else value for value in state],
+                'arrays': arrays
+            }, f)
+
+    @classmethod
+    def load(cls, index_dir, mmap=True):
+        """
+        Load index saved by save
+
+        Args:
+            index_dir (str): directory of saved index
+            mmap (bool): if True, memory-map the saved arrays rather than reading them into memory
+
+        Returns:
+            (CatalogIndex) loaded index
+        """
+        with open(os.path.join(index_dir, 'index.json'), 'r') as f:
+            meta = json.load(f)
+        mmap_mode = 'r' if mmap else None
+        state = list(meta['state'])
+        for n in meta['arrays']:
+            state[n] = np.load(os.path.join(index_dir, 'tree_{}.npy'.format(n)), mmap_mode=mmap_mode)
+        if meta['scipy_version'] != scipy.__version__:
+            # the saved tree layout is scipy's own, so only trust it with the same scipy. The data (state[1]) is fine.
+            logging.warning('Index saved with scipy {}, not {} - rebuilding tree'.format(meta['scipy_version'], scipy.__version__))
+            return cls(None, None, tree=cKDTree(state[1], balanced_tree=False))
+        tree = cKDTree.__new__(cKDTree)
+        tree.__setstate__(tuple(state))
+        return cls(None, None, tree=tree)
+
+
+def radec_to_xyz(ra, dec):
+    """
+    Args:
+        ra (np.array): right ascensions, in degrees (if no units)
+        dec (np.array): declinations, in degrees (if no units)
+
+    Returns:
+        (np.array) of shape (n, 3), unit vectors
+    """
+    ra = units.Quantity(_column_values(ra), units.deg).to(units.rad).value
+    dec = units.Quantity(_column_values(dec), units.deg).to(units.rad).value
+    cos_dec = np.cos(dec)
+    return np.stack([cos_dec * np.cos(ra), cos_dec * np.sin(ra), np.sin(dec)], axis=-1).reshape(-1, 3)
+
+
+def chord_to_angle(chord):
+    # distance between two unit vectors, to the angle between them (radians)
+    return 2. * np.arcsin(np.clip(chord / 2., 0., 1.))
+
+
+def angle_to_chord(angle):
+    # angle between two unit vectors (radians), to the distance between them
+    return 2. * np.sin(np.minimum(angle, np.pi) / 2.)
+
+
+def _column_values(values):
+    # astropy Columns with units become Quantities, pandas Series become arrays, anything else is left alone
+    if isinstance(values, table.Column) and values.unit is not None:
+        return values.quantity
+    if isinstance(values, pd.Series):
+        return values.values
+    return values
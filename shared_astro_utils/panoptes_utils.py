@@ -1,12 +1,39 @@
 
 import logging
+import os
 
 import json
 
 import pandas as pd
+import pyarrow as pa
+import pyarrow.parquet as pq
 
+from shared_astro_utils import columnar_utils
 
-def load_current_subjects(df, workflow=None, subject_set=None, save_loc=None):
+try:
+    import orjson  # optional, for faster parsing
+except ImportError:
+    orjson = None
+
+WATERMARK_FILE = '_watermark.json'
+
+
+def load_current_subjects(df, workflow=None, subject_set=None, save_loc=None, vectorized=True):
+    """
+    Expand the metadata and locations of a Panoptes subject export into columns, with Talk-friendly names
+
+    Args:
+        df (pd.DataFrame): Panoptes subject export, with json str 'metadata' and 'locations' columns
+        workflow (int): not used
+        subject_set (int): not used
+        save_loc (str): if not None, save the expanded subjects as csv here
+        vectorized (bool): if True, parse each json column in one pass and rename all columns at once.
+            If False, use the original (slow) row-by-row implementation. Both give the same result.
+
+    Returns:
+        (pd.DataFrame) subjects, with one column per metadata key (hidden '!' keys renamed without the '!')
+        and locations replaced by the first location url
+    """
     # if workflow is not None:
     #     df = df[df['workflow_id'] == workflow]
     # if subject_set is not None:
@@ -15,7 +42,272 @@ def load_current_subjects(df, workflow=None, subject_set=None, save_loc=None):
         logging.critical('Attempting to load subjects from empty dataframe')
         raise ValueError
 
-    df_with_metadata = split_json_str_to_columns(df, 'metadata')
+    if vectorized:
+        df_with_metadata = expand_subjects(df)
+    else:
+        df_with_metadata = load_current_subjects_rowwise(df)
+
+    df_with_metadata = df_with_metadata.rename(columns={'0': 'locations'})
+    assert len(df_with_metadata) == len(df)
+
+    if save_loc is not None:
+        df_with_metadata.to_csv(save_loc)
+
+    return df_with_metadata
+
+
+def stream_current_subjects(export_loc, save_loc, usecols=None, metadata_keys=None, chunk_size=100000, file_format=None):
+    """
+    Expand a Panoptes subject export csv, like load_current_subjects, without loading the whole export into memory.
+    The export is read and expanded chunk_size rows at a time, and each chunk appended to a Parquet, Feather or csv
+    file at save_loc. Peak memory scales with chunk_size, not with the size of the export.
+
+    The saved schema is set by the first chunk and widened by later chunks (see columnar_utils.ChunkedTableWriter):
+    int, float and bool columns keep their type, and everything else is saved as strings. Metadata keys which first
+    appear in later chunks are added, and columns which change type (e.g. an int key with a float value later on)
+    are saved as floats or strings, so no values are lost. Unlike load_current_subjects, empty columns are kept.
+
+    Args:
+        export_loc (str): location of Panoptes subject export csv
+        save_loc (str): location to save expanded subjects e.g. 'subjects.parquet'
+        usecols (list): if not None, only keep these export columns. 'metadata' and 'locations' are always read,
+            but the raw metadata json is only saved if included here.
+        metadata_keys (list): if not None, only keep these metadata keys (without any '!')
+        chunk_size (int): export rows to read and expand at a time
+        file_format (str): 'parquet', 'feather' or 'csv'. If None, infer from save_loc.
+
+    Returns:
+        (int) number of subjects saved
+    """
+    read_cols = None
+    if usecols is not None:
+        read_cols = list(dict.fromkeys(list(usecols) + ['metadata', 'locations']))
+
+    with columnar_utils.ChunkedTableWriter(save_loc, file_format=file_format) as writer:
+        for chunk in pd.read_csv(export_loc, usecols=read_cols, chunksize=chunk_size):
+            writer.write(expand_selected_subjects(chunk, usecols, metadata_keys))
+            logging.info('Saved {} subjects to {}'.format(writer.n_rows, save_loc))
+
+    if writer.n_rows == 0:
+        logging.critical('Attempting to load subjects from empty export {}'.format(export_loc))
+        raise ValueError
+    return writer.n_rows
+
+
+def ingest_new_subjects(
+        export_loc,
+        table_dir,
+        watermark_col='subject_id',
+        upsert=False,
+        key_col='subject_id',
+        usecols=None,
+        metadata_keys=None,
+        chunk_size=100000):
+    """
+    Add subjects that are new since the last ingest to a stored table of expanded subjects, so that refreshing
+    from a new export only expands (parses the metadata of) the new rows.
+
+    The table is a directory of Parquet part files (one per chunk of new rows) plus a watermark file recording
+    the highest watermark_col value ingested so far. Rows at or below the watermark are skipped before any parsing.
+    The first ingest into an empty table_dir ingests every row. Later parts may widen the table schema, adding new
+    metadata keys or changing column types, as in stream_current_subjects. Parts are not rewritten, and are converted
+    to the latest schema when loaded (see load_ingested_subjects).
+    Parts and the watermark are written atomically, so a failed ingest can simply be re-run.
+
+    Args:
+        export_loc (str): location of Panoptes subject export csv
+        table_dir (str): directory of stored subject table. Created if it does not exist.
+        watermark_col (str): export column which increases for new subjects e.g. 'subject_id' or 'created_at'
+        upsert (bool): if True, also re-ingest rows equal to the watermark, and replace any stored rows with the same
+            key_col value. Use with a watermark_col (like 'created_at') which several subjects may share.
+        key_col (str): export column which uniquely identifies each subject, for upsert
+        usecols (list): if not None, only keep these export columns. See stream_current_subjects.
+        metadata_keys (list): if not None, only keep these metadata keys. See stream_current_subjects.
+        chunk_size (int): export rows to read at a time
+
+    Returns:
+        (int) number of subjects ingested
+    """
+    if not os.path.isdir(table_dir):
+        os.makedirs(table_dir)
+    watermark = read_watermark(table_dir)
+    if watermark is not None and watermark['column'] != watermark_col:
+        raise ValueError('Table {} has a watermark on {}, not {}'.format(table_dir, watermark['column'], watermark_col))
+    parts = watermark['parts'] if watermark is not None else []
+    _remove_unrecorded_parts(table_dir, parts)
+    # each part is written with the schema of the one before, widened as needed, so the last is the widest
+    schema = pq.read_schema(os.path.join(table_dir, parts[-1])) if parts else None
+    watermark_value = _parse_watermark_value(watermark['value']) if watermark is not None else None
+
+    read_cols = None
+    if usecols is not None:
+        usecols = list(dict.fromkeys(list(usecols) + [key_col]))  # always store the key, for upserts
+        read_cols = list(dict.fromkeys(usecols + ['metadata', 'locations', watermark_col]))
+
+    n_new = 0
+    new_max = watermark_value
+    for chunk in pd.read_csv(export_loc, usecols=read_cols, chunksize=chunk_size):
+        chunk_watermarks = _watermark_values(chunk[watermark_col])
+        if watermark_value is not None:
+            is_new = chunk_watermarks >= watermark_value if upsert else chunk_watermarks > watermark_value
+            chunk = chunk[is_new.values]
+            chunk_watermarks = chunk_watermarks[is_new.values]
+        if chunk.empty:
+            continue
+        subjects = expand_selected_subjects(chunk, usecols, metadata_keys)
+        if upsert and parts:
+            _delete_stored_rows(table_dir, parts, key_col, set(chunk[key_col]))
+        part = 'part-{:06d}.parquet'.format(_next_part_number(parts))
+        tmp_loc = os.path.join(table_dir, '.' + part + '.tmp')
+        with columnar_utils.ChunkedTableWriter(tmp_loc, file_format='parquet', schema=schema) as writer:
+            writer.write(subjects)
+        schema = writer.schema
+        os.replace(tmp_loc, os.path.join(table_dir, part))
+        parts.append(part)
+        n_new += len(subjects)
+        chunk_max = chunk_watermarks.max()
+        new_max = chunk_max if new_max is None else max(new_max, chunk_max)
+        # only now is the part part of the table, so a crash before here leaves the table as it was
+        _write_watermark(table_dir, watermark_col, new_max, parts)
+
+    logging.info('Ingested {} new subjects into {} (watermark {} = {})'.format(n_new, table_dir, watermark_col, new_max))
+    return n_new
+
+
+def load_ingested_subjects(table_dir, columns=None):
+    """
+    Load the subject table built by ingest_new_subjects. Parts written before the schema was last widened
+    (e.g. before a new metadata key appeared) are converted to the latest schema, with nulls for any missing columns.
+
+    Args:
+        table_dir (str): directory of stored subject table
+        columns (list): if not None, only read these columns
+
+    Returns:
+        (pd.DataFrame) subjects, in the order ingested
+    """
+    watermark = read_watermark(table_dir)
+    if watermark is None or not watermark['parts']:
+        raise FileNotFoundError('No subjects have been ingested into {}'.format(table_dir))
+    part_locs = [os.path.join(table_dir, part) for part in watermark['parts']]
+    schema = pq.read_schema(part_locs[-1])
+    if columns is not None:
+        schema = pa.schema([schema.field(col) for col in columns])
+    tables = []
+    for part_loc in part_locs:
+        part_cols = [col for col in schema.names if col in pq.read_schema(part_loc).names]
+        table = pq.read_table(part_loc, columns=part_cols)
+        if not table.schema.equals(schema):
+            table = columnar_utils.conform_table(table, schema)
+        tables.append(table)
+    return pa.concat_tables(tables).to_pandas()
+
+
+def read_watermark(table_dir):
+    """
+    Args:
+        table_dir (str): directory of stored subject table
+
+    Returns:
+        (dict) of form {'column': watermark_col, 'value': highest value ingested, 'parts': [part file names]},
+            or None if nothing has been ingested
+    """
+    watermark_loc = os.path.join(table_dir, WATERMARK_FILE)
+    if not os.path.isfile(watermark_loc):
+        return None
+    with open(watermark_loc, 'r') as f:
+        return json.load(f)
+
+
+def _write_watermark(table_dir, watermark_col, value, parts):
+    if isinstance(value, pd.Timestamp):
+        value = value.isoformat()
+    elif hasattr(value, 'item'):  # numpy scalar
+        value = value.item()
+    tmp_loc = os.path.join(table_dir, '.' + WATERMARK_FILE + '.tmp')
+    with open(tmp_loc, 'w') as f:
+        json.dump({'column': watermark_col, 'value': value, 'parts': parts}, f)
+    os.replace(tmp_loc, os.path.join(table_dir, WATERMARK_FILE))
+
+
+def _watermark_values(values):
+    # ids are compared as numbers, anything else (e.g. created_at) as UTC times
+    if pd.api.types.is_numeric_dtype(values.dtype):
+        return values
+    return pd.to_datetime(values, utc=True)
+
+
+def _parse_watermark_value(value):
+    if isinstance(value, str):
+        return pd.Timestamp(value)
+    return value
+
+
+def _next_part_number(parts):
+    return max([int(part.split('-')[1].split('.')[0]) for part in parts], default=-1) + 1
+
+
+def _remove_unrecorded_parts(table_dir, parts):
+    # parts written by an ingest which failed before updating the watermark
+    for name in os.listdir(table_dir):
+        if (name.endswith('.parquet') and name not in parts) or name.endswith('.tmp'):
+            logging.warning('Removing {} from {}, left by an incomplete ingest'.format(name, table_dir))
+            os.remove(os.path.join(table_dir, name))
+
+
+def _delete_stored_rows(table_dir, parts, key_col, keys):
+    # rewrite (one at a time, so memory is bounded by part size) any part with rows to be replaced
+    for part in parts:
+        part_loc = os.path.join(table_dir, part)
+        stored_keys = pd.read_parquet(part_loc, columns=[key_col])[key_col]
+        is_replaced = stored_keys.isin(keys)
+        if is_replaced.any():
+            table = pq.read_table(part_loc)
+            tmp_loc = os.path.join(table_dir, '.' + part + '.tmp')
+            pq.write_table(table.filter(pa.array(~is_replaced.values)), tmp_loc)
+            os.replace(tmp_loc, part_loc)
+
+
+def expand_selected_subjects(chunk, usecols=None, metadata_keys=None):
+    """
+    Expand a chunk of a subject export, keeping only the selected columns. See stream_current_subjects.
+
+    Args:
+        chunk (pd.DataFrame): rows of Panoptes subject export, with json str 'metadata' and 'locations' columns
+        usecols (list): if not None, only keep these export columns (plus 'index' and 'locations')
+        metadata_keys (list): if not None, only keep these metadata keys, adding any which are missing
+
+    Returns:
+        (pd.DataFrame) expanded subjects, including empty columns
+    """
+    subjects = expand_subjects(chunk, drop_empty=False)
+    if usecols is not None:
+        export_cols = ['index', 'locations'] + list(usecols)
+        subjects = subjects[[col for col in subjects.columns if col not in chunk.columns or col in export_cols]]
+    if metadata_keys is not None:
+        export_cols = [col for col in subjects.columns if col in chunk.columns or col == 'index']
+        subjects = subjects.reindex(columns=export_cols + [key for key in metadata_keys if key not in export_cols])
+    return subjects
+
+
+def expand_subjects(df, drop_empty=True):
+    """
+    Expand metadata and locations json, and rename hidden columns. See load_current_subjects.
+
+    Args:
+        df (pd.DataFrame): Panoptes subject export, with json str 'metadata' and 'locations' columns
+        drop_empty (bool): if True, drop columns with no values
+
+    Returns:
+        (pd.DataFrame) subjects, with one column per metadata key
+    """
+    df_with_metadata = split_json_str_to_columns(df, 'metadata', vectorized=True)
+    df_with_metadata['locations'] = [locations['0'] for locations in parse_json_column(df_with_metadata['locations'])]
+    return rename_hidden_columns(df_with_metadata, drop_empty=drop_empty)
+
+
+def load_current_subjects_rowwise(df):
+    df_with_metadata = split_json_str_to_columns(df, 'metadata', vectorized=False)
     df_with_metadata['locations'] = df_with_metadata['locations'].apply(lambda x: json.loads(x)['0'])
 
     current_hidden_cols = list(filter(lambda x: x.startswith('!'), df_with_metadata.columns.values))
@@ -30,27 +322,89 @@ def load_current_subjects(df, workflow=None, subject_set=None, save_loc=None):
         df_with_metadata = df_with_metadata.drop(old_col, axis=1)
     df_with_metadata = df_with_metadata.dropna(how='all', axis=1)
     # df_renamed = df_with_metadata.rename(columns=dict(zip(current_hidden_cols, new_cols)))
+    return df_with_metadata
 
-    df_with_metadata = df_with_metadata.rename(columns={'0': 'locations'})
-    assert len(df_with_metadata) == len(df)
 
-    if save_loc is not None:
-        df_with_metadata.to_csv(save_loc)
+def rename_hidden_columns(df, drop_empty=True):
+    """
+    Rename hidden ('!') columns without the '!', for Talk, and drop columns which are entirely empty.
+    Builds the new frame once, rather than copying it per column. Matches the column order of the original loop:
+    a hidden column whose new name already exists replaces that column, and otherwise is added at the end.
 
-    return df_with_metadata
+    Args:
+        df (pd.DataFrame): subjects with metadata columns, some hidden
+        drop_empty (bool): if True, drop columns with no values
+
+    Returns:
+        (pd.DataFrame) subjects with hidden columns renamed
+    """
+    columns = {}  # of form {new_name: column}, in final order
+    hidden_cols = []
+    for n, col in enumerate(df.columns):
+        if isinstance(col, str) and col.startswith('!'):
+            hidden_cols.append((col.strip('!'), n))
+        else:
+            columns[col] = df.iloc[:, n]
+    for new_col, n in hidden_cols:
+        columns[new_col] = df.iloc[:, n].rename(new_col)
+    return pd.DataFrame({
+        col: values for col, values in columns.items()
+        if not (drop_empty and values.isna().all())
+    }, index=df.index)
+
+
+def parse_json_column(json_strs):
+    """
+    Parse a column of json strings in one call, rather than one per row.
+    Uses orjson if installed (several times faster), falling back to json for anything orjson rejects e.g. NaN.
+    If the rows don't parse as exactly one value each (e.g. an empty row, or '{},{}'), which would shift every
+    later row onto the wrong values, parse row by row instead, raising a ValueError at the first bad row.
+
+    Args:
+        json_strs (pd.Series): json strings e.g. '{"a": 1}'
+
+    Returns:
+        (list) parsed values, one per row
+    """
+    try:
+        parsed = _loads('[' + ','.join(json_strs) + ']')
+    except ValueError:  # including json.JSONDecodeError and orjson.JSONDecodeError
+        parsed = None
+    if parsed is not None and len(parsed) == len(json_strs):
+        return parsed
+    parsed = []
+    for n, json_str in enumerate(json_strs):
+        try:
+            parsed.append(_loads(json_str))
+        except ValueError as e:
+            raise ValueError('Cannot parse row {} as one json value: {!r}'.format(n, json_str)) from e
+    return parsed
+
+
+def _loads(json_str):
+    if orjson is not None:
+        try:
+            return orjson.loads(json_str)
+        except orjson.JSONDecodeError:
+            pass
+    return json.loads(json_str)
 
 
-def split_json_str_to_columns(input_df, json_column_name):
+def split_json_str_to_columns(input_df, json_column_name, vectorized=True):
     """
     Expand Dataframe column of json string into many columns
     Args:
         input_df (pd.DataFrame): dataframe with json str column
         json_column_name (str): json string column name
+        vectorized (bool): if True, parse the whole column in one pass. If False, parse row by row (slower).
     Returns:
         (pd.DataFrame) input dataframe with json column expanded into many columns
     """
     input_df = input_df.reset_index()  # concat cares about the index, but we want a literal join
-    json_df = pd.DataFrame(list(input_df[json_column_name].apply(json.loads)))
+    if vectorized:
+        json_df = pd.DataFrame(parse_json_column(input_df[json_column_name]))
+    else:
+        json_df = pd.DataFrame(list(input_df[json_column_name].apply(json.loads)))
     new_df = pd.concat([input_df, json_df], axis=1)
     assert len(new_df) == len(input_df)
     return new_df
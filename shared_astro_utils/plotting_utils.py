@@ -1,11 +1,35 @@
 
+import os
+from concurrent.futures import ProcessPoolExecutor
+
 import numpy as np
 import matplotlib
 import matplotlib.pyplot as plt
 import matplotlib.gridspec as gridspec
+from PIL import Image, ImageDraw  # installed with matplotlib
+
+
+SPACING = 0.025  # gap between galaxies, as a fraction of galaxy width (as wspace below)
+LABEL_POSITION = (0.2, 0.8)  # fraction of galaxy (width, height) from top left, as ax.text below
+LABEL_COLOR = (255, 0, 0)
+PNG_COMPRESS_LEVEL = 1  # zlib level for mosaics: several times faster than the default (6), for ~10% larger files
       
 
-def plot_galaxy_grid(galaxies, rows, columns, save_loc, labels=None):
+def plot_galaxy_grid(galaxies, rows, columns, save_loc, labels=None, fast=False):
+        """
+        Save a grid of galaxy images, without whitespace
+
+        Args:
+            galaxies (np.array): of form (n, x, y, channel), with pixel values from 0 to 255 (others are clipped)
+            rows (int): number of rows of galaxies
+            columns (int): number of columns of galaxies
+            save_loc (str): location to save grid image
+            labels (list): if not None, label to show on each galaxy
+            fast (bool): if True, save with save_galaxy_mosaic rather than matplotlib. Much faster, but each galaxy
+                keeps its original size and labels use a small bitmap font.
+        """
+        if fast:
+            return save_galaxy_mosaic(galaxies, rows, columns, save_loc, labels=labels)
         fig = plt.figure(figsize=(columns * 4, rows * 4))  # x, y order
         gs1 = gridspec.GridSpec(rows, columns, fig)  # rows (y), cols (x) order
         gs1.update(wspace=0.025, hspace=0.025)
@@ -13,7 +37,7 @@ def plot_galaxy_grid(galaxies, rows, columns, save_loc, labels=None):
             ax = plt.subplot(gs1[n])
             galaxy = galaxies[n, :, :, :]  # n, x, y, channel, in ML style
             data = galaxy.squeeze()
-            ax.imshow(data.astype(np.uint8))
+            ax.imshow(_to_uint8(data))
             if labels is not None:
                 ax.text(0.2, 0.2, labels[n], transform=ax.transAxes, color='red', fontsize=16)
             ax.grid(False)
@@ -22,3 +46,94 @@ def plot_galaxy_grid(galaxies, rows, columns, save_loc, labels=None):
         # plt.tight_layout()
         plt.savefig(save_loc, bbox_inches='tight')
         plt.close()
+
+
+def galaxy_mosaic(galaxies, rows, columns, labels=None, spacing=SPACING):
+    """
+    Assemble a grid of galaxy images into one image (array), as plot_galaxy_grid(fast=False) would show them
+    but with each galaxy at its original size, without a matplotlib figure.
+    Pixel values are clipped to 0-255 and converted to uint8 (as plot_galaxy_grid) all at once. Missing galaxies are left blank.
+
+    Args:
+        galaxies (np.array): of form (n, x, y, channel), with pixel values from 0 to 255
+        rows (int): number of rows of galaxies
+        columns (int): number of columns of galaxies
+        labels (list): if not None, label to burn in (in red) on each galaxy
+        spacing (float): white gap between galaxies, as a fraction of galaxy width
+
+    Returns:
+        (np.array) uint8 grid image, of form (x, y, channel)
+    """
+    galaxies = galaxies[:rows * columns]
+    n_galaxies, width, height, channels = galaxies.shape
+    gap = int(round(spacing * height))
+    galaxies = _to_uint8(galaxies)
+    # one (white-padded) cell per galaxy, then cells side by side
+    cells = np.full((rows * columns, width + gap, height + gap, channels), 255, dtype=np.uint8)
+    cells[:n_galaxies, :width, :height] = galaxies
+    mosaic = cells.reshape(rows, columns, width + gap, height + gap, channels).transpose(0, 2, 1, 3, 4)
+    mosaic = mosaic.reshape(rows * (width + gap), columns * (height + gap), channels)
+    mosaic = mosaic[:mosaic.shape[0] - gap, :mosaic.shape[1] - gap]  # no gap after the last row and column
+    if labels is not None:
+        image = Image.fromarray(mosaic.squeeze(axis=2) if channels == 1 else mosaic).convert('RGB')
+        draw = ImageDraw.Draw(image)
+        for n, label in enumerate(labels[:rows * columns]):
+            row, column = divmod(n, columns)
+            x = column * (height + gap) + LABEL_POSITION[0] * height
+            y = row * (width + gap) + LABEL_POSITION[1] * width
+            draw.text((x, y), str(label), fill=LABEL_COLOR, anchor='ls')  # left, baseline, as matplotlib
+        mosaic = np.asarray(image)
+    return mosaic
+
+
+def _to_uint8(pixels):
+    # clip, rather than letting out-of-range values wrap around (e.g. 256 to black)
+    return pixels if pixels.dtype == np.uint8 else np.clip(pixels, 0, 255).astype(np.uint8)
+
+
+def save_galaxy_mosaic(galaxies, rows, columns, save_loc, labels=None, spacing=SPACING):
+    """
+    Save a grid of galaxy images (see galaxy_mosaic) as e.g. png or jpeg, without a matplotlib figure
+
+    Args:
+        galaxies (np.array): of form (n, x, y, channel), with pixel values from 0 to 255
+        rows (int): number of rows of galaxies
+        columns (int): number of columns of galaxies
+        save_loc (str): location to save grid image. Format is inferred from the extension.
+        labels (list): if not None, label to burn in (in red) on each galaxy
+        spacing (float): white gap between galaxies, as a fraction of galaxy width
+    """
+    mosaic = galaxy_mosaic(galaxies, rows, columns, labels=labels, spacing=spacing)
+    image = Image.fromarray(mosaic.squeeze(axis=2) if mosaic.shape[2] == 1 else mosaic)
+    image.save(save_loc, compress_level=PNG_COMPRESS_LEVEL)  # ignored by other formats
+
+
+def save_galaxy_mosaics(galaxies, rows, columns, save_locs, labels=None, spacing=SPACING, max_workers=None):
+    """
+    Save many grids of galaxy images (see save_galaxy_mosaic) in a pool of processes.
+    Consecutive galaxies fill each grid in turn: the first rows * columns galaxies go to the first grid, and so on.
+
+    Args:
+        galaxies (np.array): of form (n, x, y, channel) e.g. memory-mapped from fits_utils.load_fits_cube
+        rows (int): number of rows of galaxies per grid
+        columns (int): number of columns of galaxies per grid
+        save_locs (list): location to save each grid image
+        labels (list): if not None, label to burn in (in red) on each galaxy
+        spacing (float): white gap between galaxies, as a fraction of galaxy width
+        max_workers (int): number of processes saving grids at once. If None, one per CPU.
+    """
+    per_grid = rows * columns
+    starts = range(0, per_grid * len(save_locs), per_grid)
+    # a few chunks of grids per process, so processes aren't idle waiting for the next grid
+    chunksize = max(1, len(save_locs) // (4 * (max_workers or os.cpu_count())))
+    with ProcessPoolExecutor(max_workers=max_workers) as executor:
+        list(executor.map(
+            save_galaxy_mosaic,
+            (galaxies[start:start + per_grid] for start in starts),  # only each grid's galaxies are sent
+            [rows] * len(save_locs),
+            [columns] * len(save_locs),
+            save_locs,
+            (labels[start:start + per_grid] if labels is not None else None for start in starts),
+            [spacing] * len(save_locs),
+            chunksize=chunksize
+        ))
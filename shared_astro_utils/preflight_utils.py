@@ -0,0 +1,186 @@
+import logging
+import os
+import struct
+import collections
+from concurrent.futures import ThreadPoolExecutor
+
+# Zooniverse recommends subject images of at most 1MB, and large images are slow for volunteers to load
+MAX_SUBJECT_BYTES = 1024 * 1024
+
+# problems found by check_location, in the order they are checked
+MISSING = 'missing'
+NOT_A_FILE = 'not_a_file'
+EMPTY = 'empty'
+TOO_LARGE = 'too_large'
+UNREADABLE = 'unreadable'
+BAD_HEADER = 'bad_header'
+
+HEADER_BYTES = 32  # enough for the PNG signature and IHDR chunk
+
+
+def check_location(location, max_bytes=MAX_SUBJECT_BYTES):
+    """
+    Check that a subject image exists, is non-empty, is under max_bytes, is readable, and has a valid image header.
+    Only the first few bytes are read, so this is cheap even on a network filesystem.
+
+    Args:
+        location (str): path to subject image
+        max_bytes (int): max. allowed file size. If None, any size is allowed.
+
+    Returns:
+        (str) first problem found e.g. 'missing', or None if the image looks fine
+    """
+    try:
+        stat = os.stat(location)
+    except FileNotFoundError:
+        return MISSING
+    except OSError:
+        return UNREADABLE
+    if not os.path.isfile(location):
+        return NOT_A_FILE
+    if stat.st_size == 0:
+        return EMPTY
+    if max_bytes is not None and stat.st_size > max_bytes:
+        return TOO_LARGE
+    try:
+        with open(location, 'rb') as f:
+            header = f.read(HEADER_BYTES)
+    except OSError:
+        return UNREADABLE
+    if image_format(header) is None:
+        return BAD_HEADER
+    return None
+
+
+def image_format(header):
+    """
+    Identify an image from the first bytes of the file. Only formats Panoptes accepts as subject images are recognised.
+
+    Args:
+        header (bytes): first (up to HEADER_BYTES) bytes of file
+
+    Returns:
+        (str) 'png', 'jpeg' or 'gif', or None if header is not a valid header of any of these
+    """
+    if header.startswith(b'\x89PNG\r\n\x1a\n'):
+        # the first chunk must be IHDR, with non-zero width and height
+        if len(header) < 24 or header[12:16] != b'IHDR':
+            return None
+        width, height = struct.unpack('>II', header[16:24])
+        return 'png' if width > 0 and height > 0 else None
+    if header.startswith(b'\xff\xd8\xff'):
+        return 'jpeg'
+    if header[:6] in (b'GIF87a', b'GIF89a'):
+        return 'gif'
+    return None
+
+
+def check_locations(locations, max_bytes=MAX_SUBJECT_BYTES, max_workers=32):
+    """
+    Check many subject images in parallel with check_location.
+    Threads, because checks spend nearly all their time waiting on the (network) filesystem.
+
+    Args:
+        locations (iterable): paths to subject images. Duplicates are checked once.
+        max_bytes (int): max. allowed file size. If None, any size is allowed.
+        max_workers (int): number of threads checking files at once
+
+    Returns:
+        (dict) of form {location: problem} for each location with a problem. Empty if all locations are fine.
+    """
+    unique_locations = list(dict.fromkeys(locations))
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = executor.map(lambda location: check_location(location, max_bytes=max_bytes), unique_locations)
+        return {location: problem for location, problem in zip(unique_locations, results) if problem is not None}
+
+
+def summarise_problems(n_checked, problems, n_examples=5):
+    """
+    Compact report of check_locations results, suitable for logging
+
+    Args:
+        n_checked (int): number of locations checked
+        problems (dict): of form {location: problem}, from check_locations
+        n_examples (int): max. example locations to include for each kind of problem
+
+    Returns:
+        (dict) of form {'checked': int, 'bad': int, 'problems': {problem: count}, 'examples': {problem: [location, ...]}}
+    """
+    counts = collections.Counter(problems.values())
+    examples = collections.defaultdict(list)
+    for location, problem in problems.items():
+        if len(examples[problem]) < n_examples:
+            examples[problem].append(location)
+    return {
+        'checked': n_checked,
+        'bad': len(problems),
+        'problems': dict(counts),
+        'examples': dict(examples)
+    }
+
+
+def preflight_manifest(manifest, drop_bad=False, max_bytes=MAX_SUBJECT_BYTES, max_workers=32):
+    """
+    Check every location of every manifest entry before uploading, so that uploads do not fail part-way through
+
+    Args:
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        drop_bad (bool): if True, remove entries with any bad location from the returned manifest
+        max_bytes (int): max. allowed file size. If None, any size is allowed.
+        max_workers (int): number of threads checking files at once
+
+    Returns:
+        (list) manifest entries, without any bad entries if drop_bad
+        (dict) report from summarise_problems, with 'dropped' entries count
+    """
+    manifest = list(manifest)
+    locations = [location for entry in manifest for location in entry['locations']]
+    problems = check_locations(locations, max_bytes=max_bytes, max_workers=max_workers)
+    report = summarise_problems(len(set(locations)), problems)
+    if drop_bad and problems:
+        good_manifest = [
+            entry for entry in manifest
+            if not any(location in problems for location in entry['locations'])
+        ]
+        report['dropped'] = len(manifest) - len(good_manifest)
+        manifest = good_manifest
+    else:
+        report['dropped'] = 0
+    log_report(report)
+    return manifest, report
+
+
+def preflight_catalog(catalog, location_col='file_loc', drop_bad=False, max_bytes=MAX_SUBJECT_BYTES, max_workers=32):
+    """
+    Check the image of every catalog row before uploading, so that uploads do not fail part-way through
+
+    Args:
+        catalog (pd.DataFrame): catalog of galaxies to be uploaded
+        location_col (str): column of catalog with the path to each galaxy image
+        drop_bad (bool): if True, remove rows with bad images from the returned catalog
+        max_bytes (int): max. allowed file size. If None, any size is allowed.
+        max_workers (int): number of threads checking files at once
+
+    Returns:
+        (pd.DataFrame) catalog, without any bad rows if drop_bad
+        (dict) report from summarise_problems, with 'dropped' rows count
+    """
+    locations = catalog[location_col]
+    problems = check_locations(locations, max_bytes=max_bytes, max_workers=max_workers)
+    report = summarise_problems(locations.nunique(), problems)
+    if drop_bad and problems:
+        is_bad = locations.isin(problems.keys())
+        report['dropped'] = int(is_bad.sum())
+        catalog = catalog[~is_bad]
+    else:
+        report['dropped'] = 0
+    log_report(report)
+    return catalog, report
+
+
+def log_report(report):
+    if report['bad']:
+        logging.warning('Pre-flight check found {} bad of {} subject images ({} entries dropped): {}'.format(
+            report['bad'], report['checked'], report['dropped'], report))
+    else:
+        logging.info('Pre-flight check passed all {} subject images'.format(report['checked']))
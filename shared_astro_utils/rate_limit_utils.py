@@ -0,0 +1,294 @@
+import logging
+import random
+import re
+import threading
+import time
+
+import requests
+import urllib3
+from panoptes_client import panoptes
+
+
+# panoptes_client reports 5xx responses only by message, without the response
+PANOPTES_STATUS_MESSAGE = re.compile(r'^Received HTTP status code (\d{3}) from API$')
+
+
+class TokenBucket():
+    """
+    Allow at most `rate` calls per second on average, with bursts of up to `burst` calls. Thread-safe.
+    """
+
+    def __init__(self, rate, burst=None):
+        """
+        Args:
+            rate (float): tokens added per second
+            burst (float): max. tokens stored. Defaults to rate (i.e. one second's worth).
+        """
+        self.rate = rate
+        self.burst = burst if burst is not None else max(rate, 1.)
+        self._tokens = self.burst
+        self._last_refill = time.monotonic()
+        self._lock = threading.Lock()
+
+    def acquire(self):
+        """
+        Take one token, sleeping until one is available.
+
+        Returns:
+            (float) seconds spent waiting
+        """
+        with self._lock:
+            now = time.monotonic()
+            self._tokens = min(self.burst, self._tokens + (now - self._last_refill) * self.rate)
+            self._last_refill = now
+            # reserve a token, going into debt if need be, so concurrent callers queue up fairly
+            self._tokens -= 1
+            wait = -self._tokens / self.rate if self._tokens < 0 else 0.
+        if wait > 0:
+            time.sleep(wait)
+        return wait
+
+    def set_rate(self, rate):
+        with self._lock:
+            self.rate = rate
+
+
+class AdaptiveRateLimiter():
+    """
+    Rate limit and retry calls to an API, e.g. Panoptes writes.
+
+    Calls wait for a TokenBucket token. Failed calls are retried if transient (throttling, 5xx, dropped connections),
+    after an exponential backoff with full jitter. Calls that create objects (see call_create) are only retried if the
+    server cannot have acted on them (throttling, or failing to connect), so retries never create duplicates. In adaptive mode, throttling or server errors also cut the
+    request rate by backoff_factor, and each success ramps it back up by recovery_step, up to max_rate.
+
+    Counters (see stats) record retries, throttling responses, and time spent throttled or backing off.
+    """
+
+    def __init__(
+            self,
+            max_rate=10.,
+            burst=None,
+            adaptive=True,
+            min_rate=0.2,
+            backoff_factor=0.5,
+            recovery_step=None,
+            max_retries=5,
+            base_delay=1.,
+            max_delay=60.):
+        """
+        Args:
+            max_rate (float): max. requests per second
+            burst (float): max. requests in a burst. Defaults to max_rate.
+            adaptive (bool): if True, lower the rate on throttling and server errors, and raise it again on success
+            min_rate (float): lowest requests per second that adaptive mode will drop to
+            backoff_factor (float): multiply the rate by this on each throttling or server error
+            recovery_step (float): add this to the rate on each success. Defaults to max_rate / 20.
+            max_retries (int): max. retries of each call before re-raising the error
+            base_delay (float): backoff before the first retry is up to this many seconds, doubling for each retry
+            max_delay (float): max. backoff before any retry, in seconds
+        """
+        self.max_rate = max_rate
+        self.adaptive = adaptive
+        self.min_rate = min_rate
+        self.backoff_factor = backoff_factor
+        self.recovery_step = recovery_step if recovery_step is not None else max_rate / 20.
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.bucket = TokenBucket(max_rate, burst)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    @property
+    def rate(self):
+        return self.bucket.rate
+
+    def call(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) under the rate limit, retrying transient errors.
+        Only for calls that are safe to repeat, e.g. linking subjects. Use call_create for calls which create objects.
+
+        Args:
+            func (callable): API call to make
+
+        Returns:
+            whatever func returns
+        """
+        return self._call(func, args, kwargs, idempotent=True)
+
+    def call_create(self, func, *args, **kwargs):
+        """
+        Call func(*args, **kwargs) under the rate limit, retrying only errors after which the server cannot
+        have created anything: throttling, or failing to connect. A 5xx error may come after the object was created,
+        so is not retried (panoptes_client already retries saves internally).
+
+        Args:
+            func (callable): API call which creates an object e.g. a new subject's save
+
+        Returns:
+            whatever func returns
+        """
+        return self._call(func, args, kwargs, idempotent=False)
+
+    def _call(self, func, args, kwargs, idempotent):
+        attempt = 0
+        while True:
+            waited = self.bucket.acquire()
+            self._count('calls', 1)
+            self._count('throttled_seconds', waited)
+            try:
+                result = func(*args, **kwargs)
+            except Exception as e:
+                if not is_transient_error(e, idempotent=idempotent) or attempt >= self.max_retries:
+                    self._count('failures', 1)
+                    raise
+                if is_throttling_error(e):
+                    self._count('throttle_responses', 1)
+                if self.adaptive:
+                    self.slow_down()
+                delay = self.backoff_delay(attempt)
+                logging.warning('Transient API error, retrying in {:.1f}s (attempt {}): {}'.format(delay, attempt + 1, e))
+                self._count('retries', 1)
+                self._count('backoff_seconds', delay)
+                time.sleep(delay)
+                attempt += 1
+            else:
+                if self.adaptive:
+                    self.speed_up()
+                return result
+
+    def backoff_delay(self, attempt):
+        """
+        Args:
+            attempt (int): number of retries already made
+
+        Returns:
+            (float) seconds to wait before the next retry: uniform between 0 and the exponential backoff ("full jitter")
+        """
+        return random.uniform(0., min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    def slow_down(self):
+        self.bucket.set_rate(max(self.min_rate, self.rate * self.backoff_factor))
+
+    def speed_up(self):
+        self.bucket.set_rate(min(self.max_rate, self.rate + self.recovery_step))
+
+    @property
+    def stats(self):
+        with self._stats_lock:
+            stats = dict(self._stats)
+        stats['rate'] = self.rate
+        return stats
+
+    def reset_stats(self):
+        with self._stats_lock:
+            self._stats = {
+                'calls': 0,
+                'retries': 0,
+                'failures': 0,
+                'throttle_responses': 0,
+                'throttled_seconds': 0.,
+                'backoff_seconds': 0.
+            }
+
+    def _count(self, name, value):
+        with self._stats_lock:
+            self._stats[name] += value
+
+
+def is_transient_error(e, idempotent=True):
+    """
+    Args:
+        e (Exception): error raised by an API call
+        idempotent (bool): if False, the call creates objects, so is only safe to retry if the server cannot have acted
+
+    Returns:
+        (bool) True if retrying the call might succeed: throttling, a server (5xx) error, or a dropped connection.
+            If not idempotent, only throttling or failing to connect.
+    """
+    if not idempotent:
+        return is_throttling_error(e) or is_unsent_error(e)
+    if isinstance(e, (requests.exceptions.ConnectionError, requests.exceptions.Timeout)):
+        return True
+    if isinstance(e, (panoptes.PanoptesAPIException, requests.exceptions.HTTPError)):
+        status = http_status(e)
+        return is_throttling_error(e) or (status is not None and status >= 500)
+    return False
+
+
+def is_throttling_error(e):
+    """
+    Args:
+        e (Exception): error raised by an API call
+
+    Returns:
+        (bool) True if e says we are making too many requests (HTTP 429)
+    """
+    message = str(e).lower()
+    return http_status(e) == 429 or 'too many requests' in message or 'rate limit' in message
+
+
+def is_unsent_error(e):
+    """
+    Args:
+        e (Exception): error raised by an API call
+
+    Returns:
+        (bool) True if e means the request never reached the server (could not connect), so cannot have had any effect
+    """
+    if isinstance(e, requests.exceptions.ConnectTimeout):
+        return True
+    if isinstance(e, requests.exceptions.ConnectionError) and e.args:
+        # requests wraps urllib3's error, whose reason says whether the connection was ever made
+        reason = getattr(e.args[0], 'reason', e.args[0])
+        return isinstance(reason, (urllib3.exceptions.NewConnectionError, urllib3.exceptions.ConnectTimeoutError))
+    return False
+
+
+def http_status(e):
+    """
+    Args:
+        e (Exception): error raised by an API call
+
+    Returns:
+        (int) HTTP status of the failed request, from e.response or (as panoptes_client attaches no response)
+            the exact panoptes_client message for 5xx errors. None if unknown.
+    """
+    response = getattr(e, 'response', None)
+    if response is not None and getattr(response, 'status_code', None) is not None:
+        return response.status_code
+    match = PANOPTES_STATUS_MESSAGE.match(str(e))
+    return int(match.group(1)) if match else None
+
+
+# shared by every Panoptes write (subject save, subject set add, subject set create) in upload_utils and subject_utils
+# replace or reconfigure to change the limits for the whole process
+PANOPTES_WRITE_LIMITER = AdaptiveRateLimiter()
+
+
+def panoptes_write(func, *args, **kwargs):
+    """
+    Make a Panoptes write which is safe to repeat (e.g. linking subjects) through the shared PANOPTES_WRITE_LIMITER
+
+    Args:
+        func (callable): Panoptes call e.g. subject_set.add
+
+    Returns:
+        whatever func returns
+    """
+    return PANOPTES_WRITE_LIMITER.call(func, *args, **kwargs)
+
+
+def panoptes_create(func, *args, **kwargs):
+    """
+    Make a Panoptes write which creates an object (e.g. a new subject's save) through the shared
+    PANOPTES_WRITE_LIMITER, retrying only errors which cannot have created it (see AdaptiveRateLimiter.call_create)
+
+    Args:
+        func (callable): Panoptes call e.g. subject.save
+
+    Returns:
+        whatever func returns
+    """
+    return PANOPTES_WRITE_LIMITER.call_create(func, *args, **kwargs)
@@ -1,61 +1,253 @@
 
 import os
+import re
+import time
 import logging
 import json
+import threading
+import collections
 from typing import List, Dict
 
 from panoptes_client import Panoptes, Project, SubjectSet, Subject, panoptes
 
+from shared_astro_utils import journal_utils, time_utils, rate_limit_utils
 
-def authenticate():  # inplace
-    this_dir = os.path.split(__file__)[0]  # neaten
-    login_loc = os.path.join(this_dir, "secret_login.json")
-    with open(login_loc, 'r') as f:
-        credentials = json.load(f)
-    Panoptes.connect(**credentials)
+# where to find Panoptes credentials, if not passed explicitly
+LOGIN_LOC_ENV_VAR = 'PANOPTES_LOGIN_LOC'
+DEFAULT_LOGIN_LOC = os.path.join(os.path.split(__file__)[0], 'secret_login.json')
 
+_session = {'client': None, 'login_loc': None}  # one authenticated client per process
+_session_lock = threading.Lock()
 
-def upload_subject(locations: List, project: Project, subject_set_name: str, metadata: Dict, max_retries=5):
+# panoptes_client raises 4xx errors with only the message(s) from the API or its OAuth server, not the status
+AUTH_ERROR_MESSAGES = re.compile(
+    r'unauthori[sz]ed|not authorized|not logged in|must be logged in|invalid_grant|invalid_token'
+    r'|access token (is invalid|expired|was revoked)',
+    re.IGNORECASE)
+
+# resolved subject sets are reused for this many seconds before being re-fetched
+SUBJECT_SET_CACHE_TTL = 600.
+
+_subject_set_cache = {}  # of form {(project_id, name): (subject_set, time resolved)}
+_subject_set_locks = collections.defaultdict(threading.Lock)  # one per (project_id, name)
+_subject_set_locks_lock = threading.Lock()  # guards creating the per-key locks
+
+
+def authenticate(login_loc=None):  # inplace
+    """
+    Make this thread use the process-wide authenticated Panoptes client, logging in only if not already connected.
+
+    Args:
+        login_loc (str): path to json file of form {"username": ..., "password": ...}.
+            Defaults to $PANOPTES_LOGIN_LOC if set, else secret_login.json in this directory.
+
+    Returns:
+        (panoptes_client.Panoptes) authenticated client
+    """
+    client = get_client(login_loc)
+    # Panoptes keeps one client per thread (see Panoptes.connect). Install the shared one for this thread as
+    # `with client:` does, but for the rest of the thread rather than one block.
+    client.__enter__()
+    return client
+
+
+def get_client(login_loc=None):
+    """
+    Get the process-wide authenticated Panoptes client, connecting on first use.
+    Expired bearer tokens are refreshed lazily, and if the refresh fails the client logs in again from scratch.
+    Time spent authenticating is recorded under 'panoptes_auth' in time_utils.TIMINGS.
+
+    Args:
+        login_loc (str): path to json file of form {"username": ..., "password": ...}.
+            Defaults to $PANOPTES_LOGIN_LOC if set, else secret_login.json in this directory.
+            Connecting with a different login_loc to the current session replaces the session.
+
+    Returns:
+        (panoptes_client.Panoptes) authenticated client
+    """
+    login_loc = get_login_loc(login_loc)
+    with _session_lock:
+        client = _session['client']
+        if client is None or _session['login_loc'] != login_loc:
+            return _connect(login_loc)
+        if client.bearer_token is not None and not client.valid_bearer_token():
+            try:
+                with time_utils.TIMINGS.timed('panoptes_auth'):
+                    client.get_bearer_token()  # refreshes
+            except panoptes.PanoptesAPIException as e:
+                logging.warning(f'Could not refresh Panoptes token, logging in again: {e}')
+                return _connect(login_loc)
+        return client
+
+
+def reauthenticate(login_loc=None):
+    """
+    Drop the current session and log in again e.g. after an authentication error
+
+    Args:
+        login_loc (str): as for authenticate. Defaults to the current session's login_loc.
+
+    Returns:
+        (panoptes_client.Panoptes) newly authenticated client
+    """
+    with _session_lock:
+        if login_loc is None:
+            login_loc = _session['login_loc']
+        _session['client'] = None
+    return authenticate(login_loc)
+
+
+def is_auth_error(e):
+    """
+    Args:
+        e (Exception): exception raised by a Panoptes request
+
+    Returns:
+        (bool) True if e is an authentication failure (HTTP 401 or 403, or one of AUTH_ERROR_MESSAGES),
+            which logging in again may fix
+    """
+    return rate_limit_utils.http_status(e) in (401, 403) or AUTH_ERROR_MESSAGES.search(str(e)) is not None
+
+
+def get_login_loc(login_loc=None):
+    if login_loc is not None:
+        return login_loc
+    return os.environ.get(LOGIN_LOC_ENV_VAR, DEFAULT_LOGIN_LOC)
+
+
+def _connect(login_loc):
+    # must hold _session_lock
+    with time_utils.TIMINGS.timed('panoptes_auth'):
+        with open(login_loc, 'r') as f:
+            credentials = json.load(f)
+        client = Panoptes.connect(**credentials)
+    logging.info('Connected to Panoptes with {}'.format(login_loc))
+    _session['client'] = client
+    _session['login_loc'] = login_loc
+    return client
+
+
+def upload_subject(locations: List, project: Project, subject_set_name: str, metadata: Dict, max_retries=5, journal=None):
     assert '!filename' in metadata.keys(), 'Metadata must contain !filename for BAJOR'
-    
-    subject = Subject()
-    # add files
-    subject.links.project = project
-    for location in locations:
-        if not os.path.isfile(location):
-            raise FileNotFoundError('Missing subject location: {}'.format(location))
-        subject.add_location(location)
 
-    subject.metadata.update(metadata)
-    subject.save()
+    # with a journal, never re-save a subject that a previous (interrupted) run already saved
+    subject_id = None
+    if journal is not None:
+        key = journal_utils.manifest_entry_key(metadata)
+        if journal.is_linked(key):
+            return journal.subject_id(key)
+        subject_id = journal.subject_id(key)
+
+    if subject_id is None:
+        subject = Subject()
+        # add files
+        subject.links.project = project
+        for location in locations:
+            if not os.path.isfile(location):
+                raise FileNotFoundError('Missing subject location: {}'.format(location))
+            subject.add_location(location)
+
+        subject.metadata.update(metadata)
+        rate_limit_utils.panoptes_create(subject.save)
+        subject_id = subject.id
+        if journal is not None:
+            journal.record_saved(key, subject_id)
 
     subject_set_name = subject_set_name
     
+    attempt = 0
     while max_retries > 0:
         try:
             subject_set = get_or_create_subject_set(project.id, subject_set_name)
-            subject_set.add(subject)
-            return subject.id
+            rate_limit_utils.panoptes_write(subject_set.add, subject_id)  # accepts ids as well as Subjects
+            if journal is not None:
+                journal.record_linked([key])
+            return subject_id
         except panoptes.PanoptesAPIException as e:  # Stale SubjectSet, need to re-fetch
             logging.error(f'Error adding subject to subject set, retrying: {e}')
+            invalidate_subject_set(project.id, subject_set_name)
+            if is_auth_error(e):
+                reauthenticate()
             max_retries -= 1
+            if max_retries > 0:
+                # back off rather than immediately re-fetching (the limiter has already retried any transient errors)
+                time.sleep(rate_limit_utils.PANOPTES_WRITE_LIMITER.backoff_delay(attempt))
+                attempt += 1
     raise Exception('Failed to add subject to subject set')
 
 
 def make_subject_sets(project_id: int, names: List):
     # to avoid threading issues where I might try to make the same subject set twice, make them all at the start
-    for name in names:
-        return get_or_create_subject_set(project_id, name)
+    # (get_or_create_subject_set is thread-safe, but separate worker processes do not share its cache)
+    return [get_or_create_subject_set(project_id, name) for name in names]
+
+
+def get_or_create_subject_set(project_id: int, name: str, ttl=None):
+    """
+    Get subject set by display name, creating it if it does not exist.
+    Resolved subject sets are cached process-wide for ttl seconds, so repeated calls (e.g. once per subject)
+    do not each query the API. Thread-safe: concurrent calls for the same subject set resolve (or create) it once.
+
+    Args:
+        project_id (int): project of subject set
+        name (str): display name of subject set
+        ttl (float): seconds to reuse a cached subject set for. Defaults to SUBJECT_SET_CACHE_TTL. 0 to always re-fetch.
+
+    Returns:
+        (panoptes_client.SubjectSet) subject set
+    """
+    if ttl is None:
+        ttl = SUBJECT_SET_CACHE_TTL
+    key = (str(project_id), name)  # project ids may arrive as str (from Project.id) or int
 
+    subject_set = _get_cached_subject_set(key, ttl)
+    if subject_set is not None:
+        return subject_set
 
-def get_or_create_subject_set(project_id: int, name: str):
-    # copied from shared_astro_utils
-    # check if subject set already exists
+    with _subject_set_lock(key):
+        # another thread may have resolved it while we waited for the lock
+        subject_set = _get_cached_subject_set(key, ttl)
+        if subject_set is not None:
+            return subject_set
+        # copied from shared_astro_utils
+        # check if subject set already exists
+        try:
+            subject_set = get_subject_set(project_id, name)
+        except ValueError:
+            logging.info(f'Didnt find subject set {name} - creating it')
+            subject_set = create_subject_set(project_id, name)
+        _subject_set_cache[key] = (subject_set, time.monotonic())
+        return subject_set
+
+
+def invalidate_subject_set(project_id: int, name: str):
+    """
+    Forget any cached subject set, so the next get_or_create_subject_set re-fetches it (e.g. if stale)
+
+    Args:
+        project_id (int): project of subject set
+        name (str): display name of subject set
+    """
+    _subject_set_cache.pop((str(project_id), name), None)
+
+
+def clear_subject_set_cache():
+    _subject_set_cache.clear()
+
+
+def _get_cached_subject_set(key, ttl):
     try:
-        return get_subject_set(project_id, name)
-    except ValueError:
-        logging.info(f'Didnt find subject set {name} - creating it')
-        return create_subject_set(project_id, name)
+        subject_set, resolved_at = _subject_set_cache[key]
+    except KeyError:
+        return None
+    if time.monotonic() - resolved_at < ttl:
+        return subject_set
+    return None
+
+
+def _subject_set_lock(key):
+    with _subject_set_locks_lock:
+        return _subject_set_locks[key]
 
 
 def get_subject_set(project_id: int, name: str):
@@ -70,5 +262,5 @@ def create_subject_set(project_id: int, name: str):
     subject_set = SubjectSet()
     subject_set.links.project = Project(project_id)
     subject_set.display_name = name
-    subject_set.save()
+    rate_limit_utils.panoptes_create(subject_set.save)
     return subject_set
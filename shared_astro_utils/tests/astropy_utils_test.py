@@ -0,0 +1,230 @@
+import os
+
+import pytest
+
+import numpy as np
+import pyarrow.parquet as pq
+from astropy import units
+from astropy.io import fits
+from astropy.table import Table, MaskedColumn, vstack
+
+from shared_astro_utils import astropy_utils
+
+
+@pytest.fixture()
+def table():
+    n_rows = 1000
+    rng = np.random.RandomState(0)
+    return Table({
+        'iauname': np.array(['J{:06d}'.format(n) for n in range(n_rows)]),
+        'bytes_name': np.array([b'nsa_%d' % n for n in range(n_rows)]),
+        'ra': rng.uniform(0., 360., size=n_rows) * units.deg,
+        'nsa_id': np.arange(n_rows, dtype=np.int32),
+        'is_good': np.arange(n_rows) % 2 == 0,
+        'petroflux': rng.uniform(size=(n_rows, 7)).astype(np.float32),
+        'redshift': MaskedColumn(rng.uniform(size=n_rows), mask=np.arange(n_rows) % 10 == 0),
+        'unwanted': np.zeros(n_rows)
+    })
+
+
+@pytest.fixture()
+def table_loc(tmpdir, table):
+    loc = tmpdir.join('catalog.fits').strpath
+    table.write(loc)
+    return loc
+
+
+def assert_tables_equal(a, b):
+    assert a.colnames == b.colnames
+    for col in a.colnames:
+        assert a[col].dtype.newbyteorder('=') == b[col].dtype.newbyteorder('=')  # FITS is big-endian
+        assert a[col].shape == b[col].shape
+        assert a[col].unit == b[col].unit
+        mask = np.ma.getmaskarray(a[col])
+        assert np.all(mask == np.ma.getmaskarray(b[col]))
+        assert np.all(np.asarray(a[col])[~mask] == np.asarray(b[col])[~mask])  # masked values may differ
+
+
+@pytest.mark.parametrize('extension', ['.feather', '.parquet'])
+def test_write_read_cache(tmpdir, table, extension):
+    cache_loc = tmpdir.join('cache' + extension).strpath
+    astropy_utils.write_cache(table, cache_loc)
+    assert_tables_equal(astropy_utils.read_cache(cache_loc), table)
+    assert_tables_equal(astropy_utils.read_cache(cache_loc, columns=['petroflux', 'iauname']), table[['petroflux', 'iauname']])
+    assert_tables_equal(astropy_utils.read_cache(cache_loc, columns=['redshift'], rows=slice(95, 125)), table[['redshift']][95:125])
+    assert len(astropy_utils.read_cache(cache_loc, rows=slice(2000, 3000))) == 0
+
+
+def test_read_cache_row_groups(tmpdir, table):
+    cache_loc = tmpdir.join('cache.parquet').strpath
+    astropy_utils.write_cache(table, cache_loc)
+    # rows spanning several row groups
+    arrow_table = pq.read_table(cache_loc)
+    pq.write_table(arrow_table, cache_loc, row_group_size=100)
+    assert_tables_equal(astropy_utils.read_cache(cache_loc, rows=slice(150, 420)), table[150:420])
+
+
+@pytest.mark.parametrize('cache_name', ['cache.feather', 'cache.parquet', 'cache.fits'])
+def test_cache_table(tmpdir, table, table_loc, cache_name):
+    cache_loc = tmpdir.join(cache_name).strpath
+    useful_cols = ['iauname', 'ra', 'petroflux', 'redshift']
+    astropy_utils.cache_table(table_loc, cache_loc, useful_cols)
+    cached = Table.read(cache_loc) if cache_name.endswith('.fits') else astropy_utils.read_cache(cache_loc)
+    assert cached.colnames == useful_cols
+    assert np.allclose(cached['ra'], table['ra'])
+
+
+def test_load_cached_table_invalidation(tmpdir, table, table_loc):
+    cache_loc = tmpdir.join('cache.feather').strpath
+    loads = []
+
+    def loading_func(loc, **kwargs):
+        loads.append(loc)
+        return Table.read(loc, **kwargs)
+
+    useful_cols = ['iauname', 'ra', 'redshift']
+    loaded = astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, columns=['ra'], rows=slice(0, 10), loading_func=loading_func)
+    assert loaded.colnames == ['ra'] and len(loaded) == 10
+    assert len(loads) == 1
+
+    # fresh, so not rebuilt
+    loaded = astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, loading_func=loading_func)
+    assert_tables_equal(loaded, Table.read(table_loc)[useful_cols])
+    assert len(loads) == 1
+
+    # asking for a column not yet cached rebuilds
+    astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols + ['nsa_id'], loading_func=loading_func)
+    assert len(loads) == 2
+
+    # changing the source rebuilds
+    stat = os.stat(table_loc)
+    os.utime(table_loc, ns=(stat.st_atime_ns, stat.st_mtime_ns + 10 ** 9))
+    astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, loading_func=loading_func)
+    assert len(loads) == 3
+
+    table[:500].write(table_loc, overwrite=True)
+    loaded = astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, loading_func=loading_func)
+    assert len(loads) == 4
+    assert len(loaded) == 500
+
+    # loading another table from the same file rebuilds
+    hdulist = fits.HDUList([fits.PrimaryHDU(), fits.table_to_hdu(table[:500]), fits.table_to_hdu(table[:200])])
+    hdulist.writeto(table_loc, overwrite=True)
+    astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, loading_func=loading_func)
+    loaded = astropy_utils.load_cached_table(table_loc, cache_loc, useful_cols, loading_func=loading_func, kwargs={'hdu': 2})
+    assert len(loads) == 6
+    assert len(loaded) == 200
+    assert astropy_utils.is_cache_fresh(table_loc, cache_loc, useful_cols, kwargs={'hdu': 2})
+    assert not astropy_utils.is_cache_fresh(table_loc, cache_loc, useful_cols)
+
+
+def test_load_cached_table_not_columnar(tmpdir, table_loc):
+    with pytest.raises(ValueError):
+        astropy_utils.load_cached_table(table_loc, tmpdir.join('cache.fits').strpath, ['ra'])
+
+
+def test_iter_source_chunks_fits(table_loc):
+    columns = ['nsa_id', 'bytes_name', 'petroflux', 'redshift', 'is_good', 'ra']
+    expected = Table.read(table_loc)[columns]
+    chunks = list(astropy_utils.iter_source_chunks(table_loc, columns, chunk_size=300))
+    assert [len(chunk) for chunk in chunks] == [300, 300, 300, 100]
+    assert_tables_equal(vstack(chunks), expected)
+
+
+def test_iter_source_chunks_hdf5(tmpdir, table):
+    table_loc = tmpdir.join('catalog.hdf5').strpath
+    table.write(table_loc, path='catalog', serialize_meta=True)
+    columns = ['nsa_id', 'iauname', 'petroflux', 'redshift', 'ra']
+    expected = Table.read(table_loc, path='catalog')[columns]
+    for path in ['catalog', None]:
+        chunks = list(astropy_utils.iter_source_chunks(table_loc, columns, chunk_size=300, path=path))
+        assert len(chunks) == 4
+        assert_tables_equal(vstack(chunks), expected)
+
+
+@pytest.mark.parametrize('source_name', ['catalog.fits', 'catalog.hdf5'])
+def test_cache_table_streaming(tmpdir, table, source_name):
+    table_loc = tmpdir.join(source_name).strpath
+    kwargs = {'path': 'catalog'} if source_name.endswith('.hdf5') else None
+    table.write(table_loc, path='catalog', serialize_meta=True) if kwargs else table.write(table_loc)
+    cache_loc = tmpdir.join('cache.feather').strpath
+    useful_cols = ['iauname', 'ra', 'petroflux', 'redshift']
+    astropy_utils.cache_table(table_loc, cache_loc, useful_cols, kwargs=kwargs, chunk_size=128)
+    expected = Table.read(table_loc, **(kwargs or {}))[useful_cols]
+    assert_tables_equal(astropy_utils.read_cache(cache_loc), expected)
+    assert astropy_utils.is_cache_fresh(table_loc, cache_loc, useful_cols, kwargs=kwargs)
+
+
+@pytest.mark.parametrize('source_name', ['catalog.fits', 'catalog.hdf5'])
+def test_cache_table_streaming_empty(tmpdir, table, source_name):
+    table_loc = tmpdir.join(source_name).strpath
+    kwargs = {'path': 'catalog'} if source_name.endswith('.hdf5') else None
+    table[:0].write(table_loc, path='catalog', serialize_meta=True) if kwargs else table[:0].write(table_loc)
+    cache_loc = tmpdir.join('cache.parquet').strpath
+    useful_cols = ['iauname', 'ra', 'petroflux', 'redshift']
+    astropy_utils.cache_table(table_loc, cache_loc, useful_cols, kwargs=kwargs)
+    cached = astropy_utils.read_cache(cache_loc)
+    assert len(cached) == 0
+    assert cached.colnames == useful_cols
+    assert cached['ra'].dtype == table['ra'].dtype
+    assert astropy_utils.is_cache_fresh(table_loc, cache_loc, useful_cols, kwargs=kwargs)
+
+
+def test_cache_writer_no_chunks(tmpdir):
+    cache_loc = tmpdir.join('cache.parquet').strpath
+    with astropy_utils.CacheWriter(cache_loc, columns=['ra', 'dec']):
+        pass
+    cached = astropy_utils.read_cache(cache_loc)
+    assert len(cached) == 0
+    assert cached.colnames == ['ra', 'dec']
+
+
+def test_cache_table_other_kwargs(tmpdir, table, table_loc):
+    # kwargs that iter_source_chunks does not take are passed to Table.read instead
+    cache_loc = tmpdir.join('cache.parquet').strpath
+    useful_cols = ['iauname', 'ra']
+    astropy_utils.cache_table(table_loc, cache_loc, useful_cols, kwargs={'format': 'fits'})
+    assert_tables_equal(astropy_utils.read_cache(cache_loc), Table.read(table_loc)[useful_cols])
+
+
+def test_cache_writer_failure(tmpdir, table):
+    cache_loc = tmpdir.join('cache.feather').strpath
+    with pytest.raises(RuntimeError):
+        with astropy_utils.CacheWriter(cache_loc) as writer:
+            writer.write(table[:10])
+            raise RuntimeError('source read failed')
+    assert os.listdir(tmpdir.strpath) == []
+
+
+def test_astropy_table_to_pandas_string(table):
+    df = astropy_utils.astropy_table_to_pandas(table)
+    assert list(df.columns) == table.colnames
+    assert df['petroflux'][3] == str(list(table['petroflux'][3]))
+    assert table['petroflux'].shape == (1000, 7)  # not modified
+
+
+def test_astropy_table_to_pandas_expand(table):
+    table['flags'] = MaskedColumn(np.ones((len(table), 2), dtype=np.int16), mask=np.zeros((len(table), 2), dtype=bool))
+    table['flags'].mask[5, 1] = True
+    df = astropy_utils.astropy_table_to_pandas(table, multidim='expand')
+    assert list(df.columns[5:12]) == ['petroflux_{}'.format(n) for n in range(7)]
+    assert np.all(df['petroflux_2'].values == table['petroflux'][:, 2])
+    assert np.shares_memory(df['petroflux_2'].values, table['petroflux'])
+    assert np.shares_memory(df['nsa_id'].values, table['nsa_id'])
+    assert df['redshift'].isna().sum() == 100
+    assert df['flags_1'].isna().tolist() == [n == 5 for n in range(len(table))]
+    assert df['flags_0'].sum() == len(table)
+    assert table['petroflux'].shape == (1000, 7)
+
+
+def test_astropy_table_to_pandas_array(table):
+    table['cube'] = np.arange(len(table) * 4, dtype='>f8').reshape(len(table), 2, 2)  # big-endian, as from FITS
+    df = astropy_utils.astropy_table_to_pandas(table, multidim='array')
+    assert list(df.columns) == table.colnames
+    assert df['petroflux'][3] == pytest.approx(list(table['petroflux'][3]))
+    assert df['cube'][1] == [4., 5., 6., 7.]
+
+
+def test_astropy_table_to_pandas_bad_mode(table):
+    with pytest.raises(ValueError):
+        astropy_utils.astropy_table_to_pandas(table, multidim='list')
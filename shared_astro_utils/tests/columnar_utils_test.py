@@ -0,0 +1,73 @@
+import pytest
+
+import os
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+
+from shared_astro_utils import columnar_utils
+
+
+@pytest.fixture()
+def chunks():
+    return [
+        pd.DataFrame({'id': [1, 2], 'ra': [1.5, 2.5], 'name': ['a', 'b'], 'empty': [np.nan, np.nan], 'flag': [True, False]}),
+        # later chunks may lack columns, gain columns, have missing values, or change type
+        pd.DataFrame({'id': [3, np.nan], 'ra': ['3.5', 'not_a_number'], 'name': [4, 'd'], 'empty': ['now', 'set']}),
+        pd.DataFrame({'id': [5], 'ra': [5.5], 'name': ['e'], 'empty': [np.nan], 'flag': [True], 'new_col': [1]})
+    ]
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather', '.csv'])
+def test_chunked_table_writer(tmpdir, chunks, extension):
+    save_loc = tmpdir.join('table' + extension).strpath
+    with columnar_utils.ChunkedTableWriter(save_loc) as writer:
+        for chunk in chunks:
+            writer.write(chunk)
+    assert writer.n_rows == 5
+    assert [str(field.type) for field in writer.schema] == ['double', 'string', 'string', 'string', 'bool', 'int64']
+
+    # no values are lost: ints with missing values become floats, and mixed columns become strings
+    table = columnar_utils.read_table(save_loc)
+    assert list(table.columns) == ['id', 'ra', 'name', 'empty', 'flag', 'new_col']
+    assert table['id'].tolist()[:3] == [1, 2, 3]
+    assert np.isnan(table['id'][3])
+    assert table['ra'].astype(str).tolist() == ['1.5', '2.5', '3.5', 'not_a_number', '5.5']
+    assert table['name'].tolist() == ['a', 'b', '4', 'd', 'e']
+    assert table['empty'].tolist()[2:4] == ['now', 'set']
+    assert table['flag'].isna().tolist() == [False, False, True, True, False]
+    assert table['new_col'].isna().tolist() == [True, True, True, True, False]
+    assert table['new_col'][4] == 1
+    assert not [name for name in os.listdir(tmpdir.strpath) if name.endswith('.tmp')]
+
+    subset = columnar_utils.read_table(save_loc, columns=['name'])
+    assert list(subset.columns) == ['name']
+
+
+def test_arrow_schema_for(chunks):
+    schema = columnar_utils.arrow_schema_for(chunks[0])
+    assert [str(field.type) for field in schema] == ['int64', 'double', 'string', 'null', 'bool']
+
+
+def test_widen_schema():
+    schema = pa.schema([('a', pa.int64()), ('b', pa.null()), ('c', pa.bool_()), ('d', pa.string())])
+    other = pa.schema([('a', pa.float64()), ('b', pa.int64()), ('c', pa.int64()), ('e', pa.float64())])
+    widened = columnar_utils.widen_schema(schema, other)
+    assert widened.names == ['a', 'b', 'c', 'd', 'e']
+    assert [str(field.type) for field in widened] == ['double', 'int64', 'string', 'string', 'double']
+
+
+def test_chunked_table_writer_keeps_large_ints(tmpdir):
+    save_loc = tmpdir.join('table.parquet').strpath
+    with columnar_utils.ChunkedTableWriter(save_loc) as writer:
+        writer.write(pd.DataFrame({'id': [2 ** 62 + 1]}))
+        writer.write(pd.DataFrame({'id': [2 ** 62 + 3], 'extra': ['a']}))  # rewrites the first chunk
+    assert columnar_utils.read_table(save_loc)['id'].tolist() == [2 ** 62 + 1, 2 ** 62 + 3]
+
+
+def test_infer_format():
+    assert columnar_utils.infer_format('a/b.PARQUET') == 'parquet'
+    assert columnar_utils.infer_format('a/b.feather') == 'feather'
+    with pytest.raises(ValueError):
+        columnar_utils.infer_format('a/b.fits')
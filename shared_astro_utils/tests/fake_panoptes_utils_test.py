@@ -0,0 +1,169 @@
+import pytest
+
+import struct
+
+import pandas as pd
+
+from shared_astro_utils import fake_panoptes_utils, upload_utils, subject_utils, rate_limit_utils, journal_utils
+
+
+@pytest.fixture()
+def manifest(tmpdir):
+    manifest = []
+    for n in range(45):
+        loc = tmpdir.join('{}.png'.format(n))
+        loc.write_binary(b'\x89PNG\r\n\x1a\n' + struct.pack('>I4sII', 13, b'IHDR', 424, 424) + bytes(100))
+        manifest.append({'locations': [loc.strpath], 'metadata': {'!filename': '{}.png'.format(n)}})
+    return manifest
+
+
+@pytest.fixture()
+def fast_retries(monkeypatch):
+    limiter = rate_limit_utils.AdaptiveRateLimiter(max_rate=10000., max_retries=10, base_delay=0.01, max_delay=0.1)
+    monkeypatch.setattr(rate_limit_utils, 'PANOPTES_WRITE_LIMITER', limiter)
+    return limiter
+
+
+def test_bulk_upload_subjects_in_blocks(manifest, fast_retries):
+    backend = fake_panoptes_utils.FakePanoptesBackend(latency=0.001, seed=0)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects('some_subject_set', manifest, project_id='1234', async_batch_size=10)
+    summary = backend.summary()
+    assert summary['subjects'] == len(manifest)
+    assert summary['linked'] == len(manifest)
+    assert summary['duplicate_subjects'] == 0
+    assert summary['link_races'] == 0
+    assert summary['requests']['login'] == 1
+    # patch is undone on exit
+    assert upload_utils.Subject is not backend
+
+
+def test_bulk_upload_subjects_in_blocks_saves_through_limiter(manifest, fast_retries, monkeypatch):
+    # each save has finished by the time panoptes_create returns, so the limiter saw (and timed) the real request
+    saved_ids = []
+
+    def panoptes_create(func, *args, **kwargs):
+        result = fast_retries.call_create(func, *args, **kwargs)
+        saved_ids.append(func.__self__.id)
+        return result
+
+    monkeypatch.setattr(rate_limit_utils, 'panoptes_create', panoptes_create)
+    backend = fake_panoptes_utils.FakePanoptesBackend(latency=0.001, seed=0)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects('some_subject_set', manifest, project_id='1234', async_batch_size=10)
+    assert len(saved_ids) == len(manifest) + 1  # and the subject set
+    assert None not in saved_ids
+    assert backend.summary()['linked'] == len(manifest)
+
+
+def test_bulk_upload_subjects_in_blocks_failed_save(manifest, fast_retries, tmpdir):
+    journal_loc = tmpdir.join('journal.db').strpath
+    good_location = manifest[12]['locations']
+    manifest[12]['locations'] = [good_location[0] + '_missing']
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=0)
+    with backend.patch():
+        with pytest.raises(FileNotFoundError):
+            upload_utils.bulk_upload_subjects(
+                'some_subject_set', manifest, project_id='1234', async_batch_size=10, journal_loc=journal_loc)
+    # the rest of the failed block was still journaled and linked, and the failure was not journaled
+    assert backend.summary()['linked'] == 19
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        assert len(journal) == 19
+        assert journal.subject_id('12.png') is None
+        assert journal.unlinked_subject_ids() == {}
+
+    manifest[12]['locations'] = good_location
+    with backend.patch():
+        upload_utils.bulk_upload_subjects(
+            'some_subject_set', manifest, project_id='1234', async_batch_size=10, journal_loc=journal_loc)
+    assert backend.summary()['linked'] == len(manifest)
+    assert backend.summary()['duplicate_subjects'] == 0
+
+
+def test_bulk_upload_subjects_pipelined_with_errors(manifest, fast_retries):
+    backend = fake_panoptes_utils.FakePanoptesBackend(latency=0.001, error_rate=0.1, seed=0)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects(
+            'some_subject_set', manifest, project_id='1234', async_batch_size=10, max_in_flight=4)
+    summary = backend.summary()
+    assert summary['errors'][503] > 0
+    assert summary['linked'] == len(manifest)
+    assert summary['link_races'] == 0
+
+
+def test_bulk_upload_subjects_throttled(manifest, fast_retries):
+    throttle_every = 7
+    backend = fake_panoptes_utils.FakePanoptesBackend(throttle_every=throttle_every, seed=0)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects(
+            'some_subject_set', manifest, project_id='1234', async_batch_size=10, max_in_flight=4)
+    summary = backend.summary()
+    assert summary['linked'] == len(manifest)
+    assert summary['duplicate_subjects'] == 0
+    # throttled by count, not time, so every 7th request was a 429, whatever the thread timing
+    assert sum(summary['requests'].values()) == 99
+    assert summary['errors'] == {429: (99 + 16) // throttle_every}
+    # each 429 was retried, either by Subject.save itself or by the limiter (which depends on the thread timing)
+    stats = fast_retries.stats
+    assert stats['throttle_responses'] + backend.internal_retries == backend.errors[429]
+    assert stats['retries'] == stats['throttle_responses']
+    assert stats['failures'] == 0
+
+
+def test_upload_subject_throttled(manifest, fast_retries):
+    backend = fake_panoptes_utils.FakePanoptesBackend(throttle_every=4, seed=0)
+    with backend.patch():
+        subject_utils.authenticate()  # request 1
+        project = subject_utils.Project.find('1234')  # 2
+        for entry in manifest[:5]:
+            # save, upload, (first time only) find and create the subject set, then link
+            subject_utils.upload_subject(entry['locations'], project, 'some_subject_set', entry['metadata'])
+    assert backend.summary()['linked'] == 5
+    assert backend.errors == {429: 6}  # every 4th of 19 accepted + 6 throttled requests
+    # the first upload (request 4) was retried by Subject.save, and every link (8, 12... 24) by the limiter
+    assert backend.internal_retries == 1
+    assert fast_retries.stats['throttle_responses'] == fast_retries.stats['retries'] == 5
+
+
+def test_upload_subject(manifest, fast_retries):
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=0)
+    with backend.patch():
+        subject_utils.authenticate()
+        project = subject_utils.Project.find('1234')
+        subject_ids = [
+            subject_utils.upload_subject(entry['locations'], project, 'some_subject_set', entry['metadata'])
+            for entry in manifest[:5]
+        ]
+    assert len(set(subject_ids)) == 5
+    assert backend.requests['subject_set_create'] == 1
+    assert backend.requests['subject_set_query'] == 1  # cached thereafter
+    assert backend.summary()['linked'] == 5
+
+
+def test_bulk_upload_subjects_preflight(manifest, fast_retries):
+    manifest[10]['locations'] = [manifest[10]['locations'][0] + '_missing']
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=0)
+    with backend.patch():
+        upload_utils.bulk_upload_subjects('some_subject_set', iter(manifest), project_id='1234', preflight=True)
+    assert backend.summary()['linked'] == len(manifest) - 1
+
+
+def test_upload_to_gz_preflight_is_opt_in(manifest, fast_retries, tmpdir):
+    catalog = pd.DataFrame([{
+        'iauname': 'J{}'.format(n), 'nsa_id': n, 'ra': 10. + n, 'dec': 1., 'petrotheta': 1., 'petroth50': 1.,
+        'petroth90': 1., 'redshift': 0.05, 'nsa_version': 'v1_0_0', 'file_loc': entry['locations'][0]
+    } for n, entry in enumerate(manifest[:4])])
+    large_loc = tmpdir.join('large.png')
+    large_loc.write_binary(open(catalog['file_loc'][0], 'rb').read() + bytes(2 * 1024 ** 2))  # over the subject limit
+    catalog.loc[0, 'file_loc'] = large_loc.strpath
+
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=0)
+    with backend.patch():
+        upload_utils.upload_to_gz('login.json', catalog, 'some_subject_set', retirement=40, project_id='1234')
+    assert backend.summary()['linked'] == 4  # nothing silently dropped
+
+    backend = fake_panoptes_utils.FakePanoptesBackend(seed=0)
+    with backend.patch():
+        upload_utils.upload_to_gz(
+            'login.json', catalog, 'some_subject_set', retirement=40, project_id='1234', preflight=True)
+    assert backend.summary()['linked'] == 3
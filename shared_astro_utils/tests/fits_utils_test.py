@@ -1,5 +1,8 @@
 import pytest
 
+import numpy as np
+from astropy.io import fits
+
 from shared_astro_utils import fits_utils
 from shared_astro_utils.tests import TEST_EXAMPLE_DIR
 
@@ -9,3 +12,146 @@ def test_fits_are_identical():
     fits_b_loc = '{}/example_b.fits'.format(TEST_EXAMPLE_DIR)
     assert fits_utils.fits_are_identical(fits_a_loc, fits_a_loc)
     assert not fits_utils.fits_are_identical(fits_a_loc, fits_b_loc)
+
+
+@pytest.fixture()
+def image():
+    pixels = np.random.RandomState(0).uniform(size=(3, 50, 40)).astype(np.float32)
+    pixels[0, 10, 10] = np.nan
+    return pixels
+
+
+@pytest.fixture()
+def fits_dir(tmpdir, image):
+    fits.writeto(tmpdir.join('original.fits').strpath, image)
+    fits.writeto(tmpdir.join('copy.fits').strpath, image.copy())
+    changed = image.copy()
+    changed[2, 49, 39] += 1.  # last pixel, so every block is read first
+    fits.writeto(tmpdir.join('changed.fits').strpath, changed)
+    moved_nan = image.copy()
+    moved_nan[0, 10, 10] = 0.
+    moved_nan[0, 10, 11] = np.nan
+    fits.writeto(tmpdir.join('moved_nan.fits').strpath, moved_nan)
+    fits.writeto(tmpdir.join('reshaped.fits').strpath, image.reshape(3, 40, 50))
+    return tmpdir
+
+
+@pytest.mark.parametrize('block_pixels', [1, 100, fits_utils.BLOCK_PIXELS])
+def test_fits_are_identical_blocks(fits_dir, block_pixels):
+    original_loc = fits_dir.join('original.fits').strpath
+    for name, expected in [('copy', True), ('changed', False), ('moved_nan', False), ('reshaped', False)]:
+        other_loc = fits_dir.join(name + '.fits').strpath
+        assert fits_utils.fits_are_identical(original_loc, other_loc, block_pixels=block_pixels) == expected
+
+
+def test_fits_are_identical_nan_positions(tmpdir):
+    # the same pixels once NaNs are removed, but with NaNs in different places
+    a_loc, b_loc = tmpdir.join('a.fits').strpath, tmpdir.join('b.fits').strpath
+    fits.writeto(a_loc, np.array([[1., np.nan, 2.], [3., 4., 5.]]))
+    fits.writeto(b_loc, np.array([[1., 2., np.nan], [3., 4., 5.]]))
+    assert not fits_utils.fits_are_identical(a_loc, b_loc)
+    assert fits_utils.fits_are_identical(a_loc, a_loc)
+
+
+def test_fits_are_identical_missing_file(fits_dir):
+    with pytest.raises(FileNotFoundError, match='missing.fits'):
+        fits_utils.fits_are_identical(fits_dir.join('original.fits').strpath, fits_dir.join('missing.fits').strpath)
+
+
+def test_fits_are_identical_scaled(tmpdir):
+    pixels = np.arange(600, dtype=np.int16).reshape(20, 30) * 0.5 + 10.
+    unscaled_loc = tmpdir.join('unscaled.fits').strpath
+    fits.writeto(unscaled_loc, pixels)
+    hdu = fits.PrimaryHDU(pixels.copy())
+    hdu.scale('int16', bscale=0.5, bzero=10.)
+    scaled_loc = tmpdir.join('scaled.fits').strpath
+    hdu.writeto(scaled_loc)
+    assert fits_utils.fits_are_identical(unscaled_loc, scaled_loc, block_pixels=64)
+
+
+def test_fits_dirs_are_identical(fits_dir, tmpdir_factory):
+    other_dir = tmpdir_factory.mktemp('other')
+    for name in ['copy', 'changed', 'moved_nan', 'reshaped']:
+        fits_dir.join(name + '.fits').copy(other_dir.join(name + '.fits'))
+    fits_dir.join('original.fits').copy(other_dir.join('changed.fits'))
+    fits_dir.join('original.fits').copy(other_dir.join('extra.fits'))
+    assert fits_utils.fits_dirs_are_identical(fits_dir.strpath, other_dir.strpath, max_workers=2) == {
+        'changed.fits': False,
+        'copy.fits': True,
+        'extra.fits': False,
+        'moved_nan.fits': True,
+        'original.fits': False,
+        'reshaped.fits': True
+    }
+
+
+def test_fits_content_hash(fits_dir, tmpdir_factory):
+    hashes = {
+        name: fits_utils.fits_content_hash(fits_dir.join(name + '.fits').strpath, block_pixels=100)
+        for name in ['original', 'copy', 'changed', 'moved_nan', 'reshaped']
+    }
+    assert hashes['original'] == hashes['copy']
+    assert len(set(hashes.values())) == 4
+    # same values, stored differently
+    image = fits.getdata(fits_dir.join('original.fits').strpath)
+    image[np.isnan(image)] = -np.float32(np.nan)
+    other_loc = tmpdir_factory.mktemp('other').join('float64.fits').strpath
+    fits.writeto(other_loc, image.astype(np.float64))
+    assert fits_utils.fits_content_hash(other_loc) == hashes['original']
+
+
+def test_fits_hash_index(fits_dir, tmpdir_factory):
+    nested_dir = fits_dir.mkdir('nested')
+    fits_dir.join('original.fits').copy(nested_dir.join('another_copy.fits'))
+    fits_dir.join('not_fits.fits').write('not a fits file')
+    index_loc = tmpdir_factory.mktemp('index').join('index.db').strpath
+
+    with fits_utils.FitsHashIndex(index_loc) as index:
+        report = index.update(fits_dir.strpath, max_workers=2, chunk_size=3)
+        assert report == {'files': 7, 'hashed': 7, 'removed': 0}
+        assert index.file_hash(fits_dir.join('not_fits.fits').strpath) is None
+        assert index.duplicate_groups() == [[
+            fits_dir.join('copy.fits').strpath,
+            nested_dir.join('another_copy.fits').strpath,
+            fits_dir.join('original.fits').strpath
+        ]]
+
+    with fits_utils.FitsHashIndex(index_loc) as index:
+        assert len(index) == 7
+        # only changed files are rehashed, and deleted files forgotten
+        fits_dir.join('changed.fits').remove()
+        fits_dir.join('original.fits').copy(fits_dir.join('reshaped.fits'))
+        report = index.update(fits_dir.strpath, max_workers=2, chunk_size=3)
+        assert report == {'files': 6, 'hashed': 1, 'removed': 1}
+        assert [len(group) for group in index.duplicate_groups()] == [4]
+
+
+def test_load_fits_cube(fits_dir, image):
+    fits_locs = [fits_dir.join(name + '.fits').strpath for name in ['original', 'changed', 'copy']] * 3
+    cube_loc = fits_dir.join('cube.npy').strpath
+    cube = fits_utils.load_fits_cube(fits_locs, cube_loc, max_workers=2, chunk_size=2)
+    assert cube.shape == (9, 50, 40, 3)
+    assert cube.dtype == np.float32
+    expected = np.moveaxis(image, 0, -1)
+    assert np.array_equal(cube[6], expected, equal_nan=True)
+    assert not np.array_equal(cube[7], expected, equal_nan=True)
+    assert np.array_equal(np.load(cube_loc), cube, equal_nan=True)
+
+
+def test_load_fits_cube_crop(tmpdir):
+    image = np.arange(30 * 20, dtype=np.int16).reshape(30, 20)  # one channel
+    fits_loc = tmpdir.join('image.fits').strpath
+    fits.writeto(fits_loc, image)
+    cube = fits_utils.load_fits_cube([fits_loc] * 3, tmpdir.join('cube.npy').strpath, crop_size=10, dtype=np.float16)
+    assert cube.shape == (3, 10, 10, 1)
+    assert cube.dtype == np.float16
+    assert np.array_equal(cube[0, :, :, 0], image[10:20, 5:15])
+    with pytest.raises(ValueError):
+        fits_utils.load_fits_cube([fits_loc], tmpdir.join('cube.npy').strpath, crop_size=25)
+
+
+def test_load_fits_cube_different_shapes(fits_dir):
+    fits_locs = [fits_dir.join(name + '.fits').strpath for name in ['original', 'reshaped']]
+    with pytest.raises(ValueError):
+        fits_utils.load_fits_cube(fits_locs, fits_dir.join('cube.npy').strpath, max_workers=1)
+    assert not any(path.basename.startswith('cube') for path in fits_dir.listdir())
@@ -0,0 +1,75 @@
+import pytest
+
+import os
+
+from panoptes_client import panoptes
+
+from shared_astro_utils import journal_utils, rate_limit_utils
+
+
+@pytest.fixture()
+def journal_loc(tmpdir):
+    return os.path.join(tmpdir.mkdir('journal').strpath, 'upload_journal.db')
+
+
+@pytest.fixture()
+def manifest():
+    return [{'locations': ['{}.png'.format(n)], 'metadata': {'!filename': '{}.png'.format(n)}} for n in range(5)]
+
+
+class FakeSubjectSet():
+
+    def __init__(self, n_throttled=0):
+        self.linked = []
+        self.n_throttled = n_throttled
+
+    def add(self, subjects):
+        if self.n_throttled > 0:
+            self.n_throttled -= 1
+            raise panoptes.PanoptesAPIException('Received HTTP status code 429 from API')
+        self.linked.extend(subjects)
+
+
+def test_upload_journal_persists(journal_loc):
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        journal.record_saved('0.png', 100)
+        journal.record_many_saved([('1.png', 101), ('2.png', 102)])
+        journal.record_linked(['0.png', '1.png'])
+
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        assert len(journal) == 3
+        assert journal.is_linked('0.png')
+        assert not journal.is_linked('2.png')
+        assert not journal.is_linked('3.png')
+        assert journal.subject_id('2.png') == '102'
+        assert journal.subject_id('3.png') is None
+        assert journal.unlinked_subject_ids() == {'2.png': '102'}
+
+    # journals are scoped by subject set
+    with journal_utils.UploadJournal(journal_loc, 'other_subject_set') as journal:
+        assert len(journal) == 0
+
+
+def test_manifest_entry_key():
+    assert journal_utils.manifest_entry_key({'!filename': 'a.png', '!iauname': 'J1'}) == 'a.png'
+    assert journal_utils.manifest_entry_key({'iauname': 'J1'}) == 'J1'
+    with pytest.raises(KeyError):
+        journal_utils.manifest_entry_key({'ra': 12.})
+
+
+def test_restart_from_journal(journal_loc, manifest, monkeypatch):
+    limiter = rate_limit_utils.AdaptiveRateLimiter(max_rate=10000., base_delay=0.01, max_delay=0.1)
+    monkeypatch.setattr(rate_limit_utils, 'PANOPTES_WRITE_LIMITER', limiter)
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        # a previous upload saved three subjects, but crashed after linking only one
+        journal.record_many_saved([('0.png', 100), ('1.png', 101), ('2.png', 102)])
+        journal.record_linked(['0.png'])
+
+        subject_set = FakeSubjectSet(n_throttled=1)
+        assert journal_utils.link_unlinked_subjects(journal, subject_set) == 2  # retried, like other links
+        assert limiter.stats['throttle_responses'] == 1
+        assert sorted(subject_set.linked) == ['101', '102']
+        assert journal.unlinked_subject_ids() == {}
+
+        remaining = list(journal_utils.skip_saved_entries(manifest, journal))
+        assert [entry['metadata']['!filename'] for entry in remaining] == ['3.png', '4.png']
@@ -1,7 +1,12 @@
+import os
+
 import pytest
 
+import numpy as np
+import pandas as pd
 from astropy import units
-from astropy.table import Table
+from astropy.coordinates import SkyCoord
+from astropy.table import Table, vstack
 
 from shared_astro_utils import matching_utils
 
@@ -82,3 +87,335 @@ def test_match_galaxies_to_catalog_table_awkward_units(galaxies, catalog):
 
     assert set(matched.colnames) == {'dec_subject',  'galaxy_data', 'name_subject', 'ra_subject', 'z_subject', 'best_match', 'sky_separation', 'dec', 'name', 'ra', 'table_data', 'z'}
     assert set(unmatched.colnames) == {'dec', 'name', 'ra', 'z', 'best_match', 'sky_separation', 'galaxy_data'}
+
+
+@pytest.fixture()
+def random_catalog():
+    rng = np.random.RandomState(42)
+    n_galaxies = 5000
+    return Table({
+        'name': np.arange(n_galaxies).astype(str),
+        'ra': rng.uniform(0., 360., size=n_galaxies),
+        'dec': np.degrees(np.arcsin(rng.uniform(-1., 1., size=n_galaxies))),
+        'table_data': rng.uniform(size=n_galaxies)
+    })
+
+
+@pytest.fixture()
+def random_galaxies(random_catalog):
+    rng = np.random.RandomState(1)
+    # half near a catalog galaxy, half anywhere
+    near = random_catalog[:500]
+    return Table({
+        'name': np.arange(1000).astype(str),
+        'ra': np.concatenate([near['ra'] + rng.normal(scale=2. / 3600, size=500), rng.uniform(0., 360., size=500)]),
+        'dec': np.concatenate([near['dec'] + rng.normal(scale=2. / 3600, size=500), rng.uniform(-90., 90., size=500)]),
+        'galaxy_data': rng.uniform(size=1000)
+    })
+
+
+def test_catalog_index_match(random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+    assert len(index) == len(random_catalog)
+
+    galaxies_coord = SkyCoord(ra=random_galaxies['ra'], dec=random_galaxies['dec'], unit=units.deg)
+    catalog_coord = SkyCoord(ra=random_catalog['ra'], dec=random_catalog['dec'], unit=units.deg)
+    for nthneighbor in [1, 2]:
+        expected_index, expected_sep, _ = galaxies_coord.match_to_catalog_sky(catalog_coord, nthneighbor=nthneighbor)
+        best_match, sep = index.match(random_galaxies['ra'], random_galaxies['dec'], nthneighbor=nthneighbor)
+        assert np.all(best_match == expected_index)
+        assert np.allclose(sep.to(units.arcsec).value, expected_sep.to(units.arcsec).value, atol=1e-6)
+
+
+def test_catalog_index_query_radius(random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+    radius = 2. * units.deg
+    galaxy_index, catalog_index, sep = index.query_radius(random_galaxies['ra'], random_galaxies['dec'], radius)
+
+    galaxies_coord = SkyCoord(ra=random_galaxies['ra'], dec=random_galaxies['dec'], unit=units.deg)
+    catalog_coord = SkyCoord(ra=random_catalog['ra'], dec=random_catalog['dec'], unit=units.deg)
+    expected_galaxy_index, expected_catalog_index, expected_sep, _ = catalog_coord.search_around_sky(galaxies_coord, radius)
+    expected = sorted(zip(expected_galaxy_index, expected_catalog_index, expected_sep.to(units.arcsec).value))
+    assert len(galaxy_index) == len(expected) > 0
+    assert list(zip(galaxy_index, catalog_index)) == [(g, c) for g, c, _ in expected]
+    assert np.allclose(sep.to(units.arcsec).value, [s for _, _, s in expected], atol=1e-6)
+
+
+def test_catalog_index_save_load(tmpdir, random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+    index_dir = tmpdir.join('index').strpath
+    index.save(index_dir)
+    loaded = matching_utils.CatalogIndex.load(index_dir)
+    assert isinstance(loaded.tree.data, np.memmap) or isinstance(loaded.tree.data.base, np.memmap)
+    expected_index, expected_sep = index.match(random_galaxies['ra'], random_galaxies['dec'])
+    loaded_index, loaded_sep = loaded.match(random_galaxies['ra'], random_galaxies['dec'])
+    assert np.all(loaded_index == expected_index)
+    assert np.all(loaded_sep == expected_sep)
+
+
+def test_match_galaxies_to_catalog_with_index(random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+
+    expected, expected_unmatched = matching_utils.match_galaxies_to_catalog_table(random_galaxies.copy(), random_catalog.copy())
+    matched, unmatched = matching_utils.match_galaxies_to_catalog_table(random_galaxies.copy(), random_catalog.copy(), catalog_index=index)
+    assert len(expected) > 400
+    assert list(matched['name']) == list(expected['name'])
+    assert list(matched['best_match']) == list(expected['best_match'])
+    assert list(unmatched['name']) == list(expected_unmatched['name'])
+
+    galaxies_df, catalog_df = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    expected, _ = matching_utils.match_galaxies_to_catalog_pandas(galaxies_df.copy(), catalog_df.copy())
+    matched, _ = matching_utils.match_galaxies_to_catalog_pandas(galaxies_df.copy(), catalog_df.copy(), catalog_index=index)
+    pd.testing.assert_frame_equal(matched.drop(columns='sky_separation'), expected.drop(columns='sky_separation'))
+    assert np.allclose(matched['sky_separation'], expected['sky_separation'], atol=1e-6)
+
+
+def test_match_galaxies_to_catalog_lazy(random_catalog, random_galaxies):
+    galaxies_colnames, catalog_colnames = list(random_galaxies.colnames), list(random_catalog.colnames)
+    result = matching_utils.match_galaxies_to_catalog_lazy(random_galaxies, random_catalog)
+    assert random_galaxies.colnames == galaxies_colnames  # not modified
+    assert random_catalog.colnames == catalog_colnames
+
+    expected, expected_unmatched = matching_utils.match_galaxies_to_catalog_table(random_galaxies.copy(), random_catalog.copy())
+    assert len(result) == len(expected)
+    matched = result.matched()
+    assert set(matched.colnames) == set(expected.colnames)
+    for col in ['name_subject', 'name', 'best_match', 'table_data', 'galaxy_data']:
+        assert list(matched[col]) == list(expected[col])
+    assert np.allclose(matched['sky_separation'], expected['sky_separation'], atol=1e-6)
+    assert list(result.unmatched()['name']) == list(expected_unmatched['name'])
+
+    subset = result.matched(galaxy_columns=['name'], catalog_columns=['name', 'table_data'], catalog_suffix='_catalog')
+    assert subset.colnames == ['name_subject', 'best_match', 'sky_separation', 'name_catalog', 'table_data']
+
+
+def test_match_galaxies_to_catalog_lazy_pandas(random_catalog, random_galaxies):
+    galaxies_df, catalog_df = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    galaxies_df.index = galaxies_df.index + 100
+    result = matching_utils.match_galaxies_to_catalog_lazy(galaxies_df, catalog_df)
+    assert 'best_match' not in galaxies_df.columns and 'best_match' not in catalog_df.columns
+
+    expected, expected_unmatched = matching_utils.match_galaxies_to_catalog_pandas(galaxies_df.copy(), catalog_df.copy())
+    matched = result.matched()
+    pd.testing.assert_frame_equal(matched.drop(columns='sky_separation'), expected[matched.columns].drop(columns='sky_separation'))
+    unmatched = result.unmatched(columns=['name'])
+    assert list(unmatched.index) == list(expected_unmatched.index)
+    assert list(unmatched['best_match']) == list(expected_unmatched['best_match'])
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_match_galaxies_to_catalog_partitioned(tmpdir, random_catalog, random_galaxies, on_disk):
+    galaxies, catalog = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    galaxies.index = galaxies.index + 1000  # unmatched galaxies keep their index
+    # galaxies and matches straddling band edges, where a match is only found thanks to the band margin
+    band_edges = matching_utils.equal_area_dec_bands(8)
+    edge_catalog = pd.DataFrame({'name': ['edge_a', 'edge_b'], 'ra': [50., 60.], 'dec': band_edges[3:5] + 1. / 3600, 'table_data': 0.})
+    edge_galaxies = pd.DataFrame({'name': ['edge_a', 'edge_b'], 'ra': [50., 60.], 'dec': band_edges[3:5] - 1. / 3600, 'galaxy_data': 0.}, index=[5000, 5001])
+    catalog = pd.concat([catalog, edge_catalog], ignore_index=True)
+    galaxies = pd.concat([galaxies, edge_galaxies])
+
+    expected_matched, expected_unmatched = matching_utils.match_galaxies_to_catalog_pandas(galaxies.copy(), catalog.copy())
+
+    if on_disk:
+        galaxies_loc, catalog_loc = tmpdir.join('galaxies.parquet').strpath, tmpdir.join('catalog.feather').strpath
+        galaxies.to_parquet(galaxies_loc, index=False)
+        catalog.to_feather(catalog_loc)
+        matched, unmatched = matching_utils.match_galaxies_to_catalog_partitioned(
+            galaxies_loc, catalog_loc, n_bands=8, max_workers=2, chunk_size=1000)
+        expected_unmatched = expected_unmatched.reset_index(drop=True)
+        unmatched = unmatched.reset_index(drop=True)
+    else:
+        galaxies_before = galaxies.copy()
+        matched, unmatched = matching_utils.match_galaxies_to_catalog_partitioned(
+            galaxies, catalog, n_bands=8, max_workers=2, chunk_size=1000, work_dir=tmpdir.mkdir('work').strpath)
+        pd.testing.assert_frame_equal(galaxies, galaxies_before)  # not modified
+
+    assert {'edge_a', 'edge_b'} <= set(matched['name_subject'])
+    pd.testing.assert_frame_equal(
+        matched.drop(columns='sky_separation'), expected_matched.drop(columns='sky_separation'))
+    assert np.allclose(matched['sky_separation'], expected_matched['sky_separation'], atol=1e-6)
+    pd.testing.assert_frame_equal(
+        unmatched[['name', 'ra', 'dec', 'galaxy_data']], expected_unmatched[['name', 'ra', 'dec', 'galaxy_data']])
+
+
+@pytest.mark.parametrize('on_disk', [False, True])
+def test_match_galaxies_to_catalog_partitioned_dtypes(tmpdir, random_catalog, random_galaxies, on_disk):
+    galaxies, catalog = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    # only known after the first chunk, and column types which Arrow would not infer from one chunk alone
+    catalog['late_value'] = np.where(np.arange(len(catalog)) < 1000, np.nan, 1.5)
+    catalog['raw'] = [str(n).encode() for n in range(len(catalog))]
+    catalog['comment'] = [None if n % 3 else 'comment_{}'.format(n) for n in range(len(catalog))]
+    galaxies['galaxy_comment'] = [None if n < 1000 else 'late' for n in range(len(galaxies))]
+
+    expected_matched, expected_unmatched = matching_utils.match_galaxies_to_catalog_pandas(galaxies.copy(), catalog.copy())
+    if on_disk:
+        galaxies_loc, catalog_loc = tmpdir.join('galaxies.feather').strpath, tmpdir.join('catalog.parquet').strpath
+        galaxies.to_feather(galaxies_loc)
+        catalog.to_parquet(catalog_loc, index=False)
+        galaxies, catalog = galaxies_loc, catalog_loc
+    matched, unmatched = matching_utils.match_galaxies_to_catalog_partitioned(
+        galaxies, catalog, n_bands=8, max_workers=2, chunk_size=1000)
+
+    assert matched.dtypes.to_dict() == expected_matched.dtypes.to_dict()
+    assert matched['late_value'].dtype == float
+    assert isinstance(matched['raw'][0], bytes)
+    pd.testing.assert_frame_equal(
+        matched.drop(columns='sky_separation'), expected_matched.drop(columns='sky_separation'))
+    assert unmatched['galaxy_comment'].dtype == expected_unmatched['galaxy_comment'].dtype
+
+
+def test_match_galaxies_to_catalog_partitioned_right_join(random_catalog, random_galaxies):
+    with pytest.raises(ValueError):
+        matching_utils.match_galaxies_to_catalog_partitioned(
+            random_galaxies.to_pandas(), random_catalog.to_pandas(), how_join='right')
+
+
+def expected_pairs(galaxies, catalog, radius):
+    galaxies_coord = SkyCoord(ra=galaxies['ra'], dec=galaxies['dec'], unit=units.deg)
+    catalog_coord = SkyCoord(ra=catalog['ra'], dec=catalog['dec'], unit=units.deg)
+    galaxy_index, catalog_index, sep, _ = catalog_coord.search_around_sky(galaxies_coord, radius)
+    return sorted(zip(galaxy_index, catalog_index))
+
+
+def test_iter_pairs_within_radius(random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+    radius = 1. * units.deg
+    chunks = list(matching_utils.iter_pairs_within_radius(random_galaxies, index, radius, chunk_size=300))
+    assert len(chunks) == 4
+    galaxy_index, catalog_index, sep = [np.concatenate(arrays) for arrays in zip(*chunks)]
+    assert sorted(zip(galaxy_index, catalog_index)) == expected_pairs(random_galaxies, random_catalog, radius)
+    assert np.all(sep <= 3600.)
+    assert np.all(np.diff(galaxy_index) >= 0)
+
+
+def test_iter_nearest_pairs(random_catalog, random_galaxies):
+    index = matching_utils.CatalogIndex.from_catalog(random_catalog)
+    galaxy_index, catalog_index, sep = [
+        np.concatenate(arrays) for arrays in zip(*matching_utils.iter_nearest_pairs(random_galaxies, index, k=3, chunk_size=300))]
+    assert len(galaxy_index) == 3 * len(random_galaxies)
+    best_match, best_sep = index.match(random_galaxies['ra'], random_galaxies['dec'], nthneighbor=3)
+    assert np.all(catalog_index[2::3] == best_match)
+    assert np.allclose(sep[2::3], best_sep.to(units.arcsec).value)
+
+    # with a radius, only neighbours within the radius
+    radius = 1. * units.deg
+    galaxy_index, catalog_index, sep = [
+        np.concatenate(arrays) for arrays in zip(*matching_utils.iter_nearest_pairs(random_galaxies, index, k=1000, matching_radius=radius))]
+    assert sorted(zip(galaxy_index, catalog_index)) == expected_pairs(random_galaxies, random_catalog, radius)
+
+
+def test_match_all_within_radius(random_catalog, random_galaxies):
+    radius = 1. * units.deg
+    n_pairs = len(expected_pairs(random_galaxies, random_catalog, radius))
+
+    galaxies_df, catalog_df = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    matched, unmatched = matching_utils.match_all_within_radius_pandas(galaxies_df, catalog_df, matching_radius=radius, chunk_size=300)
+    assert len(matched) == n_pairs
+    assert 'best_match' not in catalog_df.columns  # not modified
+    assert {'name_subject', 'name', 'sky_separation', 'match_rank', 'galaxy_data', 'table_data'} <= set(matched.columns)
+    assert set(unmatched['name']) == set(galaxies_df['name']) - set(matched['name_subject'])
+    nearest = matched[matched['match_rank'] == 1]
+    assert nearest['sky_separation'].values.tolist() == matched.groupby('name_subject', sort=False)['sky_separation'].min().values.tolist()
+
+    matched_table, unmatched_table = matching_utils.match_all_within_radius_table(
+        random_galaxies, random_catalog, matching_radius=radius, chunk_size=300)
+    assert len(matched_table) == n_pairs
+    assert len(unmatched_table) == len(unmatched)
+    assert 'best_match' not in random_catalog.colnames
+
+    right, _ = matching_utils.match_all_within_radius_pandas(galaxies_df, catalog_df, matching_radius=radius, how_join='right')
+    assert set(right['name']) == set(catalog_df['name'])
+
+
+def test_match_k_nearest(random_catalog, random_galaxies):
+    galaxies_df, catalog_df = random_galaxies.to_pandas(), random_catalog.to_pandas()
+    matched, unmatched = matching_utils.match_k_nearest_pandas(galaxies_df, catalog_df, k=2)
+    assert len(matched) == 2 * len(galaxies_df)
+    assert len(unmatched) == 0
+    assert matched['match_rank'].tolist() == [1, 2] * len(galaxies_df)
+
+    matched_table, _ = matching_utils.match_k_nearest_table(random_galaxies, random_catalog, k=2, matching_radius=10 * units.arcsec)
+    expected, _ = matching_utils.match_galaxies_to_catalog_table(random_galaxies.copy(), random_catalog.copy())
+    assert set(matched_table['name_subject']) == set(expected['name_subject'])
+
+
+@pytest.fixture()
+def duplicated_catalog(random_catalog):
+    # rows 0-99 duplicated once, rows 100-109 twice, within 0.5 arcsec
+    rng = np.random.RandomState(2)
+    duplicates = random_catalog[list(range(100)) + list(range(100, 110)) * 2]
+    duplicates['ra'] += rng.uniform(-0.2, 0.2, size=len(duplicates)) / 3600
+    duplicates['dec'] += rng.uniform(-0.2, 0.2, size=len(duplicates)) / 3600
+    duplicates['table_data'] = -1.  # marks the duplicates
+    return vstack([random_catalog, duplicates]).to_pandas()
+
+
+@pytest.mark.parametrize('n_bands', [1, 8])
+def test_self_match_groups(duplicated_catalog, n_bands):
+    group, group_size = matching_utils.self_match_groups(
+        duplicated_catalog, 1 * units.arcsec, n_bands=n_bands, max_workers=2)
+    assert group.max() == 5000 - 1  # one group per original galaxy
+    assert list(group[:5]) == [0, 1, 2, 3, 4]  # numbered by first appearance
+    assert np.all(group[5000:5100] == np.arange(100))
+    assert np.all(group_size[:100] == 2)
+    assert np.all(group_size[100:110] == 3)
+    assert np.all(group_size[110:5000] == 1)
+
+
+def test_deduplicate_catalog(duplicated_catalog):
+    before = duplicated_catalog.copy()
+    deduplicated, report = matching_utils.deduplicate_catalog(duplicated_catalog, 1 * units.arcsec)
+    pd.testing.assert_frame_equal(duplicated_catalog, before)  # not modified
+    assert list(deduplicated.index) == list(range(5000))  # first of each group
+    assert report == {'rows': 5120, 'groups': 5000, 'removed': 120, 'group_sizes': {1: 4890, 2: 100, 3: 10}}
+
+    deduplicated, _ = matching_utils.deduplicate_catalog(duplicated_catalog, 1 * units.arcsec, keep='first', keep_by='table_data')
+    assert len(deduplicated) == 5000
+    assert deduplicated['name'].is_unique
+    is_duplicated = deduplicated['name'].astype(int) < 110
+    assert np.all(deduplicated['table_data'][is_duplicated] == -1.)  # the duplicates sort first, so are kept
+    assert np.all(deduplicated.index[is_duplicated] >= 5000)
+
+    deduplicated, _ = matching_utils.deduplicate_catalog(Table.from_pandas(duplicated_catalog), 1 * units.arcsec, keep='last')
+    assert isinstance(deduplicated, Table)
+    assert len(deduplicated) == 5000
+    assert list(deduplicated['table_data'][-110:]) == [-1.] * 110  # the last of each group are the (last) duplicates
+
+
+def test_match_cache(tmpdir, random_catalog, random_galaxies):
+    cache = matching_utils.MatchCache(tmpdir.join('cache').strpath)
+    galaxies_df, catalog_df = random_galaxies.to_pandas(), random_catalog.to_pandas()
+
+    expected, expected_unmatched = matching_utils.match_galaxies_to_catalog_pandas(galaxies_df.copy(), catalog_df.copy())
+    for _ in range(2):
+        matched, unmatched = matching_utils.match_galaxies_to_catalog_pandas(
+            galaxies_df.copy(), catalog_df.copy(), match_cache=cache)
+        pd.testing.assert_frame_equal(matched, expected)
+        pd.testing.assert_frame_equal(unmatched, expected_unmatched)
+    assert (cache.hits, cache.misses) == (1, 1)
+
+    # Tables with the same positions share the entry, even with units
+    random_galaxies['ra'].unit = units.deg
+    result = matching_utils.match_galaxies_to_catalog_lazy(random_galaxies, random_catalog, match_cache=cache)
+    assert list(result.matched()['name_subject']) == list(expected['name_subject'])
+    assert cache.hits == 2
+
+    # moving one galaxy misses
+    galaxies_df.loc[0, 'ra'] += 1e-9
+    matching_utils.match_galaxies_to_catalog_lazy(galaxies_df, catalog_df, match_cache=cache)
+    assert (cache.hits, cache.misses) == (2, 2)
+
+
+def test_match_cache_eviction(tmpdir):
+    cache = matching_utils.MatchCache(tmpdir.join('cache').strpath, max_bytes=2500)
+    for n in range(3):
+        cache.put(cache.key(n), values=np.zeros(100))  # about 1kB each
+        os.utime(cache._entry_loc(cache.key(n)), (n, n))
+    assert cache.get(cache.key(0)) is None  # least recently used, so evicted
+    assert cache.get(cache.key(1)) is not None  # and now most recently used
+    cache.put(cache.key(3), values=np.zeros(100))
+    assert cache.get(cache.key(2)) is None
+    assert cache.get(cache.key(1)) is not None
+    assert cache.size_bytes <= 2500
+    cache.clear()
+    assert cache.size_bytes == 0
@@ -0,0 +1,219 @@
+import pytest
+
+import os
+import json
+
+import numpy as np
+import pandas as pd
+
+from shared_astro_utils import panoptes_utils, columnar_utils
+
+
+@pytest.fixture()
+def subject_export():
+    metadata = [
+        {'!iauname': 'J000001', 'ra': 1.5, '!ra': 10., '#retirement_limit': 40, '!empty': None},
+        {'!iauname': 'J000002', 'ra': 2.5, '!ra': 20., '#retirement_limit': 40, '!empty': None, 'extra': 'only_here'},
+        {'!iauname': 'J000003', 'ra': 3.5, '!ra': 30., '#retirement_limit': 40, '!empty': None}
+    ]
+    return pd.DataFrame({
+        'subject_id': [11, 12, 13],
+        'workflow_id': [np.nan, np.nan, np.nan],
+        'metadata': [json.dumps(m) for m in metadata],
+        'locations': [json.dumps({'0': 'https://example.com/{}.png'.format(n)}) for n in range(3)]
+    }, index=[5, 6, 7])
+
+
+def test_load_current_subjects(subject_export):
+    subjects = panoptes_utils.load_current_subjects(subject_export)
+    assert list(subjects.columns) == [
+        'index', 'subject_id', 'metadata', 'locations', 'ra', '#retirement_limit', 'extra', 'iauname']
+    assert list(subjects['iauname']) == ['J000001', 'J000002', 'J000003']
+    assert list(subjects['ra']) == [10., 20., 30.]  # hidden column replaces existing column of the same name
+    assert list(subjects['locations']) == ['https://example.com/{}.png'.format(n) for n in range(3)]
+    assert '!iauname' in json.loads(subject_export['metadata'].iloc[0])  # input not modified
+
+
+def test_load_current_subjects_vectorized_matches_rowwise(subject_export, with_orjson):
+    pd.testing.assert_frame_equal(
+        panoptes_utils.load_current_subjects(subject_export, vectorized=True),
+        panoptes_utils.load_current_subjects(subject_export, vectorized=False)
+    )
+
+
+def test_split_json_str_to_columns_vectorized_matches_rowwise(subject_export):
+    pd.testing.assert_frame_equal(
+        panoptes_utils.split_json_str_to_columns(subject_export, 'metadata', vectorized=True),
+        panoptes_utils.split_json_str_to_columns(subject_export, 'metadata', vectorized=False)
+    )
+
+
+@pytest.fixture(params=[True, False])
+def with_orjson(request, monkeypatch):
+    if not request.param:
+        monkeypatch.setattr(panoptes_utils, 'orjson', None)
+    return request.param
+
+
+def test_parse_json_column(with_orjson):
+    json_strs = pd.Series(['{"a": 1}', '{"a": NaN}', '[1, 2]'])  # NaN is valid for json, but not orjson
+    parsed = panoptes_utils.parse_json_column(json_strs)
+    assert parsed[0] == {'a': 1}
+    assert np.isnan(parsed[1]['a'])
+    assert parsed[2] == [1, 2]
+
+
+@pytest.mark.parametrize('bad_row', ['', '{"a": 2}, {"a": 3}', 'not json'])
+def test_parse_json_column_bad_row(with_orjson, bad_row):
+    # the bad row must not shift later rows onto the wrong values
+    json_strs = pd.Series(['{"a": 1}', bad_row, '{"a": 4}'])
+    with pytest.raises(ValueError, match='row 1'):
+        panoptes_utils.parse_json_column(json_strs)
+
+
+def test_load_current_subjects_empty():
+    with pytest.raises(ValueError):
+        panoptes_utils.load_current_subjects(pd.DataFrame())
+
+
+@pytest.fixture()
+def subject_export_loc(tmpdir):
+    metadata = [
+        {'!iauname': 'J{:06d}'.format(n), 'ra': n + 0.5, '#retirement_limit': 40}
+        for n in range(7)
+    ]
+    metadata[5]['late_key'] = 'only_in_later_chunk'
+    metadata[6]['#retirement_limit'] = 40.5  # int in the first chunk, float later
+    df = pd.DataFrame({
+        'subject_id': range(100, 107),
+        'workflow_id': np.nan,
+        'metadata': [json.dumps(m) for m in metadata],
+        'locations': [json.dumps({'0': 'https://example.com/{}.png'.format(n)}) for n in range(7)]
+    })
+    loc = tmpdir.join('subjects_export.csv').strpath
+    df.to_csv(loc, index=False)
+    return loc
+
+
+@pytest.mark.parametrize('extension', ['.parquet', '.feather', '.csv'])
+def test_stream_current_subjects(tmpdir, subject_export_loc, extension):
+    save_loc = tmpdir.join('subjects' + extension).strpath
+    n_subjects = panoptes_utils.stream_current_subjects(subject_export_loc, save_loc, chunk_size=3)
+    assert n_subjects == 7
+
+    streamed = columnar_utils.read_table(save_loc)
+    loaded = panoptes_utils.load_current_subjects(pd.read_csv(subject_export_loc))
+    # empty columns are kept, as are keys first seen after the first chunk and ints which become floats
+    assert 'workflow_id' in streamed.columns
+    assert streamed['late_key'].tolist()[5] == 'only_in_later_chunk'
+    assert streamed['#retirement_limit'].tolist() == [40.] * 6 + [40.5]
+    for col in ['index', 'subject_id', 'ra', 'iauname', '#retirement_limit', 'locations', 'metadata']:
+        assert streamed[col].tolist() == loaded[col].tolist(), col
+
+
+def test_stream_current_subjects_selected_cols(tmpdir, subject_export_loc):
+    save_loc = tmpdir.join('subjects.parquet').strpath
+    panoptes_utils.stream_current_subjects(
+        subject_export_loc, save_loc, usecols=['subject_id'], metadata_keys=['iauname', 'late_key'], chunk_size=3)
+    streamed = columnar_utils.read_table(save_loc)
+    assert list(streamed.columns) == ['index', 'subject_id', 'locations', 'iauname', 'late_key']
+    assert streamed['late_key'].tolist()[5] == 'only_in_later_chunk'
+
+
+def write_export(loc, n_subjects, created_at=None, ra_offset=0.):
+    df = pd.DataFrame({
+        'subject_id': range(100, 100 + n_subjects),
+        'metadata': [json.dumps({'!iauname': 'J{:06d}'.format(n), 'ra': n + ra_offset}) for n in range(n_subjects)],
+        'locations': [json.dumps({'0': 'https://example.com/{}.png'.format(n)}) for n in range(n_subjects)],
+        'created_at': created_at if created_at is not None else ['2019-01-0{} 12:00:00 UTC'.format(n % 9 + 1) for n in range(n_subjects)]
+    })
+    df.to_csv(loc, index=False)
+
+
+def test_ingest_new_subjects(tmpdir):
+    export_loc = tmpdir.join('export.csv').strpath
+    table_dir = tmpdir.join('subjects').strpath
+
+    write_export(export_loc, 5)
+    assert panoptes_utils.ingest_new_subjects(export_loc, table_dir, chunk_size=2) == 5
+    assert panoptes_utils.read_watermark(table_dir)['value'] == 104
+    assert len(panoptes_utils.read_watermark(table_dir)['parts']) == 3
+
+    write_export(export_loc, 8, ra_offset=100.)  # changes to existing subjects are ignored
+    assert panoptes_utils.ingest_new_subjects(export_loc, table_dir, chunk_size=2) == 3
+    assert panoptes_utils.ingest_new_subjects(export_loc, table_dir, chunk_size=2) == 0
+
+    subjects = panoptes_utils.load_ingested_subjects(table_dir)
+    assert subjects['subject_id'].tolist() == list(range(100, 108))
+    assert subjects['iauname'].tolist() == ['J{:06d}'.format(n) for n in range(8)]
+    assert subjects['ra'].tolist() == [0., 1., 2., 3., 4., 105., 106., 107.]
+    assert panoptes_utils.read_watermark(table_dir)['value'] == 107
+
+    assert panoptes_utils.load_ingested_subjects(table_dir, columns=['iauname']).columns.tolist() == ['iauname']
+
+
+def test_ingest_new_subjects_widens_schema(tmpdir):
+    export_loc = tmpdir.join('export.csv').strpath
+    table_dir = tmpdir.join('subjects').strpath
+
+    def write_export_with_metadata(metadata):
+        pd.DataFrame({
+            'subject_id': range(100, 100 + len(metadata)),
+            'metadata': [json.dumps(m) for m in metadata],
+            'locations': [json.dumps({'0': 'https://example.com/{}.png'.format(n)}) for n in range(len(metadata))]
+        }).to_csv(export_loc, index=False)
+
+    metadata = [{'!iauname': 'J{:06d}'.format(n), 'stage': n} for n in range(3)]
+    write_export_with_metadata(metadata)
+    panoptes_utils.ingest_new_subjects(export_loc, table_dir, chunk_size=2)
+
+    # a later export adds a key, and has a float value for what was an int key
+    metadata += [{'!iauname': 'J000003', 'stage': 3.5, 'new_key': 'a'}, {'!iauname': 'J000004', 'stage': 4}]
+    write_export_with_metadata(metadata)
+    assert panoptes_utils.ingest_new_subjects(export_loc, table_dir, chunk_size=2) == 2
+
+    subjects = panoptes_utils.load_ingested_subjects(table_dir)
+    assert subjects['subject_id'].tolist() == list(range(100, 105))
+    assert subjects['stage'].tolist() == [0., 1., 2., 3.5, 4.]
+    assert subjects['new_key'].isna().tolist() == [True, True, True, False, True]
+    assert subjects['new_key'][3] == 'a'
+    assert panoptes_utils.load_ingested_subjects(table_dir, columns=['new_key'])['new_key'][3] == 'a'
+
+
+def test_ingest_new_subjects_upsert(tmpdir):
+    export_loc = tmpdir.join('export.csv').strpath
+    table_dir = tmpdir.join('subjects').strpath
+
+    write_export(export_loc, 4, created_at=['2019-01-01 12:00:00 UTC'] * 2 + ['2019-01-02 12:00:00 UTC'] * 2)
+    panoptes_utils.ingest_new_subjects(
+        export_loc, table_dir, watermark_col='created_at', upsert=True, usecols=['subject_id'], chunk_size=3)
+    assert panoptes_utils.read_watermark(table_dir)['value'] == '2019-01-02T12:00:00+00:00'
+
+    # a later export has another subject created in the same second as the watermark, and two newer subjects
+    write_export(
+        export_loc, 7, ra_offset=100.,
+        created_at=['2019-01-01 12:00:00 UTC'] * 2 + ['2019-01-02 12:00:00 UTC'] * 3 + ['2019-01-03 12:00:00 UTC'] * 2)
+    assert panoptes_utils.ingest_new_subjects(
+        export_loc, table_dir, watermark_col='created_at', upsert=True, usecols=['subject_id'], chunk_size=3) == 5
+
+    subjects = panoptes_utils.load_ingested_subjects(table_dir).sort_values('subject_id')
+    assert subjects['subject_id'].tolist() == list(range(100, 107))  # no duplicates
+    assert subjects['ra'].tolist() == [0., 1., 102., 103., 104., 105., 106.]  # rows at the watermark replaced
+    assert list(subjects.columns) == ['index', 'subject_id', 'locations', 'ra', 'iauname']
+
+    with pytest.raises(ValueError):
+        panoptes_utils.ingest_new_subjects(export_loc, table_dir, watermark_col='subject_id')
+
+
+def test_ingest_new_subjects_after_failure(tmpdir):
+    export_loc = tmpdir.join('export.csv').strpath
+    table_dir = tmpdir.join('subjects').strpath
+    write_export(export_loc, 3)
+    panoptes_utils.ingest_new_subjects(export_loc, table_dir)
+    # as if an ingest died after writing a part, but before recording it in the watermark
+    tmpdir.join('subjects', 'part-000001.parquet').write('partial')
+    tmpdir.join('subjects', '.part-000002.parquet.tmp').write('partial')
+    write_export(export_loc, 4)
+    assert panoptes_utils.ingest_new_subjects(export_loc, table_dir) == 1
+    assert sorted(os.listdir(table_dir)) == ['_watermark.json', 'part-000000.parquet', 'part-000001.parquet']
+    assert panoptes_utils.load_ingested_subjects(table_dir)['subject_id'].tolist() == [100, 101, 102, 103]
@@ -3,6 +3,7 @@ import pytest
 import os
 
 import numpy as np
+from PIL import Image
 
 from shared_astro_utils.tests import TEST_FIGURE_DIR
 from shared_astro_utils import plotting_utils
@@ -24,3 +25,47 @@ def test_plot_galaxy_grid_no_labels(galaxies):
 
 def test_plot_galaxy_grid_with_labels(galaxies):
     plotting_utils.plot_galaxy_grid(galaxies, 9, 3, os.path.join(TEST_FIGURE_DIR, 'galaxy_grid.png'))
+
+
+def test_plot_galaxy_grid_fast(tmpdir, galaxies, labels):
+    save_loc = tmpdir.join('galaxy_grid.png').strpath
+    plotting_utils.plot_galaxy_grid(galaxies, 9, 3, save_loc, labels=labels, fast=True)
+    assert Image.open(save_loc).size == (3 * 128 + 2 * 3, 9 * 128 + 8 * 3)  # width, height
+
+
+def test_galaxy_mosaic(galaxies):
+    mosaic = plotting_utils.galaxy_mosaic(galaxies, 9, 3)
+    assert mosaic.dtype == np.uint8
+    # row-major, as plot_galaxy_grid
+    assert np.array_equal(mosaic[:128, :128], galaxies[0].astype(np.uint8))
+    assert np.array_equal(mosaic[131:259, 262:390], galaxies[5].astype(np.uint8))
+    assert np.all(mosaic[:, 128:131] == 255)
+
+
+def test_galaxy_mosaic_missing_galaxies_and_labels(galaxies):
+    unlabelled = plotting_utils.galaxy_mosaic(galaxies[:4, :, :, :1], 2, 3)
+    assert unlabelled.shape == (259, 390, 1)
+    assert np.all(unlabelled[131:, 262:] == 255)  # missing
+    mosaic = plotting_utils.galaxy_mosaic(galaxies[:4, :, :, :1], 2, 3, labels=['a', 'b', 'c', 'd'])
+    assert mosaic.shape == (259, 390, 3)  # red labels need colour
+    label_pixels = np.any(mosaic != unlabelled, axis=2)
+    assert label_pixels[:128, :128].any() and label_pixels[131:, :128].any()
+    assert not label_pixels[131:, 262:].any()
+
+
+def test_save_galaxy_mosaics(tmpdir, galaxies, labels):
+    save_locs = [tmpdir.join('grid_{}.jpg'.format(n)).strpath for n in range(7)]
+    plotting_utils.save_galaxy_mosaics(galaxies, 2, 2, save_locs, labels=labels, max_workers=2)
+    for save_loc in save_locs:
+        assert Image.open(save_loc).size == (259, 259)
+
+
+def test_out_of_range_pixels_clipped(tmpdir, monkeypatch):
+    galaxies = np.array([-1., 0., 255., 256., 300.]).reshape(1, 1, 5, 1) * np.ones((1, 4, 1, 3))
+    expected = np.array([0, 0, 255, 255, 255], dtype=np.uint8).reshape(1, 5, 1) * np.ones((4, 1, 3), dtype=np.uint8)
+    assert np.array_equal(plotting_utils.galaxy_mosaic(galaxies, 1, 1), expected)
+
+    shown = []
+    monkeypatch.setattr(plotting_utils.matplotlib.axes.Axes, 'imshow', lambda ax, data: shown.append(data))
+    plotting_utils.plot_galaxy_grid(galaxies, 1, 1, tmpdir.join('galaxy_grid.png').strpath)
+    assert np.array_equal(shown[0], expected)  # the same conversion as galaxy_mosaic
@@ -0,0 +1,98 @@
+import pytest
+
+import struct
+
+import pandas as pd
+
+from shared_astro_utils import preflight_utils
+
+
+def png_bytes(width=424, height=424, n_bytes=100):
+    header = b'\x89PNG\r\n\x1a\n' + struct.pack('>I', 13) + b'IHDR' + struct.pack('>II', width, height)
+    return header + bytes(n_bytes)
+
+
+@pytest.fixture()
+def image_locs(tmpdir):
+    files = {
+        'good.png': png_bytes(),
+        'good.jpg': b'\xff\xd8\xff\xe0' + bytes(100),
+        'good.gif': b'GIF89a' + bytes(100),
+        'empty.png': b'',
+        'large.png': png_bytes(n_bytes=2000),
+        'not_an_image.png': b'<html>404 Not Found</html>',
+        'zero_width.png': png_bytes(width=0),
+        'truncated.png': png_bytes()[:12]
+    }
+    locs = {}
+    for name, contents in files.items():
+        loc = tmpdir.join(name)
+        loc.write_binary(contents)
+        locs[name] = loc.strpath
+    locs['missing.png'] = tmpdir.join('missing.png').strpath
+    locs['directory'] = tmpdir.mkdir('directory').strpath
+    return locs
+
+
+def test_check_location(image_locs):
+    expected = {
+        'good.png': None,
+        'good.jpg': None,
+        'good.gif': None,
+        'empty.png': 'empty',
+        'large.png': 'too_large',
+        'not_an_image.png': 'bad_header',
+        'zero_width.png': 'bad_header',
+        'truncated.png': 'bad_header',
+        'missing.png': 'missing',
+        'directory': 'not_a_file'
+    }
+    for name, problem in expected.items():
+        assert preflight_utils.check_location(image_locs[name], max_bytes=1000) == problem, name
+
+
+def test_check_location_no_size_limit(image_locs):
+    assert preflight_utils.check_location(image_locs['large.png'], max_bytes=None) is None
+
+
+def test_check_locations(image_locs):
+    locations = list(image_locs.values()) * 3  # duplicates are checked once
+    problems = preflight_utils.check_locations(locations, max_bytes=1000, max_workers=4)
+    assert set(problems.keys()) == {
+        image_locs[name] for name in
+        ['empty.png', 'large.png', 'not_an_image.png', 'zero_width.png', 'truncated.png', 'missing.png', 'directory']
+    }
+
+
+def test_preflight_manifest(image_locs):
+    manifest = [
+        {'locations': [image_locs['good.png']], 'metadata': {'!filename': 'a'}},
+        {'locations': [image_locs['good.jpg'], image_locs['missing.png']], 'metadata': {'!filename': 'b'}},
+        {'locations': [image_locs['empty.png']], 'metadata': {'!filename': 'c'}},
+        {'locations': [image_locs['good.gif']], 'metadata': {'!filename': 'd'}}
+    ]
+    kept, report = preflight_utils.preflight_manifest(iter(manifest))
+    assert kept == manifest
+    assert report['checked'] == 5
+    assert report['bad'] == 2
+    assert report['problems'] == {'missing': 1, 'empty': 1}
+    assert report['examples']['missing'] == [image_locs['missing.png']]
+    assert report['dropped'] == 0
+
+    kept, report = preflight_utils.preflight_manifest(manifest, drop_bad=True)
+    assert [entry['metadata']['!filename'] for entry in kept] == ['a', 'd']
+    assert report['dropped'] == 2
+
+
+def test_preflight_catalog(image_locs):
+    catalog = pd.DataFrame([
+        {'iauname': 'a', 'file_loc': image_locs['good.png']},
+        {'iauname': 'b', 'file_loc': image_locs['not_an_image.png']},
+        {'iauname': 'c', 'file_loc': image_locs['good.png']}
+    ])
+    kept, report = preflight_utils.preflight_catalog(catalog, drop_bad=True)
+    assert list(kept['iauname']) == ['a', 'c']
+    assert report['checked'] == 2
+    assert report['problems'] == {'bad_header': 1}
+    assert report['dropped'] == 1
+    assert len(catalog) == 3  # not modified inplace
@@ -0,0 +1,114 @@
+import pytest
+
+import time
+
+from panoptes_client import panoptes
+
+from shared_astro_utils import rate_limit_utils
+
+
+@pytest.fixture()
+def limiter():
+    return rate_limit_utils.AdaptiveRateLimiter(max_rate=1000., max_retries=3, base_delay=0.001, max_delay=0.01)
+
+
+class FlakyCall():
+    # fails with the given errors, in order, then succeeds
+
+    def __init__(self, errors):
+        self.errors = list(errors)
+        self.n_calls = 0
+
+    def __call__(self, value):
+        self.n_calls += 1
+        if self.errors:
+            raise self.errors.pop(0)
+        return value
+
+
+def test_token_bucket_limits_rate():
+    bucket = rate_limit_utils.TokenBucket(rate=100., burst=1.)
+    start = time.monotonic()
+    waits = [bucket.acquire() for _ in range(21)]
+    elapsed = time.monotonic() - start
+    assert waits[0] == 0.  # first token is free
+    assert 0.15 < elapsed < 0.5  # then 100 per second
+
+
+def test_retries_transient_errors(limiter):
+    flaky = FlakyCall([
+        panoptes.PanoptesAPIException('Received HTTP status code 503 from API'),
+        rate_limit_utils.requests.exceptions.ConnectionError('connection reset')
+    ])
+    assert limiter.call(flaky, 'some_value') == 'some_value'
+    assert flaky.n_calls == 3
+    assert limiter.stats['retries'] == 2
+    assert limiter.stats['failures'] == 0
+
+
+def test_does_not_retry_other_errors(limiter):
+    flaky = FlakyCall([panoptes.PanoptesAPIException('Received HTTP status code 404 from API')])
+    with pytest.raises(panoptes.PanoptesAPIException):
+        limiter.call(flaky, 'some_value')
+    assert flaky.n_calls == 1
+
+    flaky = FlakyCall([FileNotFoundError('Missing subject location: a.png')])
+    with pytest.raises(FileNotFoundError):
+        limiter.call(flaky, 'some_value')
+    assert limiter.stats['retries'] == 0
+
+
+def test_gives_up_after_max_retries(limiter):
+    flaky = FlakyCall([panoptes.PanoptesAPIException('Received HTTP status code 502 from API')] * 10)
+    with pytest.raises(panoptes.PanoptesAPIException):
+        limiter.call(flaky, 'some_value')
+    assert flaky.n_calls == limiter.max_retries + 1
+    assert limiter.stats['failures'] == 1
+
+
+def test_adaptive_rate(limiter):
+    flaky = FlakyCall([panoptes.PanoptesAPIException('429 Too Many Requests')] * 3)
+    limiter.call(flaky, 'some_value')
+    assert limiter.stats['throttle_responses'] == 3
+    # halved three times, then one success
+    assert limiter.rate == pytest.approx(1000. / 8 + limiter.recovery_step)
+
+    for _ in range(100):
+        limiter.call(lambda: None)
+    assert limiter.rate == limiter.max_rate  # ramped back up
+
+
+def test_non_adaptive_rate():
+    limiter = rate_limit_utils.AdaptiveRateLimiter(max_rate=1000., adaptive=False, base_delay=0.001)
+    limiter.call(FlakyCall([panoptes.PanoptesAPIException('429 Too Many Requests')]), 'some_value')
+    assert limiter.rate == 1000.
+
+
+def test_creates_only_retry_errors_with_no_effect(limiter):
+    unsent = rate_limit_utils.requests.exceptions.ConnectionError(
+        rate_limit_utils.urllib3.exceptions.MaxRetryError(
+            None, '/subjects', rate_limit_utils.urllib3.exceptions.NewConnectionError(None, 'refused')))
+    flaky = FlakyCall([panoptes.PanoptesAPIException('Received HTTP status code 429 from API'), unsent])
+    assert limiter.call_create(flaky, 'some_value') == 'some_value'
+    assert flaky.n_calls == 3
+
+    # the server may have created the object before failing, so retrying could create a duplicate
+    for error in [
+            panoptes.PanoptesAPIException('Received HTTP status code 503 from API'),
+            rate_limit_utils.requests.exceptions.ConnectionError('connection reset'),
+            rate_limit_utils.requests.exceptions.ReadTimeout('read timed out')]:
+        flaky = FlakyCall([error])
+        with pytest.raises(type(error)):
+            limiter.call_create(flaky, 'some_value')
+        assert flaky.n_calls == 1
+
+
+def test_http_status():
+    response = rate_limit_utils.requests.Response()
+    response.status_code = 502
+    assert rate_limit_utils.is_transient_error(rate_limit_utils.requests.exceptions.HTTPError(response=response))
+    response.status_code = 404
+    assert not rate_limit_utils.is_transient_error(rate_limit_utils.requests.exceptions.HTTPError(response=response))
+    # numbers in other messages are not statuses
+    assert not rate_limit_utils.is_transient_error(panoptes.PanoptesAPIException('Could not find subject with id 503'))
+    assert not rate_limit_utils.is_throttling_error(panoptes.PanoptesAPIException('File is 429 bytes too large'))
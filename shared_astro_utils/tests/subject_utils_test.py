@@ -0,0 +1,190 @@
+import pytest
+
+import time
+import threading
+
+from shared_astro_utils import subject_utils
+
+
+class FakeSubjectSet():
+
+    def __init__(self, name):
+        self.display_name = name
+
+
+@pytest.fixture()
+def fake_api(monkeypatch):
+    # pretend Panoptes, recording each (slow) query and creation
+    subject_utils.clear_subject_set_cache()
+    calls = {'get': 0, 'create': 0}
+    existing = {}
+    lock = threading.Lock()
+
+    def fake_get_subject_set(project_id, name):
+        with lock:
+            calls['get'] += 1
+        time.sleep(0.01)
+        try:
+            return existing[name]
+        except KeyError:
+            raise ValueError(f'Project {project_id} has no subject set {name}')
+
+    def fake_create_subject_set(project_id, name):
+        with lock:
+            calls['create'] += 1
+        time.sleep(0.01)
+        existing[name] = FakeSubjectSet(name)
+        return existing[name]
+
+    monkeypatch.setattr(subject_utils, 'get_subject_set', fake_get_subject_set)
+    monkeypatch.setattr(subject_utils, 'create_subject_set', fake_create_subject_set)
+    yield calls
+    subject_utils.clear_subject_set_cache()
+
+
+def test_get_or_create_subject_set_is_cached(fake_api):
+    subject_set = subject_utils.get_or_create_subject_set(5733, 'some_set')
+    assert fake_api == {'get': 1, 'create': 1}
+    for _ in range(10):
+        # project id as str or int
+        assert subject_utils.get_or_create_subject_set('5733', 'some_set') is subject_set
+    assert fake_api == {'get': 1, 'create': 1}
+
+    subject_utils.invalidate_subject_set(5733, 'some_set')
+    assert subject_utils.get_or_create_subject_set(5733, 'some_set') is subject_set
+    assert fake_api == {'get': 2, 'create': 1}  # re-fetched, but not re-created
+
+
+def test_get_or_create_subject_set_ttl(fake_api):
+    subject_utils.get_or_create_subject_set(5733, 'some_set', ttl=0.)
+    subject_utils.get_or_create_subject_set(5733, 'some_set', ttl=0.)
+    assert fake_api == {'get': 2, 'create': 1}
+
+
+def test_get_or_create_subject_set_threadsafe(fake_api):
+    results = []
+    threads = [
+        threading.Thread(target=lambda: results.append(subject_utils.get_or_create_subject_set(5733, 'some_set')))
+        for _ in range(8)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    assert fake_api['create'] == 1
+    assert all(subject_set is results[0] for subject_set in results)
+
+
+def test_make_subject_sets(fake_api):
+    subject_sets = subject_utils.make_subject_sets(5733, ['a', 'b', 'c'])
+    assert [subject_set.display_name for subject_set in subject_sets] == ['a', 'b', 'c']
+
+
+class FakePanoptes():
+    # stand-in for panoptes_client.Panoptes, counting logins and token refreshes
+    _local = threading.local()
+    n_connects = 0
+
+    def __init__(self, username, password):
+        self.username = username
+        self.bearer_token = None
+        self.token_valid = True
+        self.n_refreshes = 0
+
+    @classmethod
+    def connect(cls, **credentials):
+        cls.n_connects += 1
+        return cls(**credentials)
+
+    def valid_bearer_token(self):
+        return self.token_valid
+
+    def __enter__(self):
+        self._local.previous_client = getattr(self._local, 'panoptes_client', None)
+        self._local.panoptes_client = self
+        return self
+
+    def __exit__(self, *exc):
+        self._local.panoptes_client = self._local.previous_client
+
+    def get_bearer_token(self):
+        if self.username == 'cannot_refresh':
+            raise subject_utils.panoptes.PanoptesAPIException('invalid_grant')
+        self.n_refreshes += 1
+        self.token_valid = True
+        return self.bearer_token
+
+
+@pytest.fixture()
+def fake_panoptes(monkeypatch):
+    FakePanoptes.n_connects = 0
+    monkeypatch.setattr(subject_utils, 'Panoptes', FakePanoptes)
+    monkeypatch.setattr(subject_utils, '_session', {'client': None, 'login_loc': None})
+    return FakePanoptes
+
+
+@pytest.fixture()
+def login_loc(tmpdir):
+    loc = tmpdir.join('secret_login.json')
+    loc.write('{"username": "some_user", "password": "some_password"}')
+    return loc.strpath
+
+
+def test_authenticate_connects_once(fake_panoptes, login_loc):
+    subject_utils.time_utils.TIMINGS.reset()
+    client = subject_utils.authenticate(login_loc)
+    for _ in range(5):
+        assert subject_utils.authenticate(login_loc) is client
+    assert fake_panoptes.n_connects == 1
+    assert fake_panoptes._local.panoptes_client is client
+    assert subject_utils.time_utils.TIMINGS.calls['panoptes_auth'] == 1
+
+    # other threads share the same client
+    other_thread_clients = []
+    thread = threading.Thread(target=lambda: other_thread_clients.append(subject_utils.authenticate(login_loc)))
+    thread.start()
+    thread.join()
+    assert other_thread_clients == [client]
+    assert fake_panoptes.n_connects == 1
+
+
+def test_authenticate_login_loc_from_env(fake_panoptes, login_loc, monkeypatch):
+    monkeypatch.setenv(subject_utils.LOGIN_LOC_ENV_VAR, login_loc)
+    client = subject_utils.authenticate()
+    assert client.username == 'some_user'
+
+
+def test_authenticate_refreshes_expired_token(fake_panoptes, login_loc):
+    client = subject_utils.authenticate(login_loc)
+    client.bearer_token = 'some_token'
+    client.token_valid = False
+    assert subject_utils.authenticate(login_loc) is client
+    assert client.n_refreshes == 1
+    assert fake_panoptes.n_connects == 1
+
+    client.username = 'cannot_refresh'
+    client.token_valid = False
+    new_client = subject_utils.authenticate(login_loc)
+    assert new_client is not client
+    assert fake_panoptes.n_connects == 2
+
+
+def test_reauthenticate(fake_panoptes, login_loc):
+    client = subject_utils.authenticate(login_loc)
+    assert subject_utils.reauthenticate() is not client  # with the same login_loc
+    assert fake_panoptes.n_connects == 2
+    assert subject_utils.is_auth_error(subject_utils.panoptes.PanoptesAPIException('401 Unauthorized'))
+    assert not subject_utils.is_auth_error(subject_utils.panoptes.PanoptesAPIException('Received HTTP status code 503'))
+
+
+def test_is_auth_error():
+    PanoptesAPIException = subject_utils.panoptes.PanoptesAPIException
+    assert subject_utils.is_auth_error(PanoptesAPIException('invalid_grant'))
+    assert subject_utils.is_auth_error(PanoptesAPIException('The access token expired'))
+    assert subject_utils.is_auth_error(PanoptesAPIException('You must be logged in to access this resource.'))
+    response = subject_utils.rate_limit_utils.requests.Response()
+    response.status_code = 403
+    assert subject_utils.is_auth_error(subject_utils.rate_limit_utils.requests.exceptions.HTTPError(response=response))
+    # other errors which happen to mention tokens, or 401, are not
+    assert not subject_utils.is_auth_error(ValueError('Unexpected token < in JSON at position 0'))
+    assert not subject_utils.is_auth_error(PanoptesAPIException('Could not find subject with id 401'))
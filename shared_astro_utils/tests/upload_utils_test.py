@@ -1,8 +1,14 @@
 import pytest
 
+import os
+import time
+import random
+import threading
+
+import numpy as np
 import pandas as pd
 
-from shared_astro_utils import upload_utils
+from shared_astro_utils import upload_utils, journal_utils
 
 TEST_EXAMPLES_DIR = 'python/test_examples'
 
@@ -20,22 +26,65 @@ def joint_catalog():
             'nsa_version': '1_0_0',
             'z': 0.1,
             'png_loc': 'jpeg_here.png',
-            'fits_loc': 'fits_there.fits'
+            'fits_loc': 'fits_there.fits',
+            'file_loc': 'some/dir/jpeg_here.png'
         }
     ])
 
 
+@pytest.fixture()
+def awkward_catalog():
+    # nan, inf, bytes, float32 and mixed-type object columns, as found in real NSA/DECaLS catalogs
+    return pd.DataFrame({
+        'iauname': [b'J094552.53-000534.1', 'J094552.53-000534.2', b'J094552.53-000534.3'],
+        'ra': [147.45674, 0.1, 359.99999999],
+        'dec': [1.09255, -0.5, -89.123456789],
+        'redshift': np.array([0.1, np.nan, np.inf], dtype=np.float32),
+        'nsa_id': [1, 2, 3],
+        'mixed': [np.nan, 'a_string', 4.],
+        'is_good': [True, False, True],
+        'file_loc': ['dir/a.png', 'dir/b.png', 'dir/c.png']
+    })
+
+
 def test_create_manifest_from_joint_catalog(joint_catalog):
     new_manifest = upload_utils.create_manifest_from_catalog(joint_catalog)
     assert len(new_manifest) == len(joint_catalog)
     entry = new_manifest[0]
-    assert entry['png_loc'] == 'jpeg_here.png'
-    assert type(entry['key_data']) == dict
-    assert entry['key_data']['!ra'] == 147.45674
-    assert type(entry['key_data']['!sdss_search'] == str)
-    assert type(entry['key_data']['!decals_search'] == str)
-    assert type(entry['key_data']['!simbad_search'] == str)
-    assert type(entry['key_data']['!nasa_ned_search'] == str)
+    assert entry['!png_loc'] == 'jpeg_here.png'
+    assert entry['!filename'] == 'jpeg_here.png'
+    assert entry['!ra'] == 147.45674
+    assert type(entry['!sdss_search']) == str
+    assert type(entry['!decals_search']) == str
+    assert type(entry['!simbad_search']) == str
+    assert type(entry['!nasa_ned_search']) == str
+
+
+def test_create_manifest_from_catalog_vectorized_matches_rowwise(awkward_catalog):
+    vectorized = upload_utils.create_manifest_from_catalog(awkward_catalog)
+    rowwise = upload_utils.create_manifest_from_catalog(awkward_catalog, vectorized=False)
+    assert vectorized == rowwise
+    # and the inputs were cleaned as before
+    assert vectorized[0]['!iauname'] == 'J094552.53-000534.1'
+    assert vectorized[1]['!redshift'] == -999.
+    assert vectorized[0]['!mixed'] == -999.
+
+
+def test_add_search_links_matches_coords_to_urls(awkward_catalog):
+    df = upload_utils.add_search_links(awkward_catalog.copy())
+    for n, galaxy in awkward_catalog.iterrows():
+        ra, dec = galaxy['ra'], galaxy['dec']
+        expected_urls = {
+            'decals_search': upload_utils.coords_to_decals_skyviewer(ra, dec),
+            'sdss_search': upload_utils.coords_to_sdss_navigate(ra, dec),
+            'panstarrs_dr1_search': upload_utils.coords_to_panstarrs(ra, dec),
+            'simbad_search': upload_utils.coords_to_simbad(ra, dec, search_radius=10.),
+            'nasa_ned_search': upload_utils.coords_to_ned(ra, dec, search_radius=10.),
+            'vizier_search': upload_utils.coords_to_vizier(ra, dec, search_radius=10.)
+        }
+        for link_column, url in expected_urls.items():
+            display_text = upload_utils.SEARCH_LINK_TEXT[link_column]
+            assert df.loc[n, link_column] == upload_utils.wrap_url_in_new_tab_markdown(url, display_text)
 
 
 def test_coords_to_decals_skyviewer(joint_catalog):
@@ -92,3 +141,134 @@ def test_replace_bytes_with_str():
     not_byt = 'hello world'
     string = upload_utils.replace_bytes_with_str(not_byt)
     assert type(string) == str
+
+
+def test_iter_manifest_from_catalog(awkward_catalog):
+    manifest_iter = upload_utils.iter_manifest_from_catalog(awkward_catalog, chunk_size=2)
+    assert not isinstance(manifest_iter, list)  # lazy
+    assert list(manifest_iter) == upload_utils.create_manifest_from_catalog(awkward_catalog)
+
+
+def test_manifest_record_to_upload_entry(joint_catalog):
+    record = upload_utils.create_manifest_from_catalog(joint_catalog)[0]
+    entry = upload_utils.manifest_record_to_upload_entry(record)
+    assert entry['locations'] == ['some/dir/jpeg_here.png']
+    assert entry['metadata']['!filename'] == 'jpeg_here.png'
+
+
+class FakeSubject():
+
+    def __init__(self, metadata):
+        self.metadata = metadata
+        self.id = 'id_' + metadata['!filename']
+
+
+class FakeSubjectSet():
+
+    def __init__(self):
+        self.linked = []
+        self.batch_sizes = []
+
+    def add(self, subjects):
+        self.batch_sizes.append(len(subjects))
+        self.linked.extend(subjects)
+
+
+@pytest.fixture()
+def upload_manifest():
+    return [{'locations': ['{}.png'.format(n)], 'metadata': {'!filename': '{}.png'.format(n)}} for n in range(53)]
+
+
+def test_pipelined_upload_subjects(upload_manifest):
+    in_flight = {'now': 0, 'max': 0}
+    lock = threading.Lock()
+
+    def fake_save(locations, metadata, project, pbar, client):
+        with lock:
+            in_flight['now'] += 1
+            in_flight['max'] = max(in_flight['max'], in_flight['now'])
+        time.sleep(random.random() * 0.005)  # finish out of order
+        with lock:
+            in_flight['now'] -= 1
+        return FakeSubject(metadata)
+
+    subject_set = FakeSubjectSet()
+    n_linked = upload_utils.pipelined_upload_subjects(
+        manifest=iter(upload_manifest),
+        project='some_project',
+        subject_set=subject_set,
+        max_in_flight=4,
+        link_batch_size=10,
+        save_func=fake_save,
+        client='some_client')
+
+    assert n_linked == len(upload_manifest)
+    # linked in manifest order, in full batches apart from the last
+    assert [subject.metadata for subject in subject_set.linked] == [entry['metadata'] for entry in upload_manifest]
+    assert subject_set.batch_sizes == [10, 10, 10, 10, 10, 3]
+    assert 1 < in_flight['max'] <= 4
+
+
+def test_pipelined_upload_subjects_raises_failed_save(upload_manifest):
+
+    def fake_save(locations, metadata, project, pbar, client):
+        if metadata['!filename'] == '12.png':
+            raise FileNotFoundError('Missing subject location: 12.png')
+        return FakeSubject(metadata)
+
+    subject_set = FakeSubjectSet()
+    with pytest.raises(FileNotFoundError):
+        upload_utils.pipelined_upload_subjects(
+            manifest=upload_manifest,
+            project='some_project',
+            subject_set=subject_set,
+            max_in_flight=4,
+            link_batch_size=5,
+            save_func=fake_save,
+            client='some_client')
+    # everything before the failure was still linked
+    assert [subject.metadata['!filename'] for subject in subject_set.linked] == ['{}.png'.format(n) for n in range(10)]
+
+
+def test_pipelined_upload_subjects_with_journal(upload_manifest, tmpdir):
+    journal_loc = os.path.join(tmpdir.strpath, 'journal.db')
+
+    def fake_save(locations, metadata, project, pbar, client):
+        if metadata['!filename'] == '30.png':
+            raise ConnectionError('Lost connection to Panoptes')
+        return FakeSubject(metadata)
+
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        with pytest.raises(ConnectionError):
+            upload_utils.pipelined_upload_subjects(
+                manifest=upload_manifest,
+                project='some_project',
+                subject_set=FakeSubjectSet(),
+                max_in_flight=4,
+                link_batch_size=10,
+                save_func=fake_save,
+                client='some_client',
+                journal=journal)
+        n_saved_before_crash = len(journal)
+        assert n_saved_before_crash >= 30
+        assert all(journal.is_linked('{}.png'.format(n)) for n in range(30))
+
+    def fake_save_no_failures(locations, metadata, project, pbar, client):
+        return FakeSubject(metadata)
+
+    subject_set = FakeSubjectSet()
+    with journal_utils.UploadJournal(journal_loc, 'some_subject_set') as journal:
+        journal_utils.link_unlinked_subjects(journal, subject_set)
+        n_linked = upload_utils.pipelined_upload_subjects(
+            manifest=journal_utils.skip_saved_entries(upload_manifest, journal),
+            project='some_project',
+            subject_set=subject_set,
+            max_in_flight=4,
+            link_batch_size=10,
+            save_func=fake_save_no_failures,
+            client='some_client',
+            journal=journal)
+        assert n_linked == len(upload_manifest) - n_saved_before_crash
+        assert all(journal.is_linked(entry['metadata']['!filename']) for entry in upload_manifest)
+    # every subject saved exactly once, and linked exactly once between the two runs
+    assert len(subject_set.linked) == len(upload_manifest) - 30
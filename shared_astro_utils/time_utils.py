@@ -1,4 +1,7 @@
 import datetime
+import time
+import contextlib
+import collections
 
 
 def current_time():
@@ -7,3 +10,34 @@ def current_time():
 
 def current_date():
     return datetime.datetime.now().strftime("%Y-%m-%d")
+
+
+class Timings():
+    """
+    Accumulate wall-clock time (and number of calls) spent in named stages, e.g. 'panoptes_auth' vs 'panoptes_upload'
+    """
+
+    def __init__(self):
+        self.seconds = collections.defaultdict(float)
+        self.calls = collections.defaultdict(int)
+
+    @contextlib.contextmanager
+    def timed(self, name):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.seconds[name] += time.perf_counter() - start
+            self.calls[name] += 1
+
+    def reset(self):
+        self.seconds.clear()
+        self.calls.clear()
+
+    def summary(self):
+        return ', '.join(
+            '{}: {:.2f}s over {} calls'.format(name, self.seconds[name], self.calls[name]) for name in sorted(self.seconds))
+
+
+# process-wide timings, shared by e.g. subject_utils and upload_utils
+TIMINGS = Timings()
@@ -1,26 +1,51 @@
 import logging
 import os
+import string
 import functools
+import itertools
+import collections
 import ast
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
 
 import numpy as np
 import pandas as pd
 from tqdm import tqdm
 from panoptes_client import Panoptes, Project, SubjectSet, Subject
+from panoptes_client.subject import ASYNC_SAVE_THREADS
 
-from shared_astro_utils import time_utils, subject_utils
+from shared_astro_utils import time_utils, subject_utils, journal_utils, rate_limit_utils, preflight_utils, matching_utils
 
 UPLOAD_COLS = ['iauname', 'nsa_id', 'ra', 'dec', 'petrotheta',
                    'petroth50', 'petroth90', 'redshift', 'nsa_version', 'file_loc']
 
+SIMBAD_URL = 'http://simbad.u-strasbg.fr/simbad/sim-coo?Coord={ra}+%09{dec}&CooFrame=FK5&CooEpoch=2000&CooEqui=2000&CooDefinedFrames=none&Radius={search_radius}&Radius.unit=arcmin&submit=submit+query&CoordList='
+DECALS_URL = 'http://www.legacysurvey.org/viewer?ra={ra}&dec={dec}&zoom=15&layer=decals-dr5'
+# skyserver.sdss.org really does skip the wwww, but needs http or link keeps the original Zooniverse root
+SDSS_URL = 'http://skyserver.sdss.org/dr14/en/tools/chart/navi.aspx?ra={ra}&dec={dec}&scale=0.1&width=120&height=120&opt='
+NED_URL = 'https://ned.ipac.caltech.edu/cgi-bin/objsearch?search_type=Near+Position+Search&in_csys=Equatorial&in_equinox=J2000.0&lon={ra:3.8f}d&lat={dec:3.8f}d&radius={search_radius_arcmin}&hconst=73&omegam=0.27&omegav=0.73&corr_z=1&z_constraint=Unconstrained&z_value1=&z_value2=&z_unit=z&ot_include=ANY&nmp_op=ANY&out_csys=Equatorial&out_equinox=J2000.0&obj_sort=Distance+to+search+center&of=pre_text&zv_breaker=30000.0&list_limit=5&img_stamp=YES'
+VIZIER_URL = 'http://vizier.u-strasbg.fr/viz-bin/VizieR?&-c={ra},{dec}&-c.rs={search_radius}&-out.add=_r&-sort=_r'
+PANSTARRS_URL = 'http://ps1images.stsci.edu/cgi-bin/ps1cutouts?pos={ra}{dec:+f}&filter=color&filter=g&filter=r&filter=i&filter=z&filter=y&filetypes=stack&auxiliary=data&size=240&output_size=0&verbose=0&autoscale=99.500000&catlist='
+
+SEARCH_LINK_TEXT = {
+    'decals_search': 'Click to view in DECALS',
+    'sdss_search': 'Click to view in SDSS',
+    'panstarrs_dr1_search': 'Click to view in PANSTARRS DR1',
+    'simbad_search': 'Click to search SIMBAD',
+    'nasa_ned_search': 'Click to search NASA NED',
+    'vizier_search': 'Click to search VizieR'
+}
+
 def upload_to_gz(
         login_loc: str,
         selected_catalog: pd.DataFrame,
         name: str,
         retirement: int,
         project_id='5733',
-        uploader='gz_upload_util'):
+        uploader='gz_upload_util',
+        chunk_size=10000,
+        preflight=False,
+        deduplicate_radius=None):
     """Simple wrapper to upload selected galaxies to GZ
 
     Args:
@@ -30,15 +55,32 @@ def upload_to_gz(
         retirement (int): sets retirement_limit metadata field, used by Caesar to retire after this many classifications
         project_id (str, optional): Which project to upload to. Defaults to '5733'. 6490 for GZ Mobile.
         uploader (str, optional): Sets uploader metadata field, to name the uploader used (for posterity only). Defaults to 'gz_upload_util'.
+        chunk_size (int, optional): Number of catalog rows to convert to manifest entries at a time. Defaults to 10000.
+        preflight (bool, optional): If True, check every galaxy image before uploading, and drop galaxies with
+            missing, empty, unreadable, oversized or corrupt images (logging a report). See preflight_utils.
+            Defaults to False.
+        deduplicate_radius (astropy.units.Quantity, optional): If not None, upload only the first of any galaxies
+            within this separation of each other (e.g. the same galaxy from overlapping bricks).
+            See matching_utils.deduplicate_catalog. Defaults to None.
     """
+    if deduplicate_radius is not None:
+        selected_catalog, _ = matching_utils.deduplicate_catalog(selected_catalog, matching_radius=deduplicate_radius)
+
     # restrict to key columns
     upload_cols = UPLOAD_COLS
     upload_catalog = selected_catalog[upload_cols]
     upload_catalog['#retirement_limit'] = retirement
     upload_catalog['#uploader'] = uploader
 
-    logging.info(f'Uploading {len(selected_catalog)} subjects to {name}')
-    manifest = create_manifest_from_catalog(upload_catalog)
+    if preflight:
+        upload_catalog, _ = preflight_utils.preflight_catalog(upload_catalog, location_col='file_loc', drop_bad=True)
+
+    logging.info(f'Uploading {len(upload_catalog)} subjects to {name}')
+    # manifest entries are created lazily, chunk by chunk, as the upload consumes them
+    manifest = (
+        manifest_record_to_upload_entry(record)
+        for record in iter_manifest_from_catalog(upload_catalog, chunk_size=chunk_size)
+    )
     bulk_upload_subjects(
         subject_set_name=name,
         manifest=manifest,
@@ -47,7 +89,7 @@ def upload_to_gz(
     logging.info('Upload complete')
 
 
-def create_manifest_from_catalog(catalog):
+def create_manifest_from_catalog(catalog, vectorized=True):
     """
     Create dict of files and metadata.
     All columns will be uploaded and visible!
@@ -55,18 +97,89 @@ def create_manifest_from_catalog(catalog):
     Catalog including 'png_loc' and key astro data, one galaxy per row
     Catalog can only contain scalars.
     Required cols:
-        ['ra', 'dec']
+        ['ra', 'dec', 'file_loc']
     Suggested cols:
         ['redshift', 'iauname', 'nsa_version', 'nsa_id']
 
     Args:
         catalog (astropy.Table): NSA joint catalog to upload
+        vectorized (bool): if True, clean and build links column-by-column. If False, use the original
+            (much slower) element-wise and row-wise path. Both give identical manifests.
 
     Returns:
         (dict) of form {png_loc: img.png, metadata: {metadata_col: metadata_value}}
     """
     metadata_df = catalog.copy()  # assume already filtered - all cols will be included!
 
+    if vectorized:
+        metadata_df = replace_nan_and_bytes_by_column(metadata_df)
+        metadata_df = add_search_links(metadata_df)
+    else:
+        metadata_df = clean_and_add_search_links_rowwise(metadata_df)
+
+    # rename all columns to appear only in Talk by prepending with '!'
+    current_columns = set(metadata_df.columns.values) - {'#retirement_limit', '#uploader'}
+    prepended_columns = ['!' + col for col in current_columns]
+    metadata_df = metadata_df.rename(columns=dict(zip(current_columns, prepended_columns)))
+
+    metadata_df['metadata_df_message'] = 'You can access this galaxy\'s metadata if you chose to discuss it with other volunteers by pressing "Done and Talk" at the end of your classification.'
+    metadata_df['#upload_date'] = time_utils.current_date()  # not shown to users
+
+    # file_loc has been renamed along with everything else above
+    metadata_df['!filename'] = metadata_df['!file_loc'].apply(os.path.basename)
+    
+
+    # create the manifest structure that Panoptes Python client expects
+    if vectorized:
+        metadata = dataframe_to_records(metadata_df)
+    else:
+        metadata = metadata_df.to_dict(orient='records')
+
+    return metadata
+
+
+def iter_manifest_from_catalog(catalog, chunk_size=10000):
+    """
+    Lazily create manifest records, equivalent to create_manifest_from_catalog(catalog).
+    Works through catalog in chunks of chunk_size rows, so only one chunk of records
+    (and one chunk-sized copy of the catalog) is held in memory at a time.
+
+    Args:
+        catalog (pd.DataFrame): catalog to upload, as for create_manifest_from_catalog
+        chunk_size (int): number of rows to convert at a time
+
+    Yields:
+        (dict) manifest record, as for create_manifest_from_catalog
+    """
+    for chunk_start in range(0, len(catalog), chunk_size):
+        chunk = catalog.iloc[chunk_start:chunk_start + chunk_size]
+        yield from create_manifest_from_catalog(chunk)
+
+
+def manifest_record_to_upload_entry(record):
+    """
+    Convert a manifest record (from create_manifest_from_catalog) into the form bulk_upload_subjects expects
+
+    Args:
+        record (dict): manifest record, including '!file_loc'
+
+    Returns:
+        (dict) of form {locations: [img.png], metadata: record}
+    """
+    return {'locations': [record['!file_loc']], 'metadata': record}
+
+
+def clean_and_add_search_links_rowwise(metadata_df):
+    """
+    Original element-wise cleaning and row-wise link building for create_manifest_from_catalog.
+    Kept as the reference implementation that the vectorized path must match.
+
+    Args:
+        metadata_df (pd.DataFrame): catalog copy, one galaxy per row, with 'ra' and 'dec' columns
+
+    Returns:
+        (pd.DataFrame) with nan/bytes replaced and markdown search link columns added
+    """
     # np.nan cannot be handled by JSON encoder. Convert to flag value of -999
     metadata_df = metadata_df.applymap(replace_nan_with_flag)
     # bytes cannot be handled by JSON encoder. Convert to string
@@ -91,59 +204,161 @@ def create_manifest_from_catalog(catalog):
         lambda galaxy: coords_to_vizier(galaxy['ra'], galaxy['dec'], search_radius=10.),
         axis=1)
 
-    markdown_text = {
-        'decals_search': 'Click to view in DECALS',
-        'sdss_search': 'Click to view in SDSS',
-        'panstarrs_dr1_search': 'Click to view in PANSTARRS DR1',
-        'simbad_search': 'Click to search SIMBAD',
-        'nasa_ned_search': 'Click to search NASA NED',
-        'vizier_search': 'Click to search VizieR'
-    }
-    for link_column, link_text in markdown_text.items():
+    for link_column, link_text in SEARCH_LINK_TEXT.items():
         metadata_df[link_column] = metadata_df[link_column].apply(
             lambda url: wrap_url_in_new_tab_markdown(url=url, display_text=link_text))
 
-    # rename all columns to appear only in Talk by prepending with '!'
-    current_columns = set(metadata_df.columns.values) - {'#retirement_limit', '#uploader'}
-    prepended_columns = ['!' + col for col in current_columns]
-    metadata_df = metadata_df.rename(columns=dict(zip(current_columns, prepended_columns)))
+    return metadata_df
 
-    metadata_df['metadata_df_message'] = 'You can access this galaxy\'s metadata if you chose to discuss it with other volunteers by pressing "Done and Talk" at the end of your classification.'
-    metadata_df['#upload_date'] = time_utils.current_date()  # not shown to users
 
-    metadata_df['!filename'] = metadata_df['file_loc'].apply(os.path.basename)
-    
+def replace_nan_and_bytes_by_column(df):
+    """
+    Column-at-a-time equivalent of applymap(replace_nan_with_flag) followed by applymap(replace_bytes_with_str).
+    Float columns are masked in one numpy pass, object columns of only str or only bytes are handled directly,
+    and only genuinely mixed object columns fall back to checking each element.
+    Other dtypes (ints, bools, datetimes) can hold neither nan nor bytes and are left alone.
 
-    # create the manifest structure that Panoptes Python client expects
-    metadata = metadata_df.to_dict(orient='records')
+    Args:
+        df (pd.DataFrame): catalog to clean. Modified inplace.
 
-    return metadata
+    Returns:
+        (pd.DataFrame) df with nan/inf replaced by -999 and bytes decoded to str
+    """
+    for col in df.columns:
+        values = df[col].values
+        if values.dtype.kind == 'f':
+            # applymap also upcasts e.g. float32 to float64, so do the same
+            values = values.astype(np.float64)
+            df[col] = np.where(np.isfinite(values), values, -999.)
+        elif values.dtype.kind in 'Oc':
+            inferred_type = pd.api.types.infer_dtype(values, skipna=False)
+            if inferred_type == 'string':
+                continue  # nothing to replace
+            elif inferred_type == 'bytes':
+                df[col] = [x.decode('utf-8') for x in values]
+            else:
+                df[col] = df[col].map(lambda x: replace_bytes_with_str(replace_nan_with_flag(x)))
+    return df
+
+
+def add_search_links(df, search_radius=10.):
+    """
+    Add markdown search link columns (see SEARCH_LINK_TEXT) for every galaxy, using batched string formatting.
+    Matches coords_to_* and wrap_url_in_new_tab_markdown exactly, but formats each coordinate once per
+    format spec and assembles each link column by concatenating whole columns of strings.
+
+    Args:
+        df (pd.DataFrame): catalog with 'ra' and 'dec' columns. Modified inplace.
+        search_radius (float): search radius for SIMBAD, NED and VizieR links, in arcseconds
+
+    Returns:
+        (pd.DataFrame) df with search link columns added
+    """
+    # tolist gives python floats, which format identically to the numpy scalars seen by the row-wise path
+    fields = {
+        'ra': df['ra'].tolist(),
+        'dec': df['dec'].tolist(),
+        'search_radius': [search_radius],
+        'search_radius_arcmin': [search_radius / 60.]
+    }
+    formatted_fields = {}  # cache of {(field, format_spec): object array of formatted strings}
+    for link_column, template in search_link_templates().items():
+        link = np.full(len(df), '', dtype=object)
+        for literal_text, field, format_spec, _ in string.Formatter().parse(template):
+            link += literal_text
+            if field is None:
+                continue
+            if (field, format_spec) not in formatted_fields:
+                formatted = [format(value, format_spec) for value in fields[field]]
+                formatted_fields[(field, format_spec)] = np.array(formatted, dtype=object)
+            link += formatted_fields[(field, format_spec)]  # broadcasts the single-valued search radii
+        df[link_column] = link
+    return df
+
+
+def search_link_templates():
+    """
+    Get markdown search link templates, one per SEARCH_LINK_TEXT column.
+    Formatting a template with ra, dec and search radius keywords is equivalent to wrapping
+    the matching coords_to_* url in markdown.
+
+    Returns:
+        (dict) of form {link_column: template}
+    """
+    url_templates = {
+        'decals_search': DECALS_URL,
+        'sdss_search': SDSS_URL,
+        'panstarrs_dr1_search': PANSTARRS_URL,
+        'simbad_search': SIMBAD_URL,
+        'nasa_ned_search': NED_URL,
+        'vizier_search': VIZIER_URL
+    }
+    return {
+        link_column: wrap_url_in_new_tab_markdown(url=url_templates[link_column], display_text=link_text)
+        for link_column, link_text in SEARCH_LINK_TEXT.items()
+    }
+
+
+def dataframe_to_records(df):
+    """
+    Faster equivalent of df.to_dict(orient='records').
+    Converts each column to python objects in one pass with tolist, rather than boxing every element separately.
+
+    Args:
+        df (pd.DataFrame): dataframe to convert
+
+    Returns:
+        (list) of dicts of form {column: value}, one per row
+    """
+    columns = []
+    for col in df.columns:
+        values = df[col].tolist()
+        if df[col].dtype.kind == 'O' and pd.api.types.infer_dtype(values, skipna=False) != 'string':
+            # tolist leaves numpy scalars inside object columns alone, but to_dict makes them native
+            values = [x.item() if isinstance(x, np.generic) else x for x in values]
+        columns.append(values)
+    column_names = list(df.columns)
+    return [dict(zip(column_names, row)) for row in zip(*columns)]
 
 
 def bulk_upload_subjects(
     subject_set_name, 
     manifest, 
     project_id='5733',  # default to main GZ project
-    async_batch_size=20
-    # login_loc='zooniverse_login.txt'
+    async_batch_size=20,
+    max_in_flight=None,
+    journal_loc=None,
+    login_loc=None,
+    preflight=False
     ):
     """
     Save manifest (set of galaxies with metadata prepared) to Galaxy Zoo
 
     Args:
         subject_set_name (str): name for subject set
-        manifest (list): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}.
+            May be a generator, which will be consumed one async_batch_size block at a time.
         project_id (str): panoptes project id e.g. '5733' for Galaxy Zoo, '6490' for mobile
-        n_processes (int): number of processes with which to upload galaxies in parallel
+        async_batch_size (int): number of subjects to save before linking them to the subject set
+        max_in_flight (int): if not None, upload with pipelined_upload_subjects, keeping this many saves
+            in flight while earlier subjects are linked. If None, save and link one async block at a time.
+        journal_loc (str): if not None, record saved and linked subjects in an UploadJournal at this location.
+            Entries already saved according to the journal are skipped, and any saved but unlinked subjects are linked,
+            so an interrupted upload can be safely restarted with the same manifest and journal_loc.
+        login_loc (str): path to json file of form {"username": ..., "password": ...}. See subject_utils.authenticate.
+        preflight (bool): if True, check every subject location before uploading anything, and drop entries with
+            bad locations. Reads the whole manifest into memory. See preflight_utils.preflight_manifest.
 
     Returns:
         None
     """
-    # assert os.path.exists(login_loc)
     if 'TEST' in subject_set_name:
         logging.warning('Testing mode detected - not uploading!')
         return manifest
 
+    if preflight:
+        manifest, _ = preflight_utils.preflight_manifest(manifest, drop_bad=True)
+
     if project_id == '5733':
         logging.info('Uploading to Galaxy Zoo project 5733')
     elif project_id == '6490':
@@ -153,9 +368,7 @@ def bulk_upload_subjects(
     else:
         logging.info('Uploading to unknown project {}'.format(project_id))
 
-    subject_utils.authenticate()
-
-
+    subject_utils.authenticate(login_loc)  # only logs in if this process has not already
 
     project = Project.find(project_id)
 
@@ -174,7 +387,16 @@ def bulk_upload_subjects(
 
     subject_set = subject_utils.get_or_create_subject_set(project_id, subject_set_name)
 
-    pbar = tqdm(total=len(manifest), unit=' subjects uploaded')
+    # generators have no length, in which case the bar just counts up
+    pbar = tqdm(total=len(manifest) if hasattr(manifest, '__len__') else None, unit=' subjects uploaded')
+
+    journal = None
+    if journal_loc is not None:
+        journal = journal_utils.UploadJournal(journal_loc, subject_set_name)
+        journal_utils.link_unlinked_subjects(journal, subject_set)
+        manifest_to_upload = journal_utils.skip_saved_entries(manifest, journal, pbar=pbar)
+    else:
+        manifest_to_upload = manifest
 
     # save_subject_params = {
     #     'project': project,
@@ -187,37 +409,240 @@ def bulk_upload_subjects(
 
     # https://github.com/zooniverse/panoptes-cli/blob/fb5da0d61fe50d441baef5d62079d1f91e2b5a46/panoptes_cli/commands/subject_set.py#L411
     # https://github.com/zooniverse/panoptes-python-client/issues/290
-        
-    manifest_block_start = 0
-    while True:
-        manifest_block = manifest[manifest_block_start: manifest_block_start + async_batch_size]
-        
-
-        new_subjects = []
-        with Subject.async_saves():
-            for manifest_entry in manifest_block:
-                new_subjects.append(
-                    save_subject(
-                        locations=manifest_entry['locations'], 
-                        metadata=manifest_entry['metadata'],
-                        project=project,
-                        pbar=pbar
-                    )
-                )
-        # new - avoid the link race condition panoptes-side by doing the 'add' link one at a time
-        # the add (vs the save) is pretty much instant
-        for subject in new_subjects:
-            subject_set.add(subject)
-        logging.info('{} subjects linked'.format(new_subjects))
 
-        manifest_block_start += async_batch_size
-        if manifest_block_start > len(manifest):
-            break
+    try:
+        with time_utils.TIMINGS.timed('panoptes_upload'):
+            upload_manifest(
+                manifest=manifest_to_upload,
+                project=project,
+                subject_set=subject_set,
+                async_batch_size=async_batch_size,
+                max_in_flight=max_in_flight,
+                pbar=pbar,
+                journal=journal)
+    finally:
+        if journal is not None:
+            journal.close()
+    logging.info('Panoptes time so far - {}'.format(time_utils.TIMINGS.summary()))
+    logging.info('Panoptes write rate limiting - {}'.format(rate_limit_utils.PANOPTES_WRITE_LIMITER.stats))
 
     return manifest  # for debugging only
 
 
-def save_subject(locations, project, metadata, pbar=None):
+def upload_manifest(manifest, project, subject_set, async_batch_size=20, max_in_flight=None, pbar=None, journal=None):
+    """
+    Save and link manifest entries, either pipelined or one async block at a time
+
+    Args:
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        project (panoptes_client.Project): project to save subjects to
+        subject_set (panoptes_client.SubjectSet): subject set to link saved subjects to
+        async_batch_size (int): number of subjects to save before linking them to the subject set
+        max_in_flight (int): if not None, use pipelined_upload_subjects with this many saves in flight.
+            If None, use upload_subjects_in_blocks.
+        pbar (tqdm.tqdm): progress bar to update. If None, no bar will display.
+        journal (UploadJournal): if not None, record saved and linked subjects
+
+    Returns:
+        None
+    """
+    if max_in_flight is not None:
+        pipelined_upload_subjects(
+            manifest=manifest,
+            project=project,
+            subject_set=subject_set,
+            max_in_flight=max_in_flight,
+            link_batch_size=async_batch_size,
+            pbar=pbar,
+            journal=journal)
+    else:
+        upload_subjects_in_blocks(
+            manifest=manifest,
+            project=project,
+            subject_set=subject_set,
+            async_batch_size=async_batch_size,
+            pbar=pbar,
+            journal=journal)
+
+
+def upload_subjects_in_blocks(
+        manifest, project, subject_set, async_batch_size=20, pbar=None, journal=None, max_workers=ASYNC_SAVE_THREADS,
+        client=None):
+    """
+    Save manifest entries one block at a time, linking each block to subject_set once it has saved.
+    Each block is saved concurrently in worker threads, like Subject.async_saves, but each save is a real
+    (blocking) request made through rate_limit_utils.panoptes_create, so it is rate limited, and retried if throttled.
+    Within Subject.async_saves, save() only queues the request and returns at once, hiding it from the rate limiter.
+
+    Args:
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        project (panoptes_client.Project): project to save subjects to
+        subject_set (panoptes_client.SubjectSet): subject set to link saved subjects to
+        async_batch_size (int): number of subjects to save before linking them to the subject set
+        pbar (tqdm.tqdm): progress bar to update. If None, no bar will display.
+        journal (UploadJournal): if not None, record each block as saved, then as linked.
+            If any save fails, the rest of the block is still recorded and linked before the error is raised.
+        max_workers (int): number of subjects to save concurrently, within each block
+        client (panoptes_client.Panoptes): authenticated client for the worker threads to use.
+            Panoptes clients are thread-local, so defaults to this thread's client.
+
+    Returns:
+        None
+    """
+    if client is None:
+        client = Panoptes.client()
+    manifest_iter = iter(manifest)
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        while True:
+            manifest_block = list(itertools.islice(manifest_iter, async_batch_size))
+            if not manifest_block:
+                break
+
+            futures = [
+                executor.submit(
+                    save_subject,
+                    locations=manifest_entry['locations'],
+                    metadata=manifest_entry['metadata'],
+                    project=project,
+                    pbar=pbar,
+                    client=client
+                )
+                for manifest_entry in manifest_block
+            ]
+            # like the pipelined path, only record (and link) subjects once they have saved
+            new_subjects, keys, error = [], [], None
+            for manifest_entry, future in zip(manifest_block, futures):
+                try:
+                    new_subjects.append(future.result())
+                except Exception as e:
+                    logging.warning('Failed to save {}: {}'.format(manifest_entry['metadata'], e))
+                    error = error if error is not None else e
+                    continue
+                keys.append(journal_utils.manifest_entry_key(manifest_entry['metadata']))
+            if journal is not None:
+                journal.record_many_saved([(key, subject.id) for key, subject in zip(keys, new_subjects)])
+            # new - avoid the link race condition panoptes-side by doing the 'add' link one at a time
+            # the add (vs the save) is pretty much instant
+            for subject in new_subjects:
+                rate_limit_utils.panoptes_write(subject_set.add, subject)
+            if journal is not None:
+                journal.record_linked(keys)
+            logging.info('{} subjects linked'.format(new_subjects))
+            if error is not None:
+                raise error  # the rest of the block is saved and linked, so a restart only re-uploads the failures
+
+
+def pipelined_upload_subjects(
+    manifest,
+    project,
+    subject_set,
+    max_in_flight=8,
+    link_batch_size=20,
+    pbar=None,
+    save_func=None,
+    client=None,
+    journal=None):
+    """
+    Save and link manifest entries as a pipeline, rather than in stop-start async blocks.
+    Up to max_in_flight subjects are saved concurrently in worker threads. Meanwhile, this thread links
+    finished subjects to subject_set in manifest order, link_batch_size at a time.
+    Linking only ever happens from this one thread, and only after each subject has saved,
+    so links never race each other panoptes-side (as with the one-at-a-time links in bulk_upload_subjects).
+    At most max_in_flight + link_batch_size entries are held at once, so memory stays flat
+    however long the manifest (or manifest generator) is.
+
+    Args:
+        manifest (iterable): containing dicts of form {locations: [img.jpg], metadata: {metadata_col: metadata_value, ...}}
+        project (panoptes_client.Project): project to save subjects to
+        subject_set (panoptes_client.SubjectSet): subject set to link saved subjects to
+        max_in_flight (int): number of subjects to save concurrently
+        link_batch_size (int): number of saved subjects to link with each subject_set.add call
+        pbar (tqdm.tqdm): progress bar to update. If None, no bar will display.
+        save_func (func): saves one subject and returns it, with the same arguments as save_subject.
+            Defaults to save_subject.
+        client (panoptes_client.Panoptes): authenticated client for the worker threads to use.
+            Panoptes clients are thread-local, so defaults to this thread's client.
+        journal (UploadJournal): if not None, record each subject as saved as soon as it saves, and as linked once linked
+
+    Returns:
+        (int) number of subjects saved and linked
+    """
+    if save_func is None:
+        save_func = save_subject
+    if client is None:
+        client = Panoptes.client()
+    if journal is not None:
+        save_func = journaled_save_func(save_func, journal)
+
+    n_linked = 0
+    pending = collections.deque()  # futures of subjects being saved, in manifest order
+    with ThreadPoolExecutor(max_workers=max_in_flight) as executor:
+        try:
+            for manifest_entry in manifest:
+                pending.append(executor.submit(
+                    save_func,
+                    locations=manifest_entry['locations'],
+                    metadata=manifest_entry['metadata'],
+                    project=project,
+                    pbar=pbar,
+                    client=client
+                ))
+                # stop reading the manifest until the oldest batch is linked, which bounds the saves queued
+                if len(pending) >= max_in_flight + link_batch_size:
+                    n_linked += link_subject_batch(subject_set, pending, link_batch_size, journal)
+            while pending:
+                n_linked += link_subject_batch(subject_set, pending, link_batch_size, journal)
+        except BaseException:
+            # don't wait for the rest of the manifest to upload before reporting the error
+            for future in pending:
+                future.cancel()
+            raise
+    return n_linked
+
+
+def journaled_save_func(save_func, journal):
+    """
+    Wrap save_func to record each subject in journal as soon as it saves
+
+    Args:
+        save_func (func): saves one subject and returns it, with the same arguments as save_subject
+        journal (UploadJournal): journal to record saved subjects in
+
+    Returns:
+        (func) save_func, which also records saved subjects
+    """
+    def save_and_record(**kwargs):
+        subject = save_func(**kwargs)
+        journal.record_saved(journal_utils.manifest_entry_key(kwargs['metadata']), subject.id)
+        return subject
+    return save_and_record
+
+
+def link_subject_batch(subject_set, pending, link_batch_size, journal=None):
+    """
+    Wait for the oldest link_batch_size pending saves to finish, and link those subjects to subject_set
+
+    Args:
+        subject_set (panoptes_client.SubjectSet): subject set to link saved subjects to
+        pending (collections.deque): futures of saved subjects, oldest first. Linked futures are removed.
+        link_batch_size (int): max. number of subjects to link
+        journal (UploadJournal): if not None, record linked subjects
+
+    Returns:
+        (int) number of subjects linked
+    """
+    batch = []
+    while pending and len(batch) < link_batch_size:
+        batch.append(pending[0].result())  # raises if the save failed
+        pending.popleft()
+    rate_limit_utils.panoptes_write(subject_set.add, batch)
+    if journal is not None:
+        journal.record_linked([journal_utils.manifest_entry_key(subject.metadata) for subject in batch])
+    logging.debug('{} subjects linked'.format(len(batch)))
+    return len(batch)
+
+
+def save_subject(locations, project, metadata, pbar=None, client=None):
     """
     Add manifest item to project. Note: follow with subject_set.add(subject) to associate with subject set.
     Args:
@@ -225,6 +650,7 @@ def save_subject(locations, project, metadata, pbar=None):
         project (str): project to upload subject too e.g. '5773' for Galaxy Zoo
         metadata (dict): metadata to attach to subject
         pbar (tqdm.tqdm): progress bar to update. If None, no bar will display.
+        client (panoptes_client.Panoptes): client to save with. If None, use this thread's client.
 
     Returns:
         None
@@ -239,9 +665,9 @@ def save_subject(locations, project, metadata, pbar=None):
     assert '!filename' in metadata.keys(), 'Metadata must contain !filename for BAJOR'
     subject.metadata.update(metadata)
 
-    subject.save()
+    rate_limit_utils.panoptes_create(subject.save, client=client)
 
-    if pbar:
+    if pbar is not None:
         pbar.update()
 
     return subject
@@ -291,7 +717,7 @@ def coords_to_simbad(ra, dec, search_radius):
     Returns:
         (str): SIMBAD database search url for objects at ra, dec
     """
-    return 'http://simbad.u-strasbg.fr/simbad/sim-coo?Coord={0}+%09{1}&CooFrame=FK5&CooEpoch=2000&CooEqui=2000&CooDefinedFrames=none&Radius={2}&Radius.unit=arcmin&submit=submit+query&CoordList='.format(ra, dec, search_radius)
+    return SIMBAD_URL.format(ra=ra, dec=dec, search_radius=search_radius)
 
 
 def coords_to_decals_skyviewer(ra, dec):
@@ -304,7 +730,7 @@ def coords_to_decals_skyviewer(ra, dec):
     Returns:
         (str): decals_skyviewer viewpoint url for objects at ra, dec
     """
-    return 'http://www.legacysurvey.org/viewer?ra={}&dec={}&zoom=15&layer=decals-dr5'.format(ra, dec)
+    return DECALS_URL.format(ra=ra, dec=dec)
 
 
 def coords_to_sdss_navigate(ra, dec):
@@ -317,8 +743,7 @@ def coords_to_sdss_navigate(ra, dec):
     Returns:
         (str): sdss navigate url for objects at ra, dec
     """
-    # skyserver.sdss.org really does skip the wwww, but needs http or link keeps the original Zooniverse root
-    return 'http://skyserver.sdss.org/dr14/en/tools/chart/navi.aspx?ra={}&dec={}&scale=0.1&width=120&height=120&opt='.format(ra, dec)
+    return SDSS_URL.format(ra=ra, dec=dec)
 
 
 def coords_to_ned(ra, dec, search_radius):
@@ -332,10 +757,8 @@ def coords_to_ned(ra, dec, search_radius):
     Returns:
         (str): SIMBAD database search url for objects at ra, dec
     """
-    ra_string = '{:3.8f}d'.format(ra)
-    dec_string = '{:3.8f}d'.format(dec)
     search_radius_arcmin = search_radius / 60.
-    return 'https://ned.ipac.caltech.edu/cgi-bin/objsearch?search_type=Near+Position+Search&in_csys=Equatorial&in_equinox=J2000.0&lon={}&lat={}&radius={}&hconst=73&omegam=0.27&omegav=0.73&corr_z=1&z_constraint=Unconstrained&z_value1=&z_value2=&z_unit=z&ot_include=ANY&nmp_op=ANY&out_csys=Equatorial&out_equinox=J2000.0&obj_sort=Distance+to+search+center&of=pre_text&zv_breaker=30000.0&list_limit=5&img_stamp=YES'.format(ra_string, dec_string, search_radius_arcmin)
+    return NED_URL.format(ra=ra, dec=dec, search_radius_arcmin=search_radius_arcmin)
 
 
 def coords_to_vizier(ra, dec, search_radius):
@@ -351,8 +774,7 @@ def coords_to_vizier(ra, dec, search_radius):
     Returns:
         (str): vizier url for objects at ra, dec
     """
-    return 'http://vizier.u-strasbg.fr/viz-bin/VizieR?&-c={},{}&-c.rs={}&-out.add=_r&-sort=_r'.format(
-        ra, dec, search_radius)
+    return VIZIER_URL.format(ra=ra, dec=dec, search_radius=search_radius)
 
 
 def coords_to_panstarrs(ra, dec):
@@ -366,8 +788,7 @@ def coords_to_panstarrs(ra, dec):
     Returns:
         (str): cutout url for objects at ra, dec
     """
-    return 'http://ps1images.stsci.edu/cgi-bin/ps1cutouts?pos={}{:+f}&filter=color&filter=g&filter=r&filter=i&filter=z&filter=y&filetypes=stack&auxiliary=data&size=240&output_size=0&verbose=0&autoscale=99.500000&catlist='.format(
-        ra, dec)
+    return PANSTARRS_URL.format(ra=ra, dec=dec)
 
 
 def wrap_url_in_new_tab_markdown(url, display_text):